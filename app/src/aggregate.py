@@ -0,0 +1,143 @@
+"""
+Windowed statistics of the numeric tags.
+
+Instead of every sample, sinks can get one record per time window with the
+min, max, mean and count of every numeric tag, and the latest value of the
+other tags:
+
+    {"Temperature": {"min": 26, "max": 28, "mean": 27.1, "count": 600}, "Key": "SELECT"}
+
+With more than one device the record is keyed by device name like the
+samples are. Windows are aligned to multiples of step seconds of the wall
+clock. A step shorter than the window gives sliding windows that overlap.
+
+Samples are never kept. The window is split into panes of step seconds
+that only hold running min/max/sum/count per tag, so adding a sample is
+O(1) and memory use does not depend on the poll rate. At the end of each
+pane the panes of the window are combined into the record.
+"""
+import collections
+import logging
+import math
+import threading
+import time
+
+from wireformat import flatten, unflatten
+
+logger = logging.getLogger("modbusapp")
+
+
+class Pane(object):
+    """
+    Running statistics of the samples of one step.
+    """
+    __slots__ = ("stats", "latest")
+
+    def __init__(self):
+        # name -> [min, max, sum, count]
+        self.stats = dict()
+        # name -> latest value of non numeric tags
+        self.latest = dict()
+
+
+class AggregateStage(threading.Thread):
+    """
+    Aggregate samples and publish one record per step to the sinks.
+    """
+    def __init__(self, sinks, window=60, step=None):
+        super(AggregateStage, self).__init__()
+        self.name = "AggregateStage"
+        self.setDaemon(True)
+        self.stop_event = threading.Event()
+        step = step or window
+        panes = window / float(step)
+        if step <= 0 or panes < 1 or abs(panes - round(panes)) > 1e-9:
+            raise ValueError("The aggregation window must be a multiple of its step")
+        self.sinks = list(sinks)
+        self.window = window
+        self.step = step
+        self.lock = threading.Lock()
+        self.pane = Pane()
+        self.panes = collections.deque(maxlen=int(round(panes)))
+
+    def publish(self, sample, timestamp=None):
+        with self.lock:
+            pane = self.pane
+            for name, value in flatten(sample).iteritems():
+                if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                    pane.latest[name] = value
+                    continue
+                s = pane.stats.get(name)
+                if s is None:
+                    pane.stats[name] = [value, value, value, 1]
+                    continue
+                if value < s[0]:
+                    s[0] = value
+                elif value > s[1]:
+                    s[1] = value
+                s[2] += value
+                s[3] += 1
+
+    def roll(self):
+        """
+        Close the current pane. Returns the record of the window that ends
+        with it, or None if the window has no samples.
+        """
+        with self.lock:
+            self.panes.append(self.pane)
+            self.pane = Pane()
+
+        combined = dict()
+        latest = dict()
+        for pane in self.panes:
+            latest.update(pane.latest)
+            for name, (lo, hi, total, count) in pane.stats.iteritems():
+                s = combined.get(name)
+                if s is None:
+                    combined[name] = [lo, hi, total, count]
+                else:
+                    if lo < s[0]:
+                        s[0] = lo
+                    if hi > s[1]:
+                        s[1] = hi
+                    s[2] += total
+                    s[3] += count
+        if not combined and not latest:
+            return None
+
+        record = latest
+        for name, (lo, hi, total, count) in combined.iteritems():
+            record[name] = {"min": lo, "max": hi, "mean": total / float(count), "count": count}
+        return unflatten(record)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        logger.info("Aggregating %ds windows every %ds for %s", self.window, self.step,
+                    ", ".join(sink.name for sink in self.sinks))
+        while not self.stop_event.is_set():
+            now = time.time()
+            boundary = (math.floor(now / self.step) + 1) * self.step
+            if self.stop_event.wait(boundary - now):
+                break
+            record = self.roll()
+            if record is None:
+                continue
+            for sink in self.sinks:
+                sink.publish(record, boundary)
+
+
+def load_aggregate(cfg, sinks):
+    """
+    Create the aggregation stage of the [aggregate] section for the sinks
+    it lists, or return None when it is disabled.
+    """
+    if not cfg.has_option("aggregate", "enabled") or not cfg.getboolean("aggregate", "enabled"):
+        return None
+    names = ["cloud"]
+    if cfg.has_option("aggregate", "sinks"):
+        names = [n.strip() for n in cfg.get("aggregate", "sinks").split(",") if n.strip()]
+    window = cfg.getint("aggregate", "window") if cfg.has_option("aggregate", "window") else 60
+    step = cfg.getint("aggregate", "step") if cfg.has_option("aggregate", "step") else None
+    return AggregateStage([sink for sink in sinks if sink.section in names], window, step)
@@ -0,0 +1,559 @@
+"""
+Multi device modbus collector.
+
+A single dispatcher thread keeps every configured device on a deadline
+schedule and hands due polls to a fixed pool of worker threads. Devices
+behind the same gateway (server:port) share a small pool of TCP connections
+whose size bounds the number of requests in flight to that gateway, so the
+number of threads and sockets stays flat no matter how many devices are
+configured.
+
+Connections that fail are closed and reopened on the next poll. Failed
+connects and reads put the gateway into a jittered exponential backoff;
+polls that come due before the next reconnect attempt fail fast without
+touching the network, and a failed poll is retried as soon as the backoff
+allows instead of waiting for its next deadline.
+
+Devices are configured with one section per device:
+
+    [device:plc1]
+    server: 10.0.0.5
+    port: 502
+    unit: 1
+    poll_frequency: 5
+    tags: tags
+
+Without any device section, the [sensors] section describes the only device.
+
+Modbus RTU devices are on a serial port, or behind a TCP to serial gateway
+that forwards RTU frames as they are:
+
+    [device:meter7]
+    serial: /dev/ttyUSB0
+    baudrate: 19200
+    parity: E
+    unit: 7
+
+    [device:meter8]
+    server: 10.0.0.6
+    port: 4001
+    framer: rtu
+    unit: 8
+
+All RTU devices on the same port or gateway share one bus, polled through
+a single connection: polls of the bus wait in deadline order for the
+connection and a request is only sent after the inter-frame gap, so the
+bus never carries two frames at once. A slave that stops answering costs
+the whole bus a timeout per request, so after a poll without an answer
+that slave is skipped, with its own backoff, and the bus goes on with the
+others. The expected load of every bus is logged at start up.
+
+Every poll produces a new immutable DeviceState of its device, with the
+time, latency and quality of the read of each tag, and swaps it in. Polls
+of the same device in different groups only serialize on that swap. Tags
+of a failed poll keep their last good values with quality comm_fail, or
+stale when the poll was skipped while the gateway is backing off.
+
+With report by exception enabled in [report], every device filters its
+samples through a ReportFilter and on_sample also gets the changed values.
+
+Tags assigned to a group are polled at the rate of that group instead of the
+poll frequency of the device:
+
+    [poll_groups]
+    fast: 0.1
+    geo: 60
+"""
+import collections
+import heapq
+import logging
+import threading
+import time
+import Queue
+
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
+from connection import Backoff, ModbusConnection, RtuConnection, SerialLine
+from metrics import REGISTRY
+from readplan import MAX_READ_COUNT
+from report import ReportFilter, load_report
+from scheduler import Schedule, monotonic
+from snapshot import COMM_FAIL, GOOD, STALE, DeviceState
+from tagmap import TagMap, load_tags
+
+logger = logging.getLogger("modbusapp")
+
+DEVICE_SECTION_PREFIX = "device:"
+FRAMERS = ("tcp", "rtu")
+
+DECODE_SECONDS = REGISTRY.histogram("modbus_decode_seconds", "Time to decode the registers of a poll",
+                                    buckets=(1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01))
+POLLS = REGISTRY.counter("collector_polls_total", "Polls run by the collector")
+MISSED = REGISTRY.counter("collector_missed_deadlines_total", "Poll deadlines missed because polls ran late")
+
+
+class Device(object):
+    """
+    A modbus slave polled by the collector. RTU slaves are on the serial
+    port at path, with the settings of line, or behind server:port.
+    """
+    def __init__(self, name, server, port, unit=None, framer="tcp", path=None, line=None):
+        if framer not in FRAMERS:
+            raise ValueError("%s: framer must be one of %s" % (name, ", ".join(FRAMERS)))
+        if path is not None and framer != "rtu":
+            raise ValueError("%s: serial devices need framer rtu" % name)
+        self.name = name
+        self.server = server
+        self.port = port
+        self.unit = unit
+        self.framer = framer
+        self.path = path
+        self.line = line
+        # Skips the polls of an RTU slave that stopped answering
+        self.backoff = None
+        # Called with the arguments of every update, in the order of the
+        # states they make
+        self.listener = None
+        self.state = DeviceState(())
+        self.index = dict()
+        self.lock = threading.Lock()
+        self.report = None
+        self.gateway = None
+        self.jobs = []
+
+    def __repr__(self):
+        return "Device(%s, %s, unit=%s)" % (self.name, self.endpoint, self.unit)
+
+    @property
+    def endpoint(self):
+        """
+        The serial port or server:port the device is reached through.
+        """
+        if self.path is not None:
+            return self.path
+        return "%s:%s" % (self.server, self.port)
+
+    def add_jobs(self, jobs):
+        """
+        Poll the tags of jobs, and start over with an empty state.
+        """
+        self.jobs.extend(jobs)
+        names = tuple(tag.name for job in self.jobs for tag in job.tagmap.tags)
+        self.index = dict((name, i) for i, name in enumerate(names))
+        for job in self.jobs:
+            job.indexes = [self.index[tag.name] for tag in job.tagmap.tags]
+        self.state = DeviceState(names)
+
+    def update(self, job, values, timestamp, quality=GOOD, latency=None, errors=()):
+        """
+        Swap in a new state with the values read by a job, or with the
+        quality of its tags when values is None. errors are the names of
+        tags that failed to decode. Returns the new state.
+        """
+        positions = [self.index[name] for name in errors] if errors else ()
+        with self.lock:
+            self.state = self.state.update(job.indexes, values, timestamp, quality, latency, positions)
+            if self.listener is not None:
+                self.listener(job, values, timestamp, quality, latency, errors)
+            return self.state
+
+    def changes(self, state):
+        """
+        The values of a new state to report: none after a failed poll, the
+        changed ones with report by exception, otherwise all.
+        """
+        if state.fresh is None:
+            # Nothing new to report, the sinks only learn the quality
+            return dict()
+        if self.report is not None:
+            return self.report.update(state.values, monotonic())
+        return state.values
+
+
+class PollJob(object):
+    """
+    The tags of a device that share a poll rate.
+    """
+    def __init__(self, device, group, tagmap, period):
+        self.device = device
+        self.group = group
+        self.tagmap = tagmap
+        self.schedule = Schedule(period)
+        # Positions of the tags in the state of the device
+        self.indexes = []
+
+    def __repr__(self):
+        return "PollJob(%s, group=%s, every %ss)" % (self.device.name, self.group, self.schedule.period)
+
+    def poll(self, connection):
+        """
+        Read and decode the tags of the job. Returns the new state of the
+        device.
+        """
+        tagmap = self.tagmap
+        metrics = self.device.gateway.metrics
+        start = time.time()
+        blocks = connection.read_blocks(tagmap.requests, self.device.unit)
+        decode = time.time()
+        metrics.reads.observe(decode - start)
+        metrics.requests.inc(len(blocks))
+        values = dict()
+        errors = []
+        for index, data in enumerate(blocks):
+            tagmap.decode_block(index, data, values, errors)
+        DECODE_SECONDS.observe(time.time() - decode)
+        if errors:
+            metrics.decode_errors.inc(len(errors))
+        return self.device.update(self, values, decode, GOOD, decode - start, errors)
+
+
+class GatewayMetrics(object):
+    """
+    The metrics of the polls through one gateway.
+    """
+    __slots__ = ("reads", "requests", "connection_errors", "exceptions", "timeouts", "decode_errors")
+
+    def __init__(self, gateway):
+        labels = {"gateway": gateway.name}
+        self.reads = REGISTRY.histogram("modbus_read_seconds", "Duration of the modbus reads of a poll",
+                                        **labels)
+        self.requests = REGISTRY.counter("modbus_requests_total", "Modbus read requests answered", **labels)
+        self.connection_errors = REGISTRY.counter("modbus_errors_total", "Failed polls",
+                                                  kind="connection", **labels)
+        self.exceptions = REGISTRY.counter("modbus_errors_total", "Failed polls", kind="exception", **labels)
+        self.timeouts = REGISTRY.counter("modbus_errors_total", "Failed polls", kind="timeout", **labels)
+        self.decode_errors = REGISTRY.counter("modbus_decode_errors_total", "Tag values that failed to decode",
+                                              **labels)
+
+
+class Gateway(object):
+    """
+    A modbus TCP endpoint or RTU bus shared by one or more devices. Holds
+    one connection per allowed in flight poll and the reconnect backoff
+    shared by all of them. framer and line are those of the devices.
+    """
+    def __init__(self, name, connections, framer="tcp", line=None, reconnect_min=0.05, reconnect_max=10.0):
+        self.name = name
+        self.framer = framer
+        self.line = line
+        self.connections = connections
+        self.idle = list(self.connections)
+        self.pending = collections.deque()
+        self.backoff = Backoff(reconnect_min, reconnect_max)
+        self.lock = threading.Lock()
+        self.metrics = GatewayMetrics(self)
+
+    def __repr__(self):
+        return "Gateway(%s)" % self.name
+
+    def connect(self, connection):
+        """
+        Open connection if it is closed. Returns False without trying while
+        the gateway is backing off.
+        """
+        if connection.connected:
+            return True
+        with self.lock:
+            if monotonic() < self.backoff.retry_at:
+                return False
+        connection.connect()
+        logger.info("Connected to modbus server %s", self.name)
+        return True
+
+    def failed(self):
+        """
+        Record a failed connect or read. Returns the time of the next attempt.
+        """
+        with self.lock:
+            return self.backoff.failed(monotonic())
+
+    def succeeded(self):
+        if self.backoff.failures:
+            with self.lock:
+                self.backoff.succeeded()
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+    def load(self, devices):
+        """
+        Estimated fraction of the time the polls of devices keep an RTU bus
+        busy, without retries and slave response times.
+        """
+        busy = 0.0
+        for device in devices:
+            for job in device.jobs:
+                busy += sum(self.line.read_time(count) for _, count in job.tagmap.requests) / job.schedule.period
+        return busy
+
+
+def _get(cfg, section, option, default, conv=None):
+    if not cfg.has_option(section, option):
+        return default
+    value = cfg.get(section, option)
+    return conv(value) if conv else value
+
+
+def load_devices(cfg):
+    """
+    Build the list of devices and their poll jobs from the configuration.
+    Tag maps are compiled once per tag section and group and shared between
+    devices.
+    """
+    max_gap = _get(cfg, "sensors", "max_read_gap", 0, int)
+    max_count = _get(cfg, "sensors", "max_read_count", MAX_READ_COUNT, int)
+    default_freq = _get(cfg, "sensors", "poll_frequency", 10, float)
+
+    group_freq = dict()
+    if cfg.has_section("poll_groups"):
+        for group, value in cfg.items("poll_groups"):
+            group_freq[group] = float(value)
+
+    report = load_report(cfg)
+    tagmaps = dict()
+
+    def tagmaps_for(section):
+        # Returns a list of (group, TagMap)
+        if section not in tagmaps:
+            groups = dict()
+            for tag in load_tags(cfg, section):
+                if tag.group is not None and tag.group not in group_freq:
+                    raise ValueError("%s: poll group %s is not defined in [poll_groups]" % (tag.name, tag.group))
+                groups.setdefault(tag.group, []).append(tag)
+            tagmaps[section] = [(group, TagMap(tags, max_gap=max_gap, max_count=max_count))
+                                for group, tags in sorted(groups.items())]
+        return tagmaps[section]
+
+    def add_jobs(device, section, freq):
+        jobs = []
+        tags = []
+        for group, tagmap in tagmaps_for(section):
+            period = freq if group is None else group_freq[group]
+            jobs.append(PollJob(device, group, tagmap, period))
+            tags.extend(tagmap.tags)
+        device.add_jobs(jobs)
+        if report is not None:
+            device.report = ReportFilter(tags, **report)
+        return device
+
+    devices = []
+    for section in cfg.sections():
+        if not section.startswith(DEVICE_SECTION_PREFIX):
+            continue
+        name = section[len(DEVICE_SECTION_PREFIX):]
+        path = _get(cfg, section, "serial", None)
+        framer = _get(cfg, section, "framer", "rtu" if path else "tcp").lower()
+        line = None
+        if framer == "rtu":
+            line = SerialLine(_get(cfg, section, "baudrate", 9600, int),
+                              _get(cfg, section, "parity", "N"),
+                              _get(cfg, section, "stopbits", 1, int))
+        device = Device(name,
+                        None if path else cfg.get(section, "server"),
+                        _get(cfg, section, "port", 502, int),
+                        unit=_get(cfg, section, "unit", None, int),
+                        framer=framer, path=path, line=line)
+        devices.append(add_jobs(device,
+                                _get(cfg, section, "tags", "tags"),
+                                _get(cfg, section, "poll_frequency", default_freq, float)))
+
+    if not devices:
+        device = Device("sensors", cfg.get("sensors", "server"), int(cfg.get("sensors", "port")))
+        devices.append(add_jobs(device, "tags", default_freq))
+    return devices
+
+
+class CollectorEngine(threading.Thread):
+    """
+    Poll a set of devices concurrently and pass every sample to on_sample.
+
+    on_sample(device, state, changes) is called from the worker threads and
+    must not block, or it delays the following polls. state is the new
+    DeviceState of the device, changes holds the values to report; it is
+    state.values itself without report by exception, and empty after a
+    failed poll.
+
+    TCP gateways get max_inflight connections, RTU buses a single one with
+    rtu_timeout as the response timeout.
+    """
+    def __init__(self, devices, on_sample, workers=4, max_inflight=1, timeout=3, pipeline=1,
+                 reconnect_min=0.05, reconnect_max=10.0, rtu_timeout=1):
+        super(CollectorEngine, self).__init__()
+        self.name = "CollectorEngine"
+        self.setDaemon(True)
+        self.stop_event = threading.Event()
+        self.devices = list(devices)
+        self.on_sample = on_sample
+        self.cond = threading.Condition()
+        self.queue = Queue.Queue()
+        self.heap = []
+        self.seq = 0
+
+        self.gateways = dict()
+        for device in self.devices:
+            key = device.endpoint
+            gateway = self.gateways.get(key)
+            if gateway is None:
+                if device.framer == "rtu":
+                    connections = [RtuConnection(device.line, rtu_timeout, device.path, device.server, device.port)]
+                else:
+                    connections = [ModbusConnection(device.server, device.port, timeout, pipeline)
+                                   for _ in range(max_inflight)]
+                gateway = self.gateways[key] = Gateway(key, connections, device.framer, device.line,
+                                                       reconnect_min, reconnect_max)
+            elif (device.framer, device.line) != (gateway.framer, gateway.line):
+                raise ValueError("%s: framer or serial settings differ from those of the other devices on %s"
+                                 % (device.name, key))
+            if device.framer == "rtu":
+                # A retry costs the bus a timeout, back off at least as long
+                device.backoff = Backoff(max(reconnect_min, rtu_timeout), max(reconnect_max, rtu_timeout))
+            device.gateway = gateway
+
+        self.workers = []
+        njobs = sum(len(device.jobs) for device in self.devices)
+        nconnections = sum(len(gateway.connections) for gateway in self.gateways.values())
+        for i in range(max(1, min(workers, njobs, nconnections))):
+            t = threading.Thread(target=self._work, name="CollectorWorker-%d" % i)
+            t.setDaemon(True)
+            self.workers.append(t)
+
+        REGISTRY.gauge("collector_queue_depth", "Due polls waiting for a worker", self.queue.qsize)
+        REGISTRY.gauge("collector_pending_polls", "Due polls waiting for a gateway connection",
+                       lambda: sum(len(g.pending) for g in self.gateways.values()))
+
+    def stop(self):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify()
+        for _ in self.workers:
+            self.queue.put(None)
+        for gateway in self.gateways.values():
+            gateway.close()
+
+    def _schedule(self, job, deadline=None):
+        # Called with self.cond held
+        self.seq += 1
+        if deadline is None:
+            deadline = job.schedule.deadline
+        heapq.heappush(self.heap, (deadline, self.seq, job))
+
+    def _submit(self, job):
+        # Called with self.cond held
+        gateway = job.device.gateway
+        if gateway.idle:
+            self.queue.put((job, gateway.idle.pop()))
+        else:
+            gateway.pending.append(job)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            job, connection = item
+            retry_at = None
+            try:
+                retry_at = self._poll(job, connection)
+            finally:
+                schedule = job.schedule
+                if retry_at is not None and retry_at < schedule.deadline + schedule.period:
+                    # Retry the failed poll once the gateway may be reachable
+                    # again, without giving up its current deadline
+                    deadline = retry_at
+                else:
+                    missed = schedule.advance(monotonic())
+                    if missed:
+                        MISSED.inc(missed)
+                        logger.warning("%s: missed %d poll deadline(s), %d in total", job, missed, schedule.missed)
+                    deadline = schedule.deadline
+                with self.cond:
+                    self._schedule(job, deadline)
+                    gateway = job.device.gateway
+                    if gateway.pending:
+                        self.queue.put((gateway.pending.popleft(), connection))
+                    else:
+                        gateway.idle.append(connection)
+                    self.cond.notify()
+
+    def _poll(self, job, connection):
+        """
+        Poll a job and publish the sample. Returns the time to retry a poll
+        that failed for lack of a connection, otherwise None.
+        """
+        device = job.device
+        gateway = device.gateway
+        retry_at = None
+        POLLS.inc()
+        backoff = device.backoff
+        try:
+            try:
+                if backoff is not None and monotonic() < backoff.retry_at:
+                    # Leave the bus to the slaves that answer
+                    state = device.update(job, None, time.time(), STALE)
+                    retry_at = backoff.retry_at
+                elif gateway.connect(connection):
+                    state = job.poll(connection)
+                    gateway.succeeded()
+                    if backoff is not None and backoff.failures:
+                        backoff.succeeded()
+                else:
+                    logger.debug("%s: %s is unreachable, waiting to reconnect", device.name, gateway)
+                    state = device.update(job, None, time.time(), STALE)
+                    retry_at = gateway.backoff.retry_at
+            except ConnectionException as ex:
+                gateway.metrics.connection_errors.inc()
+                retry_at = gateway.failed()
+                logger.error("%s: Failed to retrieve data from modbus server: %s, reconnecting in %.2fs",
+                             device.name, ex, retry_at - monotonic())
+                state = device.update(job, None, time.time(), COMM_FAIL)
+            except ModbusIOException as ex:
+                gateway.metrics.timeouts.inc()
+                if backoff is not None:
+                    retry_at = backoff.failed(monotonic())
+                    logger.error("%s: %s, skipping it for %.2fs", device.name, ex, retry_at - monotonic())
+                else:
+                    logger.error("%s: Failed to retrieve data from modbus server! %s", device.name, ex)
+                state = device.update(job, None, time.time(), COMM_FAIL)
+            except ModbusException as ex:
+                gateway.metrics.exceptions.inc()
+                logger.error("%s: Failed to retrieve data from modbus server! %s", device.name, ex)
+                state = device.update(job, None, time.time(), COMM_FAIL)
+            self.on_sample(device, state, device.changes(state))
+        except Exception:
+            logger.exception("%s: Exception.. but let us be resilient..", device.name)
+        return retry_at
+
+    def run(self):
+        logger.info("Collector polling %d devices via %d gateways with %d workers",
+                    len(self.devices), len(self.gateways), len(self.workers))
+        for device in self.devices:
+            for job in device.jobs:
+                logger.info("%s: %d tags with %d reads", job, len(job.tagmap.tags), len(job.tagmap.plan))
+        for gateway in self.gateways.values():
+            if gateway.line is None:
+                continue
+            devices = [device for device in self.devices if device.gateway is gateway]
+            load = gateway.load(devices)
+            if load > 1:
+                logger.warning("RTU bus %s (%r) is overloaded: %d devices need %.0f%% of its time, "
+                               "polls will run late", gateway.name, gateway.line, len(devices), load * 100)
+            else:
+                logger.info("RTU bus %s (%r): %d devices, %.0f%% busy", gateway.name, gateway.line,
+                            len(devices), load * 100)
+        for t in self.workers:
+            t.start()
+
+        with self.cond:
+            now = monotonic()
+            for device in self.devices:
+                for job in device.jobs:
+                    job.schedule.start(now)
+                    self._schedule(job)
+
+            while not self.stop_event.is_set():
+                now = monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    job = heapq.heappop(self.heap)[2]
+                    self._submit(job)
+                timeout = self.heap[0][0] - now if self.heap else None
+                self.cond.wait(timeout)
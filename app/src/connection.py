@@ -0,0 +1,437 @@
+"""
+Modbus TCP and RTU connections of the collector.
+
+A ModbusConnection is a plain socket that speaks just enough Modbus TCP to
+read holding registers. It returns the raw register bytes, so the tag map
+decodes them without building register lists first, and it can pipeline:
+with pipeline > 1 up to that many requests of a read plan are sent before
+the first response is read, and responses are matched to their requests by
+the MBAP transaction id. Only enable pipelining for devices and gateways
+that queue requests; many serial gateways answer one request at a time.
+
+Socket errors, timeouts and malformed responses close the connection and
+raise ConnectionException, so a broken connection is never reused. The
+collector reopens it on the next poll, with a jittered exponential Backoff
+between failed attempts.
+
+An RtuConnection speaks Modbus RTU, on a serial port (RS-485/RS-232) or over
+TCP to a transparent serial gateway. A serial bus is half duplex and shared
+by all the slaves on it: requests are sent one at a time, each after the
+silent interval (3.5 character times) that delimits RTU frames. A slave
+that does not answer within the timeout, or a garbled answer, raises
+ModbusIOException without closing the connection, since the bus itself is
+fine; the collector then skips that slave for a while so that the others
+keep the bus.
+"""
+import logging
+import random
+import socket
+import struct
+import time
+
+import serial
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
+from scheduler import monotonic
+
+logger = logging.getLogger("modbusapp")
+
+READ_HOLDING_REGISTERS = 0x03
+# MBAP header (transaction id, protocol id, length, unit) + function, address, count
+REQUEST = struct.Struct(">HHHBBHH")
+MBAP = struct.Struct(">HHHB")
+# RTU request without its CRC: unit, function, address, count
+RTU_REQUEST = struct.Struct(">BBHH")
+# The CRC of an RTU frame is sent low byte first
+CRC = struct.Struct("<H")
+PARITIES = ("N", "E", "O")
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data):
+    """
+    CRC-16/MODBUS of a byte string.
+    """
+    crc = 0xffff
+    table = CRC_TABLE
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+
+class Backoff(object):
+    """
+    Jittered exponential delay between reconnect attempts.
+    """
+    def __init__(self, initial=0.05, maximum=10.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+        self.retry_at = 0
+
+    def failed(self, now):
+        """
+        Record a failure at now. Returns the time of the next attempt.
+        """
+        delay = min(self.maximum, self.initial * (1 << min(self.failures, 30)))
+        # Half of the delay is random, so that the clients of a rebooted
+        # gateway do not all come back at the same moment
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        self.failures += 1
+        self.retry_at = now + delay
+        return self.retry_at
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0
+
+
+class SerialLine(object):
+    """
+    The settings of a serial bus, with 8 data bits. Lines with the same
+    settings are equal.
+    """
+    __slots__ = ("baudrate", "parity", "stopbits")
+
+    def __init__(self, baudrate=9600, parity="N", stopbits=1):
+        parity = parity.upper()[:1]
+        if parity not in PARITIES:
+            raise ValueError("parity must be N, E or O, not %s" % parity)
+        if stopbits not in (1, 2):
+            raise ValueError("stopbits must be 1 or 2, not %s" % stopbits)
+        if baudrate <= 0:
+            raise ValueError("baudrate must be positive")
+        self.baudrate = baudrate
+        self.parity = parity
+        self.stopbits = stopbits
+
+    def __repr__(self):
+        return "%d %s%d" % (self.baudrate, self.parity, self.stopbits)
+
+    def __eq__(self, other):
+        return isinstance(other, SerialLine) and \
+            (self.baudrate, self.parity, self.stopbits) == (other.baudrate, other.parity, other.stopbits)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.baudrate, self.parity, self.stopbits))
+
+    @property
+    def char_time(self):
+        """
+        Seconds on the wire per byte: start, 8 data, parity and stop bits.
+        """
+        return (9 + (self.parity != "N") + self.stopbits) / float(self.baudrate)
+
+    @property
+    def frame_gap(self):
+        """
+        The silence between two frames: 3.5 character times, and a fixed
+        1.75ms above 19200 baud, as the Modbus serial line spec recommends.
+        """
+        if self.baudrate > 19200:
+            return 0.00175
+        return 3.5 * self.char_time
+
+    def read_time(self, count):
+        """
+        Seconds a read of count registers occupies the bus: the request,
+        the response and the gap after each of them.
+        """
+        return (8 + 5 + 2 * count) * self.char_time + 2 * self.frame_gap
+
+
+class ModbusConnection(object):
+    """
+    A Modbus TCP connection. Not thread safe; the collector hands each
+    connection to one worker at a time.
+    """
+    def __init__(self, server, port, timeout=3, pipeline=1):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.pipeline = max(1, pipeline)
+        self.sock = None
+        self.tid = 0
+
+    def __repr__(self):
+        return "ModbusConnection(%s:%s)" % (self.server, self.port)
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self):
+        self.close()
+        try:
+            sock = socket.create_connection((self.server, self.port), self.timeout)
+        except (socket.error, socket.timeout) as ex:
+            raise ConnectionException("%s:%s: %s" % (self.server, self.port, ex))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def _recv(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        pos = 0
+        while pos < size:
+            n = self.sock.recv_into(view[pos:])
+            if not n:
+                raise socket.error("connection closed by %s:%s" % (self.server, self.port))
+            pos += n
+        return bytes(data)
+
+    def read_blocks(self, blocks, unit=None):
+        """
+        Read the holding registers of every (address, count) in blocks.
+        Returns the register bytes of each block, in block order.
+
+        Raises ModbusException if the device answered a request with an
+        exception response, ConnectionException on any transport error.
+        """
+        if self.sock is None:
+            raise ConnectionException("%s:%s: not connected" % (self.server, self.port))
+        unit = unit or 0
+        results = [None] * len(blocks)
+        outstanding = dict()
+        errors = []
+        sent = 0
+        try:
+            while sent < len(blocks) or outstanding:
+                frames = []
+                while sent < len(blocks) and len(outstanding) < self.pipeline:
+                    address, count = blocks[sent]
+                    self.tid = (self.tid + 1) & 0xffff
+                    frames.append(REQUEST.pack(self.tid, 0, 6, unit, READ_HOLDING_REGISTERS, address, count))
+                    outstanding[self.tid] = sent
+                    sent += 1
+                if frames:
+                    self.sock.sendall("".join(frames))
+
+                tid, protocol, length, _ = MBAP.unpack(self._recv(MBAP.size))
+                if protocol != 0 or length < 2:
+                    raise ConnectionException("%s:%s: malformed response header" % (self.server, self.port))
+                pdu = self._recv(length - 1)
+                index = outstanding.pop(tid, None)
+                if index is None:
+                    # The late answer to a request of an earlier, timed out poll
+                    logger.debug("%s: discarding response with unknown transaction id %d", self, tid)
+                    continue
+
+                function = ord(pdu[0])
+                if function == READ_HOLDING_REGISTERS | 0x80:
+                    errors.append("%s: exception code %d" % (blocks[index], ord(pdu[1])))
+                    continue
+                count = blocks[index][1]
+                if function != READ_HOLDING_REGISTERS or len(pdu) != 2 + 2 * count or ord(pdu[1]) != 2 * count:
+                    raise ConnectionException("%s:%s: unexpected response to %s" % (self.server, self.port, blocks[index]))
+                results[index] = pdu[2:]
+        except (socket.error, socket.timeout) as ex:
+            self.close()
+            raise ConnectionException("%s:%s: %s" % (self.server, self.port, ex))
+        except ConnectionException:
+            self.close()
+            raise
+
+        if errors:
+            raise ModbusException("Read of %s failed" % ", ".join(errors))
+        return results
+
+
+class RtuConnection(object):
+    """
+    A Modbus RTU connection, on the serial port at path or over TCP to a
+    serial gateway at server:port. Requests are sent one at a time. Not
+    thread safe; a bus has a single connection.
+    """
+    def __init__(self, line, timeout=1, path=None, server=None, port=None):
+        self.line = line
+        self.timeout = timeout
+        self.path = path
+        self.server = server
+        self.port = port
+        self.serial = None
+        self.sock = None
+        # The bus is silent long enough for the next frame from then on
+        self.ready_at = 0
+        # A late answer to a timed out request may still arrive
+        self.dirty = False
+
+    def __repr__(self):
+        if self.path is not None:
+            return "RtuConnection(%s, %r)" % (self.path, self.line)
+        return "RtuConnection(%s:%s)" % (self.server, self.port)
+
+    @property
+    def connected(self):
+        return self.serial is not None or self.sock is not None
+
+    def connect(self):
+        self.close()
+        try:
+            if self.path is not None:
+                self.serial = serial.Serial(self.path, self.line.baudrate, bytesize=8, parity=self.line.parity,
+                                            stopbits=self.line.stopbits, timeout=self.timeout)
+            else:
+                self.sock = socket.create_connection((self.server, self.port), self.timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (serial.SerialException, socket.error, OSError, ValueError) as ex:
+            self.close()
+            raise ConnectionException("%s: %s" % (self, ex))
+        self.ready_at = 0
+        self.dirty = True
+
+    def close(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.serial = None
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def _flush(self):
+        # Drop whatever is left of earlier frames
+        if self.serial is not None:
+            self.serial.reset_input_buffer()
+        else:
+            self.sock.setblocking(0)
+            try:
+                while self.sock.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            finally:
+                self.sock.settimeout(self.timeout)
+        self.dirty = False
+
+    def _write(self, frame):
+        if self.serial is not None:
+            self.serial.write(frame)
+            # Wait until the frame is on the wire, the response timeout
+            # starts after it
+            self.serial.flush()
+        else:
+            self.sock.sendall(frame)
+
+    def _read(self, size):
+        # Returns less than size bytes if the timeout passes first
+        if self.serial is not None:
+            return self.serial.read(size)
+        data = bytearray(size)
+        view = memoryview(data)
+        pos = 0
+        try:
+            while pos < size:
+                n = self.sock.recv_into(view[pos:])
+                if not n:
+                    raise socket.error("connection closed by %s:%s" % (self.server, self.port))
+                pos += n
+        except socket.timeout:
+            pass
+        return bytes(data[:pos])
+
+    def _garbled(self, unit, message):
+        self.dirty = True
+        return ModbusIOException("%s: unit %d: %s" % (self, unit, message))
+
+    def _response(self, unit):
+        """
+        Read a read holding registers or exception response frame.
+        """
+        header = self._read(3)
+        if len(header) < 3:
+            self.ready_at = monotonic() + self.line.frame_gap
+            self.dirty = True
+            if not header:
+                raise ModbusIOException("%s: no response from unit %d" % (self, unit))
+            raise self._garbled(unit, "incomplete response")
+        function = ord(header[1])
+        if function == READ_HOLDING_REGISTERS | 0x80:
+            size = 0
+        elif function == READ_HOLDING_REGISTERS:
+            size = ord(header[2])
+        else:
+            self.ready_at = monotonic() + self.line.frame_gap
+            raise self._garbled(unit, "unexpected function %d" % function)
+        frame = header + self._read(size + 2)
+        self.ready_at = monotonic() + self.line.frame_gap
+        if len(frame) < size + 5:
+            raise self._garbled(unit, "incomplete response")
+        if crc16(frame[:-2]) != CRC.unpack(frame[-2:])[0]:
+            raise self._garbled(unit, "CRC error")
+        return frame
+
+    def read_blocks(self, blocks, unit=None):
+        """
+        Read the holding registers of every (address, count) in blocks.
+        Returns the register bytes of each block, in block order.
+
+        Raises ModbusException if the slave answered a request with an
+        exception response, ModbusIOException if it did not answer or the
+        answer was garbled, ConnectionException on any transport error.
+        """
+        if not self.connected:
+            raise ConnectionException("%s: not connected" % self)
+        # Unit 0 is the broadcast address, no slave answers it
+        unit = unit or 1
+        results = [None] * len(blocks)
+        errors = []
+        try:
+            if self.dirty:
+                self._flush()
+            for index, (address, count) in enumerate(blocks):
+                request = RTU_REQUEST.pack(unit, READ_HOLDING_REGISTERS, address, count)
+                delay = self.ready_at - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self._write(request + CRC.pack(crc16(request)))
+
+                frame = self._response(unit)
+                slave = ord(frame[0])
+                if slave != unit:
+                    # The late answer of a slave that timed out before,
+                    # ours may still follow
+                    logger.debug("%s: discarding late response of unit %d", self, slave)
+                    frame = self._response(unit)
+                    slave = ord(frame[0])
+                    if slave != unit:
+                        raise self._garbled(unit, "response from unit %d" % slave)
+                if ord(frame[1]) != READ_HOLDING_REGISTERS:
+                    errors.append("%s: exception code %d" % (blocks[index], ord(frame[2])))
+                    continue
+                if ord(frame[2]) != 2 * count:
+                    raise self._garbled(unit, "unexpected response to %s" % (blocks[index],))
+                results[index] = frame[3:-2]
+        except (serial.SerialException, socket.error, OSError) as ex:
+            self.close()
+            raise ConnectionException("%s: %s" % (self, ex))
+
+        if errors:
+            raise ModbusException("Read of %s failed" % ", ".join(errors))
+        return results
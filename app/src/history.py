@@ -0,0 +1,118 @@
+"""
+In-memory time series history of the numeric tags.
+
+Each tag keeps its latest samples in a fixed capacity ring buffer backed by
+two preallocated array('d') (timestamps and values), so memory use is known
+up front: 16 bytes per sample slot and tag. Queries return the raw samples
+of a time range or min/max/avg buckets of step seconds.
+"""
+import bisect
+import threading
+from array import array
+
+from wireformat import flatten
+
+
+class RingBuffer(object):
+    """
+    Fixed capacity buffer of (timestamp, value) samples.
+    """
+    __slots__ = ("capacity", "times", "values", "head", "count")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.values = array("d", [0.0]) * capacity
+        # Index of the next slot to write
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _segments(self):
+        # The stored samples in time order, as at most two (start, end) slices
+        if self.count < self.capacity:
+            return ((0, self.count),)
+        return ((self.head, self.capacity), (0, self.head))
+
+    def range(self, start, end):
+        """
+        Return copies of the timestamps and values of the samples with
+        start <= timestamp <= end, as two arrays.
+        """
+        times = array("d")
+        values = array("d")
+        for lo, hi in self._segments():
+            first = bisect.bisect_left(self.times, start, lo, hi)
+            last = bisect.bisect_right(self.times, end, first, hi)
+            times.extend(self.times[first:last])
+            values.extend(self.values[first:last])
+        return times, values
+
+
+class History(object):
+    """
+    Ring buffers of all numeric tags, keyed by tag name ("device/tag" with
+    more than one device).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffers = dict()
+        self.lock = threading.Lock()
+
+    def tags(self):
+        with self.lock:
+            return sorted(self.buffers)
+
+    def record(self, timestamp, sample):
+        with self.lock:
+            for name, value in flatten(sample).iteritems():
+                if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                    continue
+                buf = self.buffers.get(name)
+                if buf is None:
+                    buf = self.buffers[name] = RingBuffer(self.capacity)
+                buf.append(timestamp, value)
+
+    def query(self, tag, start=None, end=None, step=None):
+        """
+        Return [[timestamp, value], ...] for the samples of a tag, or
+        [[bucket start, min, max, avg, count], ...] when step is given.
+        Buckets are aligned to multiples of step. Returns None for an
+        unknown tag.
+        """
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        # Only copy the samples while holding the lock, so that the
+        # collector is not held up by the aggregation
+        with self.lock:
+            buf = self.buffers.get(tag)
+            if buf is None:
+                return None
+            times, values = buf.range(start, end)
+
+        if not step:
+            return [[t, v] for t, v in zip(times, values)]
+
+        points = []
+        bucket = None
+        for t, v in zip(times, values):
+            b = t - t % step
+            if b != bucket:
+                if bucket is not None:
+                    points.append([bucket, lo, hi, total / n, n])
+                bucket, lo, hi, total, n = b, v, v, 0.0, 0
+            if v < lo:
+                lo = v
+            elif v > hi:
+                hi = v
+            total += v
+            n += 1
+        if bucket is not None:
+            points.append([bucket, lo, hi, total / n, n])
+        return points
@@ -0,0 +1,370 @@
+"""
+Concurrent HTTPS servers for the WSGI app.
+
+wsgiref's simple server answers one request per connection, one connection
+at a time, and does the TLS handshake on the accepting thread. The servers
+here keep HTTP/1.1 connections alive, do the handshake on the thread that
+serves the connection and share one SSLContext, so returning clients can
+resume their TLS session instead of doing a full handshake.
+
+    threaded    one thread per connection
+    pool        a fixed pool of worker threads that only run requests in
+                progress. A poller thread does the TLS handshakes and
+                watches idle keep-alive connections; event streams and long
+                polls move to a thread of their own. Connections beyond
+                max_connections are closed right away.
+"""
+import collections
+import errno
+import logging
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import Queue
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+logger = logging.getLogger("modbusapp")
+
+
+class _BodyReader(object):
+    """
+    wsgi.input limited to the request body, so that the unread rest of a
+    body can be skipped before the next request on the connection.
+    """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else ""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else ""
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def drain(self):
+        while self.remaining and self.read(min(self.remaining, 65536)):
+            pass
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """
+    HTTP/1.1 response handler. Responses without a Content-Length (event
+    streams) close the connection when done.
+    """
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if "Content-Length" not in self.headers or self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+            self.request_handler.close_connection = 1
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    Serve requests on a connection until the client or the response asks to
+    close it, or the connection is idle for the server's timeout.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, request, client_address, server, attach=False):
+        if not attach:
+            WSGIRequestHandler.__init__(self, request, client_address, server)
+            return
+        # Attached to a pooled connection: the server calls
+        # handle_one_request for each request, then finish
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def buffered(self):
+        """
+        True if the next request has been read from the socket already.
+        """
+        # socket._fileobject keeps read ahead data in _rbuf
+        if self.rfile._rbuf.getvalue():
+            return True
+        pending = getattr(self.connection, "pending", None)
+        return bool(pending and pending())
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, socket.error):
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+
+        environ = self.get_environ()
+        detach = getattr(self.server, "detach", None)
+        if detach is not None:
+            environ["httpserver.detach"] = detach
+        body = _BodyReader(self.rfile, int(environ.get("CONTENT_LENGTH") or 0))
+        environ["wsgi.input"] = body
+        handler = KeepAliveServerHandler(body, self.wfile, self.get_stderr(), environ)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not self.close_connection:
+            body.drain()
+
+
+class _TLSMixIn:
+    """
+    Wrap accepted connections in TLS on the thread that serves them.
+    """
+    # An old style class like the SocketServer classes: deriving from object
+    # would put object.__init__ ahead of WSGIServer.__init__
+    ssl_context = None
+    connection_timeout = 15
+
+    def finish_request(self, request, client_address):
+        request.settimeout(self.connection_timeout)
+        if self.ssl_context is not None:
+            try:
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+            except (socket.error, IOError) as ex:
+                logger.debug("TLS handshake with %s failed: %s", client_address[0], ex)
+                return
+        self.RequestHandlerClass(request, client_address, self)
+
+
+class ThreadedWSGIServer(_TLSMixIn, ThreadingMixIn, WSGIServer):
+    """
+    One thread per connection.
+    """
+    daemon_threads = True
+
+    def detach(self):
+        # Every connection has a thread of its own already
+        pass
+
+
+class _Connection(object):
+    """
+    A pooled connection and its handler, once the TLS handshake is done.
+    """
+    def __init__(self, request, client_address):
+        self.request = request
+        self.client_address = client_address
+        self.handler = None
+        self.handshake = False
+        self.writable = False
+        self.deadline = 0
+
+    def fileno(self):
+        return self.request.fileno()
+
+
+class PooledWSGIServer(_TLSMixIn, WSGIServer):
+    """
+    Requests are served by a fixed pool of worker threads. Between requests
+    connections are left to the poller thread, so that idle clients do not
+    hold a worker. A request that will block for long (an event stream or
+    a long poll) calls environ["httpserver.detach"]; its worker then leaves
+    the pool for good and a new worker takes its place.
+    """
+    def __init__(self, address, handler, workers=16, max_connections=64):
+        WSGIServer.__init__(self, address, handler)
+        self.max_connections = max_connections
+        self.active = 0
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        # Connections handed to the poller, and its wakeup pipe
+        self.incoming = collections.deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.local = threading.local()
+        self.spawned = 0
+        t = threading.Thread(target=self._poll, name="HTTPPoller")
+        t.setDaemon(True)
+        t.start()
+        for i in range(workers):
+            self._spawn()
+
+    def _spawn(self):
+        with self.lock:
+            self.spawned += 1
+            name = "HTTPWorker-%d" % self.spawned
+        t = threading.Thread(target=self._work, name=name)
+        t.setDaemon(True)
+        t.start()
+
+    def process_request(self, request, client_address):
+        # Runs on the accepting thread
+        with self.lock:
+            if self.active >= self.max_connections:
+                full = True
+            else:
+                full = False
+                self.active += 1
+        if full:
+            logger.warning("Connection limit of %d reached, closing connection from %s",
+                           self.max_connections, client_address[0])
+            self.shutdown_request(request)
+            return
+        request.setblocking(0)
+        connection = _Connection(request, client_address)
+        if self.ssl_context is not None:
+            try:
+                connection.request = self.ssl_context.wrap_socket(request, server_side=True,
+                                                                  do_handshake_on_connect=False)
+            except (socket.error, IOError) as ex:
+                logger.debug("TLS setup with %s failed: %s", client_address[0], ex)
+                self._close(connection)
+                return
+            connection.handshake = True
+        self._idle(connection)
+
+    def detach(self):
+        """
+        Take the calling worker out of the pool and start a new one.
+        """
+        if not getattr(self.local, "detached", True):
+            self.local.detached = True
+            self._spawn()
+
+    def _idle(self, connection):
+        # Hand a connection to the poller until its next request
+        connection.deadline = time.time() + self.connection_timeout
+        self.incoming.append(connection)
+        os.write(self.wakeup_w, "x")
+
+    def _close(self, connection):
+        try:
+            if connection.handler is not None:
+                connection.handler.finish()
+        except (socket.error, IOError):
+            pass
+        finally:
+            self.shutdown_request(connection.request)
+            with self.lock:
+                self.active -= 1
+
+    def _handshake(self, connection):
+        # One step of a non blocking TLS handshake. Returns False if it failed.
+        try:
+            connection.request.do_handshake()
+        except ssl.SSLWantReadError:
+            connection.writable = False
+        except ssl.SSLWantWriteError:
+            connection.writable = True
+        except (socket.error, IOError) as ex:
+            logger.debug("TLS handshake with %s failed: %s", connection.client_address[0], ex)
+            return False
+        else:
+            connection.handshake = False
+            connection.writable = False
+        return True
+
+    def _poll(self):
+        # Connections are few (max_connections), so select will do
+        idle = set()
+        while True:
+            while self.incoming:
+                idle.add(self.incoming.popleft())
+            now = time.time()
+            for connection in [c for c in idle if c.deadline <= now]:
+                idle.discard(connection)
+                self._close(connection)
+            timeout = min([c.deadline for c in idle] or [now + 1]) - now
+            readers = [c for c in idle if not c.writable]
+            writers = [c for c in idle if c.writable]
+            try:
+                readable, writable, _ = select.select([self.wakeup_r] + readers, writers, [], max(timeout, 0))
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wakeup_r in readable:
+                os.read(self.wakeup_r, 4096)
+                readable.remove(self.wakeup_r)
+            for connection in readable + writable:
+                if connection.handshake:
+                    if not self._handshake(connection):
+                        idle.discard(connection)
+                        self._close(connection)
+                    elif connection.handshake or not connection.request.pending():
+                        # Handshake pending, or done and waiting for the request
+                        continue
+                idle.discard(connection)
+                self.queue.put(connection)
+
+    def _work(self):
+        self.local.detached = False
+        while not self.local.detached:
+            connection = self.queue.get()
+            try:
+                self._serve(connection)
+            except Exception:
+                self.handle_error(connection.request, connection.client_address)
+                self._close(connection)
+
+    def _serve(self, connection):
+        # Serve the requests the client has sent, then hand the connection
+        # back to the poller or close it
+        request = connection.request
+        request.setblocking(1)
+        request.settimeout(self.connection_timeout)
+        if connection.handler is None:
+            connection.handler = self.RequestHandlerClass(request, connection.client_address, self, attach=True)
+        handler = connection.handler
+        handler.close_connection = 1
+        handler.handle_one_request()
+        while not handler.close_connection and handler.buffered():
+            handler.handle_one_request()
+        if handler.close_connection:
+            self._close(connection)
+        else:
+            request.setblocking(0)
+            self._idle(connection)
+
+
+def make_tls_server(host, port, app, mode, ssl_context=None, workers=16, max_connections=64, timeout=15):
+    """
+    Create a threaded or pooled WSGI server for app.
+    """
+    if mode == "threaded":
+        server = ThreadedWSGIServer((host, port), KeepAliveRequestHandler)
+    elif mode == "pool":
+        server = PooledWSGIServer((host, port), KeepAliveRequestHandler, workers, max_connections)
+    else:
+        raise ValueError("Unknown server mode %s" % mode)
+    server.ssl_context = ssl_context
+    server.connection_timeout = timeout
+    server.set_app(app)
+    return server
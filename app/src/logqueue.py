@@ -0,0 +1,147 @@
+"""
+Logging that never blocks the threads that log.
+
+QueueHandler is the only handler on the app logger. It formats the message
+of a record and appends the record to a bounded in-memory queue; a LogWriter
+thread takes records from the queue and passes them to the real handlers
+(the rotating log file, the console), so formatting, file writes and
+rotation on slow flash never stall a poll or a request. When the queue is
+full, records are dropped and counted, and the writer logs how many were
+lost.
+
+RepeatFilter rate limits repeated warnings and errors, like a modbus server
+failing on every poll. The first record with a message template is logged,
+further ones within the interval are only counted, and the next record
+after the interval carries the number of records suppressed.
+"""
+import collections
+import logging
+import threading
+import time
+
+from metrics import REGISTRY
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler appending records to a LogWriter.
+    """
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            # Render the message now, its arguments may change once the
+            # caller goes on
+            record.msg = record.getMessage()
+            record.args = None
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def createLock(self):
+        # emit does not need the handler lock, the writer has its own
+        self.lock = None
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class LogWriter(threading.Thread):
+    """
+    Pass queued records to the handlers from a background thread.
+    """
+    def __init__(self, handlers, maxlen=10000):
+        super(LogWriter, self).__init__()
+        self.name = "LogWriter"
+        self.setDaemon(True)
+        self.stop_event = threading.Event()
+        self.handlers = list(handlers)
+        self.records = collections.deque()
+        self.maxlen = maxlen
+        self.wake = threading.Event()
+        self.dropped = 0
+        REGISTRY.counter("log_records_dropped_total", "Log records dropped because the log queue was full",
+                         lambda: self.dropped)
+
+    def put(self, record):
+        # deque.append is atomic, only waking the writer takes a lock
+        if len(self.records) >= self.maxlen:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if not self.wake.is_set():
+            self.wake.set()
+
+    def stop(self):
+        """
+        Write the queued records and stop.
+        """
+        self.stop_event.set()
+        self.wake.set()
+        self.join(5)
+        for handler in self.handlers:
+            handler.close()
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def run(self):
+        reported = 0
+        records = self.records
+        while True:
+            self.wake.wait()
+            # Cleared before draining, a record appended meanwhile sets it again
+            self.wake.clear()
+            while records:
+                self._handle(records.popleft())
+            dropped = self.dropped
+            if dropped != reported:
+                self._handle(logging.LogRecord("modbusapp", logging.WARNING, __file__, 0,
+                                               "Log queue full, dropped %d log records", (dropped - reported,),
+                                               None))
+                reported = dropped
+            if self.stop_event.is_set():
+                break
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Suppress records of level WARNING and above that repeat within interval
+    seconds. Records are told apart by their message template and first
+    argument, the device name in the messages of the collector.
+    """
+    def __init__(self, interval=60, level=logging.WARNING):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.level = level
+        self.lock = threading.Lock()
+        # key -> [time logged, records suppressed since]
+        self.seen = dict()
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        args = record.args
+        key = (record.msg, args[0] if isinstance(args, tuple) and args else None)
+        now = time.time()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry is not None else 0
+            if len(self.seen) > 1000:
+                # Forget templates that have stopped repeating
+                self.seen = dict((k, e) for k, e in self.seen.iteritems() if now - e[0] < self.interval)
+            self.seen[key] = [now, 0]
+        if suppressed:
+            record.msg = "%s (%d similar messages suppressed)" % (record.getMessage(), suppressed)
+            record.args = None
+        return True
@@ -1,23 +1,24 @@
 #!/Users/sureshsankaran/.venv/modbus_app/bin/python
+import sys
 import time
-import json
 import signal
 import threading
-import subprocess
 import os
-import re
-import httplib, urllib
 import ssl
 import logging
-import random
-from pymodbus.exceptions import ModbusException
-from pymodbus.constants import Endian
-from pymodbus.client.sync import ModbusTcpClient as ModbusClient
-from pymodbus.payload import BinaryPayloadDecoder
 from ConfigParser import SafeConfigParser
 from logging.handlers import RotatingFileHandler
 from wsgiref.simple_server import make_server
-from bottle import Bottle, request
+from bottle import Bottle, request, response, abort
+from aggregate import load_aggregate
+from collector import CollectorEngine, load_devices
+from history import History
+from httpserver import make_tls_server
+from logqueue import LogWriter, QueueHandler, RepeatFilter
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from publisher import load_sinks
+from shard import SHARD_ENV, PipeHandler, RecordWriter, Supervisor, run_worker
+from snapshot import SnapshotStore
 
 logger = logging.getLogger("modbusapp")
 
@@ -33,7 +34,16 @@ signal.signal(signal.SIGTERM, _stop_handler)
 signal.signal(signal.SIGINT, _sleep_handler)
 
 DISPLAY_MSG = "Hello! Welcome!"
-OUTPUT = dict()
+SNAPSHOTS = SnapshotStore()
+# Long poll and stream keepalive timeouts in seconds
+LONG_POLL_TIMEOUT = 30
+LONG_POLL_TIMEOUT_MAX = 60
+STREAM_KEEPALIVE = 15
+SINKS = []
+# Send the time, read latency and bad tag qualities with the samples
+SAMPLE_METADATA = True
+HISTORY = None
+AGGREGATE = None
 
 # Get hold of the configuration file (package_config.ini)
 moduledir = os.path.abspath(os.path.dirname(__file__))
@@ -43,28 +53,48 @@ tcfg = os.path.join(BASEDIR, "../project",  "package_config.ini")
 CONFIG_FILE = os.getenv("CAF_APP_CONFIG_FILE", tcfg)
 
 cfg = SafeConfigParser()
+# Tag names are case sensitive
+cfg.optionxform = str
 cfg.read(CONFIG_FILE)
 
-def setup_logging(cfg):
+def setup_logging(cfg, handlers=None):
     """
     Setup logging for the current module and dependent libraries based on
-    values available in config.
+    values available in config. Returns the LogWriter thread of queued
+    logging, or None when logging is synchronous. Records are passed to
+    handlers, if given, instead of the console and the log file.
     """
     # set a format which is simpler for console use
     formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+    # The format does not use them, skip looking them up for every record
+    logging.logThreads = 0
+    logging.logProcesses = 0
+    logging.logMultiprocessing = 0
 
     # Set log level based on what is defined in package_config.ini file
     loglevel = cfg.getint("logging", "log_level")
     logger.setLevel(loglevel)
 
+    # Repeated warnings and errors are logged once per repeat_interval seconds
+    repeat_interval = 60
+    if cfg.has_option("logging", "repeat_interval"):
+        repeat_interval = cfg.getint("logging", "repeat_interval")
+    if repeat_interval > 0:
+        logger.addFilter(RepeatFilter(repeat_interval))
+
+    if handlers is not None:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+    handlers = []
+
     # Create a console handler only if console logging is enabled
     ce = cfg.getboolean("logging", "console")
     if ce:
         console = logging.StreamHandler()
         console.setLevel(loglevel)
         console.setFormatter(formatter)
-        # add the handler to the root logger
-        logger.addHandler(console)
+        handlers.append(console)
 
     # The default is to use a Rotating File Handler
     log_file_dir = os.getenv("CAF_APP_LOG_DIR", "/tmp")
@@ -74,7 +104,50 @@ def setup_logging(cfg):
     rfh = RotatingFileHandler(log_file_path, maxBytes=1024*1024, backupCount=3)
     rfh.setLevel(loglevel)
     rfh.setFormatter(formatter)
-    logger.addHandler(rfh)
+    handlers.append(rfh)
+
+    # By default records are written by a background thread, so file writes
+    # and rotation never block the collector. queue_size 0 logs synchronously.
+    queue_size = 10000
+    if cfg.has_option("logging", "queue_size"):
+        queue_size = cfg.getint("logging", "queue_size")
+    if queue_size <= 0:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+    writer = LogWriter(handlers, queue_size)
+    writer.start()
+    logger.addHandler(QueueHandler(writer))
+    return writer
+
+def collector_options(cfg):
+    """
+    Return the [collector] settings as CollectorEngine keyword arguments.
+    """
+    options = dict()
+    for option in ("workers", "max_inflight", "pipeline"):
+        if cfg.has_option("collector", option):
+            options[option] = cfg.getint("collector", option)
+    for option in ("timeout", "rtu_timeout"):
+        if cfg.has_option("collector", option):
+            options[option] = cfg.getfloat("collector", option)
+    if cfg.has_option("collector", "reconnect_min_ms"):
+        options["reconnect_min"] = cfg.getint("collector", "reconnect_min_ms") / 1000.0
+    if cfg.has_option("collector", "reconnect_max_ms"):
+        options["reconnect_max"] = cfg.getint("collector", "reconnect_max_ms") / 1000.0
+    return options
+
+def _detach():
+    """
+    Move a long running request off the worker of the pooled server. Returns
+    False on the single threaded server, where it would block every other
+    request.
+    """
+    detach = request.environ.get("httpserver.detach")
+    if detach is None:
+        return False
+    detach()
+    return True
 
 class WebApp(Bottle):
     """
@@ -84,7 +157,25 @@ class WebApp(Bottle):
         Bottle.__init__(self)
         self.route("/", callback=self.hello)
         self.route("/display", method='POST', callback=self.display)
-        self.route("/data", method='GET', callback=self.data)
+        self.route("/data", method='GET', callback=self.timed("/data", self.data))
+        self.route("/history", method='GET', callback=self.timed("/history", self.history))
+        self.route("/stream", method='GET', callback=self.stream)
+        self.route("/metrics", method='GET', callback=self.metrics)
+
+    def timed(self, path, callback):
+        """
+        Wrap a route callback to record its duration. Long polls are
+        included, so /data with ?since= shows up in the upper buckets.
+        """
+        requests = REGISTRY.histogram("http_request_seconds", "Duration of HTTP requests", path=path)
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                requests.observe(time.time() - start)
+        return wrapper
 
     def hello(self):
         global DISPLAY_MSG
@@ -97,146 +188,187 @@ class WebApp(Bottle):
         return {"msg": DISPLAY_MSG}
 
     def data(self):
-        global OUTPUT
-        return OUTPUT
-
-def dweet(content):
-    enabled = cfg.getboolean("dweet", "enabled")
-    if enabled is False:
-        logger.debug("Dweeting is disabled. Nothing to do...")
+        """
+        Serve the pre-encoded latest snapshot. Answers 304 Not Modified when
+        If-None-Match carries the ETag of the current snapshot.
+
+        With ?meta=1 every tag is served as {"value", "time", "quality"},
+        the time of its last read and the quality of the value.
+
+        With ?since=<seq> the request is a long poll: it blocks up to
+        timeout seconds (default 30) until a snapshot newer than seq is
+        published, and answers 304 if none was. The sequence number of the
+        returned snapshot is in the X-Sequence header. The single threaded
+        server does not wait and answers right away.
+        """
+        snapshot = SNAPSHOTS.current
+        since = request.query.get("since")
+        if since:
+            try:
+                since = int(since)
+                timeout = min(float(request.query.get("timeout") or LONG_POLL_TIMEOUT), LONG_POLL_TIMEOUT_MAX)
+            except ValueError:
+                abort(400, "since and timeout must be numbers")
+            if not _detach():
+                timeout = 0
+            snapshot = SNAPSHOTS.wait(since, timeout) or snapshot
+            if snapshot.seq == since:
+                response.set_header("X-Sequence", str(snapshot.seq))
+                response.status = 304
+                return ""
+
+        meta = request.query.get("meta") in ("1", "true", "yes")
+        etag = snapshot.etag
+        if meta:
+            etag = etag[:-1] + '-meta"'
+        response.set_header("X-Sequence", str(snapshot.seq))
+        response.set_header("ETag", etag)
+        response.set_header("Cache-Control", "no-cache")
+        if SNAPSHOTS.not_modified(request.get_header("If-None-Match"), etag):
+            response.status = 304
+            return ""
+        response.content_type = "application/json"
+        return snapshot.meta if meta else snapshot.body
+
+    def metrics(self):
+        """
+        Runtime metrics in the Prometheus text format.
+        """
+        response.content_type = METRICS_CONTENT_TYPE
+        return REGISTRY.render()
+
+    def stream(self):
+        """
+        Server-Sent Events stream of the snapshots. Each event carries the
+        /data body and the snapshot sequence number as event id. Not
+        available on the single threaded server.
+        """
+        if not _detach():
+            abort(501, "/stream needs [server] mode threaded or pool")
+        try:
+            last = int(request.get_header("Last-Event-ID") or -1)
+        except ValueError:
+            last = -1
+        response.content_type = "text/event-stream"
+        response.set_header("Cache-Control", "no-cache")
+
+        def events(seq):
+            snapshot = SNAPSHOTS.current
+            if snapshot.seq != seq:
+                seq = snapshot.seq
+                yield snapshot.event
+            while True:
+                snapshot = SNAPSHOTS.wait(seq, STREAM_KEEPALIVE)
+                if snapshot is None:
+                    # Comment line, keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                seq = snapshot.seq
+                yield snapshot.event
+        return events(last)
+
+    def history(self):
+        """
+        GET /history?tag=<name>&from=<epoch>&to=<epoch>&step=<seconds>
+        Without tag, lists the tags with history.
+        """
+        if HISTORY is None:
+            abort(404, "History is disabled")
+        tag = request.query.get("tag")
+        if not tag:
+            return {"tags": HISTORY.tags()}
+        try:
+            args = dict()
+            for name, key in (("from", "start"), ("to", "end"), ("step", "step")):
+                value = request.query.get(name)
+                if value:
+                    args[key] = float(value)
+        except ValueError:
+            abort(400, "from, to and step must be numbers")
+        if args.get("step", 1) <= 0:
+            abort(400, "step must be positive")
+
+        points = HISTORY.query(tag, **args)
+        if points is None:
+            abort(404, "No history for tag %s" % tag)
+        if "step" in args:
+            return {"tag": tag, "step": args["step"], "columns": ["time", "min", "max", "avg", "count"],
+                    "points": points}
+        return {"tag": tag, "columns": ["time", "value"], "points": points}
+
+def publish(device, state, changes):
+    """
+    Make a new DeviceState of a device available on /data and push the
+    changed values to the configured sinks. With a single device /data
+    holds its values directly, otherwise it is keyed by device name.
+
+    With SAMPLE_METADATA the samples of the sinks carry the time of the
+    poll in "_time", the read latency in "_latency_ms" and, while any tag
+    is not good, the quality of those tags in "_quality". After a failed
+    poll the sinks only get the qualities, and the poll after which all
+    tags are good again is always sent.
+    """
+    timestamp = state.timestamp
+    SNAPSHOTS.publish(device.name, state)
+
+    # Only the values read by this poll are new, failed polls add no points
+    fresh = state.fresh
+    if fresh is not None:
+        # State values are never modified, so everyone can share them
+        sample = {device.name: fresh} if SNAPSHOTS.keyed else fresh
+        if HISTORY is not None:
+            HISTORY.record(timestamp, sample)
+        if AGGREGATE is not None:
+            AGGREGATE.publish(sample, timestamp)
+
+    if not SINKS:
         return
-
-    dweet_server = cfg.get("dweet","server")
-    dweet_name = cfg.get("dweet", "name")
-    logger.debug("Connecting to https://%s", dweet_server)
-    conn = httplib.HTTPSConnection(dweet_server, timeout=10)
-    #params = urllib.urlencode(content)
-    url = "/dweet/for/%s" % (dweet_name)
-    logger.debug("Dweeting: %s", url)
-    #conn.request("GET", url)
-    conn.request("POST", url, body=json.dumps(content), headers={'Content-Type': 'application/json'})
-    response = conn.getresponse()
-    logger.debug("Response Status: %s, Response Reason: %s", response.status, response.reason)
-
-
-def send_to_cloud(content):
-    enabled = cfg.getboolean("cloud", "enabled")
-    if enabled is False:
-        logger.debug("Sending to data center app is disabled. Nothing to do...")
+    issues = state.issues() if SAMPLE_METADATA else None
+    if not changes and issues is None and not (SAMPLE_METADATA and state.recovered):
         return
-
-    server = cfg.get("cloud", "server")
-    port = cfg.getint("cloud", "port")
-    url = cfg.get("cloud", "url")
-    method = cfg.get("cloud", "method")
-    scheme = cfg.get("cloud", "scheme")
-    logger.debug("Connecting to https://%s:%s", server, port)
-
-    conn = httplib.HTTPConnection(server, port, timeout=10)
-    content = json.dumps(content)
-    headers = {"Content-Type": "application/json"}
-    logger.debug("Sending to cloud: URL %s, Headers %s, Body %s", url, headers, content)
-    conn.request("POST", url, content, headers)
-    time.sleep(2)
-    response = conn.getresponse()
-    logger.debug("Response Status: %s, Response Reason: %s", response.status, response.reason)
-
-class ModbusThread(threading.Thread):
-    def __init__(self):
-        super(ModbusThread, self).__init__()
-        self.name = "ModbusThread"
-        self.setDaemon(True)
-        self.stop_event = threading.Event()
-        self.client = None
-
-
-    def stop(self):
-        self.stop_event.set()
-        self.client.close()
-
-    def run(self):
-        global OUTPUT
-        ret = dict()
-
-        modbus_server = cfg.get("sensors", "server")
-        modbus_port = int(cfg.get("sensors", "port")) 
-        self.client = ModbusClient(modbus_server, port=modbus_port)
-
-        temp_reg = int(cfg.get("sensors", "temperature_reg"),16)
-        humid_reg = int(cfg.get("sensors", "humidity_reg"), 16)
-        pressure_reg = int(cfg.get("sensors", "pressure_reg"), 16)
-        geo_lat_reg = int(cfg.get("sensors", "geo_latitude_reg"), 16)
-        geo_long_reg = int(cfg.get("sensors", "geo_longitude_reg"), 16) 
-        key_op_reg = int(cfg.get("sensors", "key_operation_reg"), 16)
- 
-        poll_freq = int(cfg.get("sensors", "poll_frequency"))
-
-        while True:
-            if self.stop_event.is_set():
-                break
-            try:
-                try:
-                    # Read all data in a single go
-		    # recv = self.client.read_holding_registers(temp_reg,5)
-
-                    # Read Temperature 
-                    recv = self.client.read_holding_registers(temp_reg,1)
-                    ret['Temperature'] = recv.registers[0]
-
-                    # Read Humidity
-                    recv = self.client.read_holding_registers(humid_reg,1)
-                    ret['Humidity'] = recv.registers[0]
-
-                    # Read Pressure
-                    recv = self.client.read_holding_registers(pressure_reg,1)     
-                    ret['Pressure'] = recv.registers[0]
-
-                    # Read Geo location latitude
-                    recv = self.client.read_holding_registers(geo_lat_reg,2)
-                    decoder = BinaryPayloadDecoder.fromRegisters(recv.registers, endian=Endian.Big)
-                    ret['Latitude'] = decoder.decode_32bit_float() 
- 
-                    # Read Geo location longitude
-                    recv = self.client.read_holding_registers(geo_long_reg,2)
-                    decoder = BinaryPayloadDecoder.fromRegisters(recv.registers, endian=Endian.Big)
-                    ret['Longitude'] = decoder.decode_32bit_float()
- 
-                    # Read keyboard operation
-                    recv = self.client.read_holding_registers(key_op_reg,6)
-                    decoder = BinaryPayloadDecoder.fromRegisters(recv.registers, endian=Endian.Big)
-                    reg_str = decoder.decode_string(6)
-                    str_tokens = reg_str.split("\x00")
-                    ret['Key'] = str_tokens[0]
-                     
-                except ModbusException:
-                    logger.error("Failed to retrieve data from modbus server!")
-
-                OUTPUT = ret
-                dweet(ret)
-                send_to_cloud(ret)
-                logger.debug("###################################")
-                time.sleep(poll_freq)
-            except Exception as ex:
-                logger.exception("Exception.. but let us be resilient..")
-                time.sleep(poll_freq)
-
+    if SAMPLE_METADATA:
+        changes = dict(changes)
+        if issues is not None:
+            changes["_quality"] = issues
+        if fresh is not None:
+            changes["_latency_ms"] = round(state.latency * 1000, 3)
+    if SNAPSHOTS.keyed:
+        changes = {device.name: changes}
+    if SAMPLE_METADATA:
+        changes["_time"] = timestamp
+    for sink in SINKS:
+        sink.publish(changes, timestamp)
 
 class HTTPServerThread(threading.Thread):
     """
     Open a HTTP/TCP Port and spit out json response.
     """
-    def __init__(self, ipaddress, port, app):
+    def __init__(self, ipaddress, port, app, mode="threaded", workers=16, max_connections=64, timeout=15):
         super(HTTPServerThread, self).__init__()
         self.ipaddress = ipaddress
         self.port = port
         self.name = "HTTPServerThread-%s" % self.ipaddress
         self.setDaemon(True)
         self.stop_event = threading.Event()
-        self.httpd = make_server(self.ipaddress, self.port, app)
         cert = os.path.join(BASEDIR, "ssl.crt")
         key = os.path.join(BASEDIR, "ssl.key")
 
-        self.httpd.socket = ssl.wrap_socket(self.httpd.socket, certfile=cert, keyfile=key, server_side=True)
+        if mode != "single" and not hasattr(ssl, "SSLContext"):
+            logger.warning("This python has no ssl.SSLContext, falling back to the single threaded server")
+            mode = "single"
+
+        if mode == "single":
+            # One request at a time, TLS handshake on the serving thread
+            self.httpd = make_server(self.ipaddress, self.port, app)
+            self.httpd.socket = ssl.wrap_socket(self.httpd.socket, certfile=cert, keyfile=key, server_side=True)
+        else:
+            # A single context for all connections keeps the TLS session
+            # cache, so that clients can resume their sessions
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            context.load_cert_chain(cert, key)
+            self.httpd = make_tls_server(self.ipaddress, self.port, app, mode, ssl_context=context,
+                                         workers=workers, max_connections=max_connections, timeout=timeout)
 
         logger.debug("Thread : %s. %s:%s initialized" % (self.name, self.ipaddress, str(self.port)))
 
@@ -250,7 +382,16 @@ class HTTPServerThread(threading.Thread):
         self.httpd.serve_forever()
 
 if __name__ == '__main__':
-    setup_logging(cfg)
+    if os.getenv(SHARD_ENV):
+        # A worker process of the sharded collector. Its stdout carries the
+        # records for the supervisor, anything printed goes to stderr.
+        records = RecordWriter(os.dup(1))
+        os.dup2(2, 1)
+        setup_logging(cfg, [PipeHandler(records)])
+        run_worker(cfg, os.getenv(SHARD_ENV), records, collector_options(cfg))
+        os._exit(0)
+
+    log_writer = setup_logging(cfg)
     app = WebApp()
 
     ip = "0.0.0.0"
@@ -260,10 +401,49 @@ if __name__ == '__main__':
 
     # Setup App Server
 
-    hs = HTTPServerThread(ip, port, app)
+    server_options = dict()
+    if cfg.has_option("server", "mode"):
+        server_options["mode"] = cfg.get("server", "mode")
+    for option in ("workers", "max_connections", "timeout"):
+        if cfg.has_option("server", option):
+            server_options[option] = cfg.getint("server", option)
+
+    hs = HTTPServerThread(ip, port, app, **server_options)
     hs.start()
 
-    mc = ModbusThread()
+    devices = load_devices(cfg)
+    SNAPSHOTS = SnapshotStore(keyed=len(devices) > 1)
+
+    processes = 1
+    if cfg.has_option("collector", "processes"):
+        processes = cfg.getint("collector", "processes")
+
+    if cfg.has_option("collector", "sample_metadata"):
+        SAMPLE_METADATA = cfg.getboolean("collector", "sample_metadata")
+
+    if not cfg.has_option("history", "enabled") or cfg.getboolean("history", "enabled"):
+        capacity = 3600
+        if cfg.has_option("history", "capacity"):
+            capacity = cfg.getint("history", "capacity")
+        if capacity < 1:
+            raise ValueError("[history] capacity must be at least 1, set enabled: no to disable the history")
+        HISTORY = History(capacity)
+
+    sinks = load_sinks(cfg)
+    for sink in sinks:
+        sink.start()
+    SINKS = sinks
+    AGGREGATE = load_aggregate(cfg, sinks)
+    if AGGREGATE is not None:
+        # These sinks only get the window statistics
+        SINKS = [sink for sink in sinks if sink not in AGGREGATE.sinks]
+        AGGREGATE.start()
+
+    if processes > 1:
+        # Worker processes run this script again, with SHARD_ENV set
+        mc = Supervisor(devices, publish, processes, [sys.executable, os.path.abspath(__file__)])
+    else:
+        mc = CollectorEngine(devices, publish, **collector_options(cfg))
     mc.start()
 
     def terminate_self():
@@ -271,9 +451,15 @@ if __name__ == '__main__':
         try:
             hs.stop()
             mc.stop()
+            if AGGREGATE is not None:
+                AGGREGATE.stop()
+            for sink in sinks:
+                sink.stop()
         except Exception as ex:
             logger.exception("Error stopping the app gracefully.")
         logger.info("Killing self..")
+        if log_writer is not None:
+            log_writer.stop()
         os.kill(os.getpid(), 9)
 
     while True:
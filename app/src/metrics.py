@@ -0,0 +1,191 @@
+"""
+Runtime metrics, served on GET /metrics in the Prometheus text format.
+
+Counters and histograms are plain objects updated without locks: an event
+costs an attribute increment, or a bisect into the bucket bounds and a
+list increment, a few hundred nanoseconds, so the instrumentation stays
+on in production. Updates from different threads rely on the GIL; a rare
+lost increment under contention is accepted for that. Gauges are
+callbacks evaluated when the metrics are scraped, so queue depths cost
+nothing in between.
+
+Metrics kept elsewhere, like those of the worker processes of a sharded
+collector, are merged into the output by collectors added with
+add_collector.
+
+Metrics are registered once, when the instrumented object is created, and
+the hot paths only hold a reference to the metric:
+
+    reads = REGISTRY.histogram("modbus_read_seconds", "Duration of modbus reads",
+                               gateway="10.0.0.5:502")
+    ...
+    start = time.time()
+    ...
+    reads.observe(time.time() - start)
+"""
+import collections
+import threading
+from bisect import bisect_left
+
+# Seconds, from half a millisecond to ten seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(object):
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def samples(self, name, labels):
+        yield name, labels, self.func()
+
+
+class Histogram(object):
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        # A list, bisect indexes it faster than a tuple
+        self.bounds = sorted(bounds)
+        # The last count is for the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value, bisect_left=bisect_left):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.bounds + ["+Inf"], counts):
+            total += count
+            yield name + "_bucket", labels + (("le", _format(bound)),), total
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, total
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry(object):
+    """
+    Metric families by name, each with one metric per label set.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help, {labels: metric})
+        self.families = collections.OrderedDict()
+        self.collectors = []
+
+    def _get(self, kind, name, help, labels, factory):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = (kind, help, collections.OrderedDict())
+            elif family[0] != kind:
+                raise ValueError("%s is already registered as a %s" % (name, family[0]))
+            metric = family[2].get(labels)
+            if metric is None:
+                metric = family[2][labels] = factory()
+            return metric
+
+    def counter(self, name, help, func=None, **labels):
+        """
+        Return the counter of name and labels. With func, the value of the
+        counter is func() instead, for totals that are already kept
+        elsewhere.
+        """
+        if func is None:
+            return self._get("counter", name, help, labels, Counter)
+        return self._callback("counter", name, help, func, labels)
+
+    def gauge(self, name, help, func, **labels):
+        """
+        Register func() as the value of a gauge.
+        """
+        return self._callback("gauge", name, help, func, labels)
+
+    def _callback(self, kind, name, help, func, labels):
+        # A later registration for the same labels replaces the callback
+        metric = self._get(kind, name, help, labels, lambda: Gauge(func))
+        metric.func = func
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def add_collector(self, func):
+        """
+        Add the families func() returns, in the format of collect(), to
+        those of the registry when metrics are rendered.
+        """
+        with self.lock:
+            self.collectors.append(func)
+
+    def collect(self):
+        """
+        Return the metrics of the registry as a list of (name, type, help,
+        samples) families, with samples as (sample name, labels, value).
+        """
+        with self.lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics) in self.families.items()]
+        result = []
+        for name, kind, help, metrics in families:
+            samples = []
+            for labels, metric in metrics:
+                samples.extend(metric.samples(name, labels))
+            result.append((name, kind, help, samples))
+        return result
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        families = collections.OrderedDict()
+        for name, kind, help, samples in self.collect():
+            families[name] = (kind, help, samples)
+        with self.lock:
+            collectors = list(self.collectors)
+        for collector in collectors:
+            for name, kind, help, samples in collector():
+                if name in families:
+                    families[name][2].extend(samples)
+                else:
+                    families[name] = (kind, help, list(samples))
+        lines = []
+        for name, (kind, help, samples) in families.iteritems():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for sample, sample_labels, value in samples:
+                if sample_labels:
+                    sample += "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in sample_labels)
+                lines.append("%s %s" % (sample, _format(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,405 @@
+"""
+Publish pipeline between the collector and the HTTP sinks.
+
+Every sink (dweet.io, the cloud app) has its own bounded sample buffer and
+worker thread. Acquisition only appends to the buffers and never waits on
+the network; when a sink falls behind, its oldest samples are dropped. The
+workers group samples into batches of up to batch_size samples or
+batch_interval milliseconds and send each batch over a persistent keep-alive
+connection.
+
+A sink with a spool keeps samples it could not send in an on-disk store and
+forward spool and replays them in large batches once the server is
+reachable again. While the spool holds samples, new samples are appended to
+it as well so they are delivered in order.
+
+Samples are buffered as (timestamp, sample) pairs. The cloud sink can send
+them as JSON or in the packed binary format of wireformat.py, optionally
+compressed with zlib (Content-Encoding: deflate) or gzip.
+"""
+import collections
+import httplib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from metrics import REGISTRY
+from spool import Spool
+from wireformat import CONTENT_TYPE as PACKED_CONTENT_TYPE, encode_batch
+
+logger = logging.getLogger("modbusapp")
+
+
+class SampleBuffer(object):
+    """
+    Bounded FIFO of samples. Appending to a full buffer drops the oldest
+    sample.
+    """
+    def __init__(self, maxlen):
+        self.items = collections.deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get_batch(self, size, interval, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for at least one item,
+        then up to interval seconds for size items. Returns an empty list on
+        timeout or once the buffer is closed and empty.
+        """
+        with self.cond:
+            if timeout is None:
+                while not self.items and not self.closed:
+                    self.cond.wait()
+            elif not self.items and not self.closed and timeout > 0:
+                self.cond.wait(timeout)
+            if not self.items:
+                return []
+            deadline = time.time() + interval
+            while len(self.items) < size and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.items.popleft() for _ in range(min(size, len(self.items)))]
+
+
+class HTTPSink(threading.Thread):
+    """
+    Base class of a sink posting batches of samples to an HTTP server over a
+    persistent connection.
+    """
+    content_type = "application/json"
+    content_encoding = None
+    # Name of the config section of the sink
+    section = None
+
+    # Seconds between attempts to reach the server while samples are spooled
+    RETRY_MIN = 1
+    RETRY_MAX = 60
+
+    def __init__(self, name, scheme, server, port, url, method="POST",
+                 batch_size=1, batch_interval=0, queue_size=1000, timeout=10,
+                 spool=None, replay_batch=500):
+        super(HTTPSink, self).__init__()
+        self.name = "%sSink" % name
+        self.setDaemon(True)
+        self.scheme = scheme
+        self.server = server
+        self.port = port
+        self.url = url
+        self.method = method
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.timeout = timeout
+        self.buffer = SampleBuffer(queue_size)
+        self.conn = None
+        self.spool = spool
+        self.replay_batch = replay_batch
+        self.retry_at = 0
+        self.retry_delay = self.RETRY_MIN
+
+        labels = {"sink": self.section or name}
+        self.requests = REGISTRY.histogram("sink_request_seconds", "Duration of the requests of a sink", **labels)
+        self.sent = REGISTRY.counter("sink_samples_total", "Samples delivered by a sink", **labels)
+        self.errors = REGISTRY.counter("sink_errors_total", "Failed requests of a sink", **labels)
+        REGISTRY.gauge("sink_queue_depth", "Samples waiting in the buffer of a sink", self.buffer.__len__, **labels)
+        REGISTRY.counter("sink_dropped_total", "Samples dropped because a sink fell behind",
+                         lambda: self.buffer.dropped, **labels)
+        if spool is not None:
+            REGISTRY.gauge("sink_spool_bytes", "Size of the spool of a sink", lambda: spool.size, **labels)
+
+    def publish(self, sample, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.buffer.put((timestamp, sample))
+
+    def stop(self):
+        self.buffer.close()
+
+    def _connect(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.server, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.server, self.port, timeout=self.timeout)
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def encode(self, batch, replay=False):
+        """
+        Return the request body for a batch of (timestamp, sample) pairs.
+        replay is set for batches replayed from the spool.
+        """
+        raise NotImplementedError()
+
+    def compress(self, body):
+        if self.content_encoding == "deflate":
+            return zlib.compress(body)
+        if self.content_encoding == "gzip":
+            c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return c.compress(body) + c.flush()
+        return body
+
+    def request(self, body):
+        """
+        Send one request, reusing the open connection when possible.
+        Returns the response status.
+        """
+        headers = {"Content-Type": self.content_type, "Connection": "keep-alive"}
+        if self.content_encoding:
+            headers["Content-Encoding"] = self.content_encoding
+        for attempt in (1, 2):
+            if self.conn is None:
+                logger.debug("Connecting to %s://%s:%s", self.scheme, self.server, self.port)
+                self.conn = self._connect()
+            try:
+                self.conn.request(self.method, self.url, body, headers)
+                response = self.conn.getresponse()
+                # The body has to be consumed before the connection can be reused
+                response.read()
+                if response.getheader("connection", "").lower() == "close":
+                    self._close()
+                return response.status
+            except (httplib.HTTPException, IOError):
+                # The server may have closed an idle keep-alive connection.
+                # Retry once on a fresh connection.
+                self._close()
+                if attempt == 2:
+                    raise
+
+    def send(self, batch, replay=False):
+        body = self.compress(self.encode(batch, replay))
+        start = time.time()
+        try:
+            status = self.request(body)
+        except Exception:
+            self.errors.inc()
+            raise
+        finally:
+            self.requests.observe(time.time() - start)
+        if status >= 500:
+            self.errors.inc()
+            raise httplib.HTTPException("%s:%s answered with status %d" % (self.server, self.port, status))
+        self.sent.inc(len(batch))
+        logger.debug("%s: sent %d samples, response status %s", self.name, len(batch), status)
+        return status
+
+    def _offline(self):
+        self.retry_at = time.time() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, self.RETRY_MAX)
+
+    def _online(self):
+        self.retry_at = 0
+        self.retry_delay = self.RETRY_MIN
+
+    def _replay(self):
+        """
+        Send one batch from the spool. Returns False if the server could not
+        be reached.
+        """
+        if time.time() < self.retry_at:
+            return False
+        records = self.spool.read(self.replay_batch)
+        if not records:
+            return True
+        batch = []
+        for record in records:
+            try:
+                timestamp, sample = json.loads(record)
+                batch.append((timestamp, sample))
+            except (ValueError, TypeError):
+                logger.warning("%s: dropping unreadable spooled record", self.name)
+        try:
+            if batch:
+                self.send(batch, replay=True)
+        except Exception as ex:
+            self._offline()
+            logger.warning("%s: replay of %d spooled samples failed (%s), retrying in %ds",
+                           self.name, len(batch), ex, self.retry_at - time.time())
+            return False
+        self.spool.ack()
+        self._online()
+        return True
+
+    def _run_spooled(self):
+        while True:
+            # Wake up to retry the server or to sync the tail of the spool
+            wakeups = [self.retry_at] if self.spool.pending else []
+            sync_at = self.spool.sync_at
+            if sync_at is not None:
+                wakeups.append(sync_at)
+            timeout = max(0, min(wakeups) - time.time()) if wakeups else None
+            batch = self.buffer.get_batch(self.batch_size, self.batch_interval, timeout)
+            if not batch and self.buffer.closed:
+                break
+            self.spool.sync_due()
+
+            if batch and not self.spool.pending:
+                try:
+                    self.send(batch)
+                    continue
+                except Exception as ex:
+                    logger.warning("%s: failed to send %d samples (%s), spooling them",
+                                   self.name, len(batch), ex)
+                    self._offline()
+
+            if batch:
+                self.spool.append([json.dumps(item) for item in batch])
+            self._replay()
+        self.spool.close()
+
+    def run(self):
+        if self.spool is not None:
+            self._run_spooled()
+        else:
+            while True:
+                batch = self.buffer.get_batch(self.batch_size, self.batch_interval)
+                if not batch:
+                    break
+                try:
+                    self.send(batch)
+                except Exception:
+                    logger.exception("%s: failed to send %d samples", self.name, len(batch))
+        self._close()
+
+
+def merge(state, sample):
+    """
+    Merge a sample, which may hold only the changed values, into state.
+    "_quality" lists all tags that are not good, so it replaces the one in
+    state, and a sample without it means they all are.
+    """
+    for key, value in sample.iteritems():
+        if isinstance(value, dict) and key != "_quality":
+            merge(state.setdefault(key, dict()), value)
+        else:
+            state[key] = value
+    if "_quality" not in sample:
+        state.pop("_quality", None)
+    return state
+
+
+class DweetSink(HTTPSink):
+    """
+    dweet.io only keeps the latest dweet of a thing, so a batch is reduced to
+    the latest values. Samples may only hold the values that changed, so the
+    sink keeps the latest value of every tag and always sends all of them.
+    """
+    section = "dweet"
+
+    def __init__(self, server, name, **kwargs):
+        super(DweetSink, self).__init__("Dweet", "https", server, httplib.HTTPS_PORT,
+                                        "/dweet/for/%s" % name, **kwargs)
+        self.state = dict()
+
+    def encode(self, batch, replay=False):
+        for _, sample in batch:
+            merge(self.state, sample)
+        return json.dumps(self.state)
+
+
+class CloudSink(HTTPSink):
+    """
+    With the json encoding a single sample is posted as a JSON object and a
+    batch as a JSON array; replayed samples are always posted as an array
+    and carry their time in "_time", so they are stored at the time they
+    were polled. The packed encoding posts every batch in the binary format.
+    """
+    section = "cloud"
+
+    def __init__(self, scheme, server, port, url, method="POST", encoding="json", compression=None, **kwargs):
+        super(CloudSink, self).__init__("Cloud", scheme, server, port, url, method, **kwargs)
+        if encoding not in ("json", "packed"):
+            raise ValueError("Unknown cloud encoding %s" % encoding)
+        if compression not in (None, "deflate", "gzip"):
+            raise ValueError("Unknown cloud compression %s" % compression)
+        self.encoding = encoding
+        self.content_encoding = compression
+        if encoding == "packed":
+            self.content_type = PACKED_CONTENT_TYPE
+
+    def encode(self, batch, replay=False):
+        if self.encoding == "packed":
+            return encode_batch(batch)
+        if replay:
+            return json.dumps([sample if "_time" in sample else dict(sample, _time=ts) for ts, sample in batch])
+        if self.batch_size == 1 and len(batch) == 1:
+            return json.dumps(batch[0][1])
+        return json.dumps([sample for _, sample in batch])
+
+
+def _batching(cfg, section):
+    kwargs = dict()
+    if cfg.has_option(section, "batch_size"):
+        kwargs["batch_size"] = cfg.getint(section, "batch_size")
+    if cfg.has_option(section, "batch_interval_ms"):
+        kwargs["batch_interval"] = cfg.getint(section, "batch_interval_ms") / 1000.0
+    if cfg.has_option(section, "queue_size"):
+        kwargs["queue_size"] = cfg.getint(section, "queue_size")
+    return kwargs
+
+
+def _spooling(cfg, section):
+    # Persistent app data lives under CAF_APP_DATA_DIR on IOx
+    data_dir = os.getenv("CAF_APP_DATA_DIR", "/tmp")
+    spool_args = dict()
+    if cfg.has_option(section, "spool_max_mb"):
+        spool_args["max_size"] = cfg.getint(section, "spool_max_mb") * 1024 * 1024
+    if cfg.has_option(section, "spool_segment_kb"):
+        spool_args["segment_size"] = cfg.getint(section, "spool_segment_kb") * 1024
+    if cfg.has_option(section, "spool_fsync_ms"):
+        spool_args["fsync_interval"] = cfg.getint(section, "spool_fsync_ms") / 1000.0
+
+    kwargs = dict(spool=Spool(os.path.join(data_dir, "spool", section), **spool_args))
+    if cfg.has_option(section, "replay_batch"):
+        kwargs["replay_batch"] = cfg.getint(section, "replay_batch")
+    return kwargs
+
+
+def load_sinks(cfg):
+    """
+    Create the enabled sinks from the [dweet] and [cloud] sections.
+    """
+    sinks = []
+    if cfg.getboolean("dweet", "enabled"):
+        sinks.append(DweetSink(cfg.get("dweet", "server"), cfg.get("dweet", "name"),
+                               **_batching(cfg, "dweet")))
+    else:
+        logger.debug("Dweeting is disabled. Nothing to do...")
+
+    if cfg.getboolean("cloud", "enabled"):
+        kwargs = _batching(cfg, "cloud")
+        if cfg.has_option("cloud", "spool") and cfg.getboolean("cloud", "spool"):
+            kwargs.update(_spooling(cfg, "cloud"))
+        if cfg.has_option("cloud", "encoding"):
+            kwargs["encoding"] = cfg.get("cloud", "encoding")
+        if cfg.has_option("cloud", "compression"):
+            compression = cfg.get("cloud", "compression")
+            # zlib streams are sent as Content-Encoding: deflate
+            kwargs["compression"] = dict(none=None, zlib="deflate").get(compression, compression)
+        sinks.append(CloudSink(cfg.get("cloud", "scheme"), cfg.get("cloud", "server"),
+                               cfg.getint("cloud", "port"), cfg.get("cloud", "url"),
+                               cfg.get("cloud", "method"), **kwargs))
+    else:
+        logger.debug("Sending to data center app is disabled. Nothing to do...")
+    return sinks
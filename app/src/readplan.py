@@ -0,0 +1,64 @@
+"""
+Coalesced register read planning.
+
+Register ranges from the configuration are merged into the smallest set of
+read_holding_registers requests, so that one round trip to the modbus slave
+can serve several sensors. The values of each range are sliced back out of
+the block response.
+"""
+
+# A read holding registers response PDU carries at most 125 registers
+MAX_READ_COUNT = 125
+
+
+class ReadBlock(object):
+    """
+    A single modbus request covering one or more configured register ranges.
+    Each entry in ranges is a (name, offset, count) tuple where offset is
+    relative to the start address of the block.
+    """
+    __slots__ = ("address", "count", "ranges")
+
+    def __init__(self, address, count):
+        self.address = address
+        self.count = count
+        self.ranges = []
+
+    def __repr__(self):
+        return "ReadBlock(address=0x%02x, count=%d, ranges=%s)" % (self.address, self.count,
+                                                                   [r[0] for r in self.ranges])
+
+
+def plan_reads(ranges, max_gap=0, max_count=MAX_READ_COUNT):
+    """
+    Merge (name, address, count) register ranges into ReadBlocks.
+
+    Two ranges end up in the same block if the number of unused registers
+    between them is at most max_gap and the block does not grow beyond
+    max_count registers. Overlapping ranges are allowed.
+    """
+    if max_count < 1 or max_count > MAX_READ_COUNT:
+        raise ValueError("max_count must be between 1 and %d" % MAX_READ_COUNT)
+    if max_gap < 0:
+        raise ValueError("max_gap must not be negative")
+
+    blocks = []
+    block = None
+    for name, address, count in sorted(ranges, key=lambda r: (r[1], r[2])):
+        if count < 1 or count > max_count:
+            raise ValueError("%s: register count %d does not fit a single read" % (name, count))
+
+        if block is not None:
+            end = block.address + block.count
+            new_end = max(end, address + count)
+            if address - end <= max_gap and new_end - block.address <= max_count:
+                block.count = new_end - block.address
+                block.ranges.append((name, address - block.address, count))
+                continue
+
+        block = ReadBlock(address, count)
+        block.ranges.append((name, 0, count))
+        blocks.append(block)
+
+    return blocks
+
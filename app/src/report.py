@@ -0,0 +1,88 @@
+"""
+Report by exception.
+
+Instead of every value of every poll, only the tags that changed are passed
+on to dweet.io and the cloud app. A numeric tag counts as changed when it
+moved by more than its absolute deadband or by more than deadband_pct
+percent of the last reported value. Without a deadband, any change of the
+value is reported. Tags that did not change are still reported once they
+were silent for heartbeat seconds, and every keyframe seconds all tags are
+sent, so receivers that missed updates converge.
+
+    [report]
+    enabled: yes
+    deadband: 0
+    deadband_pct: 0
+    heartbeat: 60
+    keyframe: 300
+
+The deadband of a single tag can be set with the deadband= and
+deadband_pct= tag options.
+"""
+import threading
+
+
+class ReportFilter(object):
+    """
+    Report state of the tags of one device.
+    """
+    def __init__(self, tags, deadband=0, deadband_pct=0, heartbeat=60, keyframe=300):
+        # name -> (absolute deadband, relative deadband)
+        self.deadbands = dict()
+        for tag in tags:
+            absolute = deadband if tag.deadband is None else tag.deadband
+            pct = deadband_pct if tag.deadband_pct is None else tag.deadband_pct
+            self.deadbands[tag.name] = (absolute, pct / 100.0)
+        self.heartbeat = heartbeat
+        self.keyframe = keyframe
+        # name -> (last reported value, time it was reported)
+        self.reported = dict()
+        self.keyframe_at = None
+        self.lock = threading.Lock()
+
+    def _changed(self, name, value, last):
+        if value == last:
+            return False
+        if isinstance(value, bool) or not isinstance(value, (int, long, float)) \
+                or not isinstance(last, (int, long, float)):
+            return True
+        absolute, relative = self.deadbands.get(name, (0, 0))
+        if not absolute and not relative:
+            return True
+        delta = abs(value - last)
+        return bool((absolute and delta > absolute) or (relative and delta > relative * abs(last)))
+
+    def update(self, values, now):
+        """
+        Return the values to report at time now (seconds of a monotonic
+        clock), all of them when a keyframe is due.
+        """
+        with self.lock:
+            if self.keyframe_at is None or now >= self.keyframe_at:
+                self.keyframe_at = now + self.keyframe
+                for name, value in values.iteritems():
+                    self.reported[name] = (value, now)
+                return dict(values)
+
+            changes = dict()
+            silent = now - self.heartbeat
+            for name, value in values.iteritems():
+                last = self.reported.get(name)
+                if last is None or last[1] <= silent or self._changed(name, value, last[0]):
+                    self.reported[name] = (value, now)
+                    changes[name] = value
+            return changes
+
+
+def load_report(cfg):
+    """
+    Return the [report] settings as ReportFilter keyword arguments, or None
+    when report by exception is disabled.
+    """
+    if not cfg.has_option("report", "enabled") or not cfg.getboolean("report", "enabled"):
+        return None
+    kwargs = dict()
+    for option in ("deadband", "deadband_pct", "heartbeat", "keyframe"):
+        if cfg.has_option("report", option):
+            kwargs[option] = cfg.getfloat("report", option)
+    return kwargs
@@ -0,0 +1,75 @@
+"""
+Deadline based poll scheduling.
+
+Polls run on absolute deadlines of a monotonic clock (start + n * period),
+so the time spent reading and publishing never shifts later samples. A poll
+that starts late still runs if it is less than half a period behind; older
+deadlines are skipped and counted instead of being run back to back.
+"""
+import ctypes
+import ctypes.util
+import math
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+# Python 2 has no time.monotonic. Fall back to wall clock time when
+# clock_gettime is not available.
+monotonic = getattr(time, "monotonic", None) or _clock_gettime() or time.time
+
+
+class Schedule(object):
+    """
+    Deadlines of a periodic task.
+    """
+    __slots__ = ("period", "deadline", "missed")
+
+    def __init__(self, period):
+        if period <= 0:
+            raise ValueError("poll period must be positive")
+        self.period = period
+        self.deadline = None
+        self.missed = 0
+
+    def start(self, now):
+        self.deadline = now
+        return self.deadline
+
+    def advance(self, now):
+        """
+        Move to the next deadline after the current one. Deadlines more
+        than half a period in the past are skipped. Returns the number
+        skipped.
+        """
+        deadline = self.deadline + self.period
+        missed = 0
+        late = now - deadline
+        if late > self.period / 2.0:
+            missed = int(math.ceil(late / self.period - 0.5))
+            deadline += missed * self.period
+            self.missed += missed
+        self.deadline = deadline
+        return missed
@@ -0,0 +1,439 @@
+"""
+Collector sharding across worker processes.
+
+A single process decodes, schedules and publishes every poll under one
+GIL. With [collector] processes > 1 the app becomes a supervisor: it starts
+that many worker processes, each running a CollectorEngine over a shard of
+the devices, and keeps /data, the history, report by exception and the
+sinks for itself. Devices behind the same gateway or on the same RTU bus
+stay in one shard, since they share its connections, and shards are
+balanced by the modbus requests per second of their devices.
+
+Workers are the app itself, started again with MODBUS_SHARD set to
+"<index>/<count>". They load the same configuration, and so the same
+devices, poll jobs and tag order as the supervisor. A worker does not send
+its device states: it replays every update of a device to the supervisor,
+which applies it to its own copy of the device and arrives at the same
+state.
+
+Records go over the stdout pipe of the worker, each framed as
+
+    "<IB"       payload length + 1, record kind
+
+with the payloads
+
+    SAMPLE      "<HHBdf" device, job, quality, timestamp and read latency
+                (NaN if none); for good polls followed by the values of the
+                tags of the job: a bitmap of the tags that decoded, one
+                struct of all numeric tags in their register types (float64
+                if scaled), then every string tag as "<H" length + bytes
+    LOG         "<B" level, then the message
+    METRICS     JSON of Registry.collect() of the worker, every few seconds
+    HELLO       "<HI" shard index, crc32 of the device layout
+
+A worker that exits is restarted with a backoff; its devices turn stale in
+the meantime. Workers exit when the supervisor goes away.
+"""
+import collections
+import json
+import logging
+import os
+import select
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+from collector import CollectorEngine, load_devices
+from connection import Backoff
+from metrics import REGISTRY
+from scheduler import monotonic
+from snapshot import GOOD, STALE
+from tagmap import TAG_TYPES
+
+logger = logging.getLogger("modbusapp")
+
+SHARD_ENV = "MODBUS_SHARD"
+FRAME = struct.Struct("<IB")
+SAMPLE = struct.Struct("<HHBdf")
+LEVEL = struct.Struct("<B")
+HELLO = struct.Struct("<HI")
+LENGTH = struct.Struct("<H")
+SAMPLE_RECORD = 1
+LOG_RECORD = 2
+METRICS_RECORD = 3
+HELLO_RECORD = 4
+# Seconds between the metrics records of a worker
+METRICS_INTERVAL = 5
+NAN = float("nan")
+
+RESTARTS = REGISTRY.counter("collector_worker_restarts_total", "Collector worker processes restarted")
+
+
+def assign_shards(devices, count):
+    """
+    Split devices into at most count shards of similar load. Returns the
+    positions of the devices of every shard.
+    """
+    groups = collections.OrderedDict()
+    for position, device in enumerate(devices):
+        groups.setdefault(device.endpoint, []).append(position)
+    weighted = []
+    for group in groups.values():
+        weight = sum(len(job.tagmap.requests) / job.schedule.period
+                     for position in group for job in devices[position].jobs)
+        weighted.append((-weight, group[0], group))
+    shards = [[] for _ in range(max(1, min(count, len(groups))))]
+    loads = [0.0] * len(shards)
+    # Heaviest first, each to the lightest shard so far
+    for weight, _, group in sorted(weighted):
+        lightest = loads.index(min(loads))
+        shards[lightest].extend(group)
+        loads[lightest] -= weight
+    return [sorted(shard) for shard in shards]
+
+
+def layout(devices):
+    """
+    crc32 of the names, poll jobs and tags of devices. Equal in the
+    supervisor and its workers as long as they read the same configuration.
+    """
+    text = repr([(device.name, [(job.group, [tag.name for tag in job.tagmap.tags]) for job in device.jobs])
+                 for device in devices])
+    return zlib.crc32(text) & 0xffffffff
+
+
+class SampleCodec(object):
+    """
+    Packs the values of a poll of the tags of a tag map.
+    """
+    def __init__(self, tags):
+        fmt = "<"
+        fixed = []
+        strings = []
+        for tag in tags:
+            if tag.type == "string":
+                strings.append(tag.name)
+            else:
+                fmt += "d" if tag.scale not in (None, 1) else TAG_TYPES[tag.type][0]
+                fixed.append(tag.name)
+        self.fixed = fixed
+        self.strings = strings
+        # Bitmap order
+        self.names = fixed + strings
+        self.values = struct.Struct(fmt)
+        bitmap = bytearray((len(self.names) + 7) // 8)
+        for i in range(len(self.names)):
+            bitmap[i >> 3] |= 1 << (i & 7)
+        # The bitmap of a poll without decode errors
+        self.complete = bytes(bitmap)
+
+    def encode(self, values):
+        get = values.get
+        fixed = [get(name) for name in self.fixed]
+        strings = [get(name) for name in self.strings]
+        bitmap = self.complete
+        if len(values) < len(self.names):
+            bits = bytearray(len(bitmap))
+            for i, value in enumerate(fixed + strings):
+                if value is not None:
+                    bits[i >> 3] |= 1 << (i & 7)
+            bitmap = bytes(bits)
+            fixed = [0 if value is None else value for value in fixed]
+        parts = [bitmap, self.values.pack(*fixed)]
+        for value in strings:
+            value = value or ""
+            parts.append(LENGTH.pack(len(value)))
+            parts.append(value)
+        return "".join(parts)
+
+    def decode(self, buf, pos):
+        """
+        Unpack the values at pos of buf. Returns the values and the names
+        of the tags that failed to decode.
+        """
+        end = pos + len(self.complete)
+        bitmap = buf[pos:end]
+        fixed = self.values.unpack_from(buf, end)
+        pos = end + self.values.size
+        values = dict(zip(self.fixed, fixed))
+        for name in self.strings:
+            size = LENGTH.unpack_from(buf, pos)[0]
+            pos += LENGTH.size
+            values[name] = buf[pos:pos + size]
+            pos += size
+        errors = ()
+        if bitmap != self.complete:
+            bits = bytearray(bitmap)
+            errors = [name for i, name in enumerate(self.names) if not bits[i >> 3] & (1 << (i & 7))]
+            for name in errors:
+                del values[name]
+        return values, errors
+
+
+def _codecs(devices):
+    # The codec of every job of every device, one per tag map, since tag
+    # maps are shared between devices
+    codecs = dict()
+    result = []
+    for device in devices:
+        for job in device.jobs:
+            if job.tagmap not in codecs:
+                codecs[job.tagmap] = SampleCodec(job.tagmap.tags)
+        result.append([codecs[job.tagmap] for job in device.jobs])
+    return result
+
+
+class RecordWriter(object):
+    """
+    Writes the records of a worker to the supervisor. Once the supervisor
+    is gone, records are dropped and closed is set.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+        self.closed = False
+        # PollJob -> (device position, job position, SampleCodec)
+        self.jobs = dict()
+
+    def write(self, kind, payload):
+        data = FRAME.pack(len(payload) + 1, kind) + payload
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                while data:
+                    data = data[os.write(self.fd, data):]
+            except OSError:
+                self.closed = True
+
+    def attach(self, devices, positions):
+        """
+        Send the updates of the devices at positions.
+        """
+        codecs = _codecs(devices)
+        for position in positions:
+            device = devices[position]
+            for index, job in enumerate(device.jobs):
+                self.jobs[job] = (position, index, codecs[position][index])
+            device.listener = self.sample
+
+    def sample(self, job, values, timestamp, quality, latency, errors):
+        position, index, codec = self.jobs[job]
+        record = SAMPLE.pack(position, index, quality, timestamp, NAN if latency is None else latency)
+        if values is not None:
+            record += codec.encode(values)
+        self.write(SAMPLE_RECORD, record)
+
+
+class PipeHandler(logging.Handler):
+    """
+    Handler passing the records of a worker to the supervisor, which logs
+    them.
+    """
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.formatter = logging.Formatter()
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+            if record.exc_info:
+                message += "\n" + self.formatter.formatException(record.exc_info)
+            if isinstance(message, unicode):
+                message = message.encode("utf-8")
+            self.writer.write(LOG_RECORD, LEVEL.pack(record.levelno) + message)
+        except Exception:
+            self.handleError(record)
+
+
+def run_worker(cfg, shard, writer, options):
+    """
+    Poll shard "<index>/<count>" of the devices of cfg with a
+    CollectorEngine created with options, until interrupted or the
+    supervisor goes away.
+    """
+    index, count = [int(n) for n in shard.split("/")]
+    devices = load_devices(cfg)
+    positions = assign_shards(devices, count)[index]
+    writer.write(HELLO_RECORD, HELLO.pack(index, layout(devices)))
+    for position in positions:
+        # The supervisor filters by exception
+        devices[position].report = None
+    writer.attach(devices, positions)
+    engine = CollectorEngine([devices[position] for position in positions],
+                             lambda device, state, changes: None, **options)
+    engine.start()
+    parent = os.getppid()
+    next_metrics = 0
+    try:
+        while not writer.closed and os.getppid() == parent:
+            now = time.time()
+            if now >= next_metrics:
+                writer.write(METRICS_RECORD, json.dumps(REGISTRY.collect()))
+                next_metrics = now + METRICS_INTERVAL
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    engine.stop()
+
+
+class Supervisor(threading.Thread):
+    """
+    Poll devices in worker processes started with command and pass every
+    sample to on_sample, like a CollectorEngine.
+    """
+    def __init__(self, devices, on_sample, processes, command):
+        super(Supervisor, self).__init__()
+        self.name = "Supervisor"
+        self.setDaemon(True)
+        self.stop_event = threading.Event()
+        self.devices = list(devices)
+        self.on_sample = on_sample
+        self.processes = processes
+        self.command = command
+        self.shards = assign_shards(self.devices, processes)
+        self.layout = layout(self.devices)
+        self.codecs = _codecs(self.devices)
+        count = len(self.shards)
+        self.workers = [None] * count
+        self.buffers = [""] * count
+        self.started = [0] * count
+        # Time to restart an exited worker, None to never restart it
+        self.restart_at = [None] * count
+        self.backoffs = [Backoff(1.0, 60.0) for _ in range(count)]
+        # Latest Registry.collect() of every worker
+        self.metrics = [[] for _ in range(count)]
+        REGISTRY.add_collector(self._metrics)
+
+    def _metrics(self):
+        families = []
+        for index, worker in enumerate(list(self.metrics)):
+            shard = [["shard", str(index)]]
+            for name, kind, help, samples in worker:
+                families.append((name, kind, help, [(sample, labels + shard, value)
+                                                    for sample, labels, value in samples]))
+        return families
+
+    def stop(self):
+        self.stop_event.set()
+        workers = [worker for worker in list(self.workers) if worker is not None]
+        for worker in workers:
+            try:
+                worker.terminate()
+            except OSError:
+                pass
+        deadline = time.time() + 2
+        for worker in workers:
+            while worker.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if worker.poll() is None:
+                worker.kill()
+
+    def _start(self, index):
+        env = dict(os.environ)
+        env[SHARD_ENV] = "%d/%d" % (index, self.processes)
+        worker = subprocess.Popen(self.command, stdout=subprocess.PIPE, close_fds=True, env=env)
+        self.workers[index] = worker
+        self.buffers[index] = ""
+        self.started[index] = monotonic()
+        self.restart_at[index] = None
+        logger.info("Started collector worker %d (pid %d) for %d devices",
+                    index, worker.pid, len(self.shards[index]))
+
+    def _exited(self, index):
+        worker = self.workers[index]
+        worker.stdout.close()
+        status = worker.wait()
+        self.workers[index] = None
+        self.metrics[index] = []
+        if self.stop_event.is_set():
+            return
+        # Until the worker is back, the values of its devices are stale
+        now = time.time()
+        for position in self.shards[index]:
+            device = self.devices[position]
+            for job in device.jobs:
+                state = device.update(job, None, now, STALE)
+                self.on_sample(device, state, device.changes(state))
+        if self.restart_at[index] is not None:
+            return
+        backoff = self.backoffs[index]
+        if monotonic() - self.started[index] > backoff.maximum:
+            backoff.succeeded()
+        self.restart_at[index] = backoff.failed(monotonic())
+        logger.error("Collector worker %d exited with status %s, restarting it in %.1fs",
+                     index, status, self.restart_at[index] - monotonic())
+
+    def _received(self, index, data):
+        buf = self.buffers[index] + data
+        pos = 0
+        while len(buf) - pos >= FRAME.size:
+            length, kind = FRAME.unpack_from(buf, pos)
+            end = pos + 4 + length
+            if end > len(buf):
+                break
+            try:
+                self._record(index, kind, buf, pos + FRAME.size, end)
+            except Exception:
+                logger.exception("Bad record from collector worker %d", index)
+            pos = end
+        self.buffers[index] = buf[pos:]
+
+    def _record(self, index, kind, buf, start, end):
+        if kind == SAMPLE_RECORD:
+            position, job, quality, timestamp, latency = SAMPLE.unpack_from(buf, start)
+            device = self.devices[position]
+            values = errors = None
+            if quality == GOOD:
+                values, errors = self.codecs[position][job].decode(buf, start + SAMPLE.size)
+            # latency != latency for NaN
+            state = device.update(device.jobs[job], values, timestamp, quality,
+                                  None if latency != latency else latency, errors)
+            self.on_sample(device, state, device.changes(state))
+        elif kind == LOG_RECORD:
+            level = LEVEL.unpack_from(buf, start)[0]
+            if logger.isEnabledFor(level):
+                message = "worker %d: %s" % (index, buf[start + LEVEL.size:end])
+                logger.handle(logging.LogRecord(logger.name, level, __file__, 0, message, None, None))
+        elif kind == METRICS_RECORD:
+            self.metrics[index] = json.loads(buf[start:end])
+        elif kind == HELLO_RECORD:
+            _, crc = HELLO.unpack_from(buf, start)
+            if crc != self.layout:
+                logger.error("Collector worker %d loaded different devices, the configuration changed? "
+                             "Stopping it", index)
+                # Never restart it
+                self.restart_at[index] = float("inf")
+                self.workers[index].terminate()
+
+    def run(self):
+        logger.info("Collector polling %d devices in %d worker processes",
+                    len(self.devices), len(self.shards))
+        for index in range(len(self.shards)):
+            self._start(index)
+        while not self.stop_event.is_set():
+            fds = dict((worker.stdout.fileno(), index)
+                       for index, worker in enumerate(self.workers) if worker is not None)
+            if not fds:
+                time.sleep(1)
+            else:
+                try:
+                    readable = select.select(list(fds), [], [], 1.0)[0]
+                except select.error:
+                    continue
+                for fd in readable:
+                    index = fds[fd]
+                    data = os.read(fd, 65536)
+                    if data:
+                        self._received(index, data)
+                    else:
+                        self._exited(index)
+            now = monotonic()
+            for index, restart_at in enumerate(self.restart_at):
+                if self.workers[index] is None and restart_at is not None and now >= restart_at \
+                        and not self.stop_event.is_set():
+                    RESTARTS.inc()
+                    self._start(index)
@@ -0,0 +1,246 @@
+"""
+Versioned, pre-serialized snapshots of the latest values.
+
+The collector publishes a new immutable Snapshot once per poll. It carries
+the JSON body served on /data, a sequence number and an ETag, so HTTP
+requests only hand out bytes that were encoded once and can answer
+conditional requests with 304 Not Modified.
+
+With more than one device the body is {device: values}. The JSON of every
+device is cached separately, so a poll only encodes the values of the
+device that was polled.
+
+Streaming and long polling clients block in wait() until a newer snapshot
+is published. Each snapshot also carries its Server-Sent Events message, so
+one encoded event is fanned out to all subscribers.
+
+The collector keeps the values of each device in a DeviceState, together
+with the time, read latency and quality of the read that produced each tag.
+Per tag metadata is held in parallel arrays, 13 bytes per tag, instead of
+one object or dict per tag and sample. States are never modified either: a
+poll builds a new state that shares what it did not change and swaps it
+in, so neither snapshots nor any other reader need to copy or lock them.
+"""
+import json
+import threading
+import time
+from array import array
+
+# Quality of a tag value
+NONE = 0
+GOOD = 1
+# The last read of the tag failed, the value is the last good one
+COMM_FAIL = 2
+# The tag was not read on time, the device was not reachable
+STALE = 3
+# The registers did not hold a valid value for the type of the tag
+DECODE_ERROR = 4
+QUALITY_NAMES = ("none", "good", "comm_fail", "stale", "decode_error")
+
+
+class DeviceState(object):
+    """
+    The values of the tags of a device, in values, and per tag in names
+    order the time and latency of the last good read and the quality of the
+    value, in the parallel arrays times, latencies and quality. fresh holds
+    the values read by the poll that made the state, None if it failed.
+    Never modified once created.
+    """
+    __slots__ = ("names", "values", "times", "latencies", "quality", "bad", "recovered", "fresh",
+                 "latency", "timestamp", "seq")
+
+    def __init__(self, names):
+        self.names = names
+        self.values = dict()
+        self.times = array("d", [0.0]) * len(names)
+        self.latencies = array("f", [0.0]) * len(names)
+        self.quality = array("B", [NONE]) * len(names)
+        # Number of tags whose quality is not GOOD
+        self.bad = len(names)
+        # The poll made the last tag that was not GOOD good again
+        self.recovered = False
+        self.fresh = None
+        # Seconds the read of the poll took
+        self.latency = None
+        # Time of the poll that made the state
+        self.timestamp = None
+        # Orders the states of a device, polls may finish out of order
+        self.seq = 0
+
+    def update(self, indexes, values, timestamp, quality=GOOD, latency=None, errors=()):
+        """
+        Return a new state for a poll at timestamp of the tags at indexes.
+        values are the values read, the tags at the indexes in errors could
+        not be decoded. When values is None the poll failed with quality
+        COMM_FAIL or STALE and the tags keep their values; STALE does not
+        replace the quality of tags that are not GOOD.
+        """
+        state = DeviceState.__new__(DeviceState)
+        state.names = self.names
+        state.timestamp = timestamp
+        state.seq = self.seq + 1
+        state.latency = latency
+        flags = self.quality[:]
+        bad = self.bad
+        if values is None:
+            state.values = self.values
+            state.times = self.times
+            state.latencies = self.latencies
+            state.fresh = None
+            for i in indexes:
+                if flags[i] == GOOD:
+                    flags[i] = quality
+                    bad += 1
+                elif quality != STALE:
+                    flags[i] = quality
+        else:
+            merged = dict(self.values)
+            merged.update(values)
+            state.values = merged
+            state.fresh = values
+            times = state.times = self.times[:]
+            latencies = state.latencies = self.latencies[:]
+            latency = latency or 0.0
+            for i in indexes:
+                if flags[i] != GOOD:
+                    flags[i] = GOOD
+                    bad -= 1
+                times[i] = timestamp
+                latencies[i] = latency
+            for i in errors:
+                flags[i] = DECODE_ERROR
+                bad += 1
+                times[i] = self.times[i]
+                latencies[i] = self.latencies[i]
+        state.quality = flags
+        state.bad = bad
+        state.recovered = bad == 0 and self.bad > 0
+        return state
+
+    def issues(self):
+        """
+        Return {tag: quality name} of the tags that are not GOOD, or None.
+        """
+        if not self.bad:
+            return None
+        quality = self.quality
+        return dict((name, QUALITY_NAMES[quality[i]])
+                    for i, name in enumerate(self.names) if quality[i] != GOOD)
+
+    def meta(self):
+        """
+        Return {tag: {"value": v, "time": t, "latency_ms": l, "quality": q}}.
+        """
+        values = self.values
+        times = self.times
+        latencies = self.latencies
+        quality = self.quality
+        return dict((name, {"value": values.get(name), "time": times[i] or None,
+                            "latency_ms": round(latencies[i] * 1000, 3) if times[i] else None,
+                            "quality": QUALITY_NAMES[quality[i]]})
+                    for i, name in enumerate(self.names))
+
+
+class Snapshot(object):
+    """
+    The values published by one poll. Never modified once created.
+    """
+    __slots__ = ("seq", "timestamp", "values", "states", "keyed", "body", "etag", "event", "_meta")
+
+    def __init__(self, seq, timestamp, values, states, body, etag, keyed=False):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.values = values
+        # device name -> DeviceState
+        self.states = states
+        self.keyed = keyed
+        self.body = body
+        self.etag = etag
+        # json.dumps output has no line breaks, so the body fits one data line
+        self.event = "id: %d\ndata: %s\n\n" % (seq, body)
+        self._meta = None
+
+    @property
+    def meta(self):
+        """
+        JSON of the values with the time and quality of every tag, encoded
+        on first use. Concurrent first uses encode the same body twice.
+        """
+        if self._meta is None:
+            if self.keyed:
+                meta = dict((name, state.meta()) for name, state in self.states.iteritems())
+            else:
+                meta = self.states.values()[0].meta() if self.states else dict()
+            self._meta = json.dumps(meta)
+        return self._meta
+
+
+class SnapshotStore(object):
+    """
+    Holds the current snapshot. Readers just take self.current; publishing
+    replaces it with a new object.
+    """
+    def __init__(self, keyed=False):
+        self.keyed = keyed
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.fragments = dict()
+        # ETags stay unique across restarts of the app
+        self.epoch = "%x" % int(time.time())
+        self.current = Snapshot(0, None, dict(), dict(), "{}", self._etag(0), keyed)
+
+    def _etag(self, seq):
+        return '"%s-%d"' % (self.epoch, seq)
+
+    def publish(self, name, state):
+        """
+        Publish the new DeviceState of a device. Returns the new snapshot,
+        or the current one if it already has a newer state of the device.
+        """
+        values = state.values
+        fragment = json.dumps(values)
+        with self.lock:
+            prev = self.current
+            published = prev.states.get(name)
+            if published is not None and published.seq >= state.seq:
+                return prev
+            seq = prev.seq + 1
+            if self.keyed:
+                merged = dict(prev.values)
+                merged[name] = values
+                states = dict(prev.states)
+                states[name] = state
+                self.fragments[name] = fragment
+                body = "{%s}" % ", ".join("%s: %s" % (json.dumps(n), f)
+                                          for n, f in sorted(self.fragments.iteritems()))
+                values = merged
+            else:
+                states = {name: state}
+                body = fragment
+            self.current = Snapshot(seq, state.timestamp, values, states, body, self._etag(seq), self.keyed)
+            self.cond.notify_all()
+            return self.current
+
+    def wait(self, seq, timeout):
+        """
+        Wait up to timeout seconds for a snapshot newer than seq. Returns the
+        current snapshot if it is newer, otherwise None.
+        """
+        snapshot = self.current
+        # A sequence number from before a restart of the app is ahead of us
+        if snapshot.seq != seq:
+            return snapshot
+        with self.cond:
+            if self.current.seq == seq:
+                self.cond.wait(timeout)
+            snapshot = self.current
+        return snapshot if snapshot.seq != seq else None
+
+    def not_modified(self, if_none_match, etag):
+        """
+        True if an If-None-Match header matches the ETag of a snapshot.
+        """
+        if not if_none_match:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or ("W/" + etag) in tags
@@ -0,0 +1,246 @@
+"""
+Store and forward spool for samples that could not be sent.
+
+Records are appended to fixed size segment files in a spool directory and
+made durable with one fsync per fsync_interval rather than per record, to
+keep flash wear and write latency low. The writer calls sync_due() when
+appends stop, so that the tail is synced within fsync_interval as well.
+The spool is capped at max_size bytes; when it is full the oldest segments
+are dropped. A read cursor, persisted next to the segments, records how far
+the spool has been replayed.
+
+Each record is stored as a (length, crc32) header followed by the data. A
+record torn by a power loss fails the crc check and the rest of its segment
+is skipped.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger("modbusapp")
+
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+class Spool(object):
+    """
+    Append only, segment based on-disk FIFO.
+    """
+    def __init__(self, directory, segment_size=1024 * 1024, max_size=64 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max(max_size, 2 * segment_size)
+        self.fsync_interval = fsync_interval
+        self.lock = threading.RLock()
+        self.evicted = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.sizes = dict()
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self.sizes[seq] = os.path.getsize(self._path(seq))
+
+        self.reader = None
+        self.read_seq, self.read_offset = self._load_cursor()
+        # Segments before the cursor have been replayed already, empty ones
+        # and the one the cursor is at the end of hold nothing to replay
+        for seq in sorted(self.sizes):
+            if seq < self.read_seq or self.sizes[seq] == 0 or \
+                    (seq == self.read_seq and self.read_offset >= self.sizes[seq]):
+                self._remove(seq)
+        if self.read_seq not in self.sizes:
+            self.read_seq, self.read_offset = min(self.sizes) if self.sizes else self.read_seq, 0
+        self.read_end = None
+
+        # Always append to a fresh segment so that a torn record left behind
+        # by a crash is never followed by new data
+        self.write_seq = max(self.sizes) + 1 if self.sizes else self.read_seq
+        self.writer = None
+        self._open_writer()
+        self.last_sync = time.time()
+        self.unsynced = False
+
+        if self.pending:
+            logger.info("Spool %s holds %d bytes to replay", directory, self.size)
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "%016d%s" % (seq, SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (IOError, ValueError):
+            return (min(self.sizes) if self.sizes else 0), 0
+
+    def _save_cursor(self, durable=False):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("%d %d\n" % (self.read_seq, self.read_offset))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def _open_writer(self):
+        self.writer = open(self._path(self.write_seq), "ab")
+        self.sizes[self.write_seq] = self.writer.tell()
+
+    def _remove(self, seq):
+        if self.reader is not None and self.reader[0] == seq:
+            self.reader[1].close()
+            self.reader = None
+        try:
+            os.remove(self._path(seq))
+        except OSError:
+            pass
+        self.sizes.pop(seq, None)
+
+    @property
+    def size(self):
+        return sum(self.sizes.values())
+
+    @property
+    def pending(self):
+        """
+        True if there are records that have not been replayed.
+        """
+        with self.lock:
+            return (self.read_seq, self.read_offset) < (self.write_seq, self.sizes[self.write_seq])
+
+    def append(self, records):
+        """
+        Append a list of byte strings to the spool.
+        """
+        with self.lock:
+            for data in records:
+                self.writer.write(RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+                self.writer.write(data)
+                self.sizes[self.write_seq] += RECORD_HEADER.size + len(data)
+                if self.sizes[self.write_seq] >= self.segment_size:
+                    self._rotate()
+
+            if self.size > self.max_size:
+                self._evict()
+            self.unsynced = True
+            if time.time() - self.last_sync >= self.fsync_interval:
+                self.sync()
+
+    def _rotate(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.write_seq += 1
+        self._open_writer()
+
+    def _evict(self):
+        # Drop the oldest segments, never the one being written
+        while self.size > self.max_size and len(self.sizes) > 1:
+            seq = min(self.sizes)
+            self.evicted += self.sizes[seq]
+            logger.warning("Spool full, dropping %d bytes of unsent samples", self.sizes[seq])
+            self._remove(seq)
+            if self.read_seq <= seq:
+                self.read_seq, self.read_offset = min(self.sizes), 0
+                self.read_end = None
+        self._save_cursor()
+
+    def sync(self):
+        """
+        Make everything appended so far durable.
+        """
+        with self.lock:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self._save_cursor(durable=True)
+            self.last_sync = time.time()
+            self.unsynced = False
+
+    @property
+    def sync_at(self):
+        """
+        The time the records appended since the last sync are due to be
+        synced, None if there are none.
+        """
+        with self.lock:
+            return self.last_sync + self.fsync_interval if self.unsynced else None
+
+    def sync_due(self):
+        """
+        Sync the records appended since the last sync if they are due.
+        """
+        with self.lock:
+            if self.unsynced and time.time() >= self.last_sync + self.fsync_interval:
+                self.sync()
+
+    def read(self, max_records):
+        """
+        Return up to max_records records from the read cursor onward. The
+        cursor only moves on ack(), so the same records are returned again
+        until they are acknowledged.
+        """
+        with self.lock:
+            self.writer.flush()
+            records = []
+            seq, offset = self.read_seq, self.read_offset
+            while len(records) < max_records and (seq, offset) < (self.write_seq, self.sizes[self.write_seq]):
+                if offset >= self.sizes.get(seq, 0):
+                    seq, offset = seq + 1, 0
+                    continue
+                if self.reader is None or self.reader[0] != seq:
+                    if self.reader is not None:
+                        self.reader[1].close()
+                    self.reader = (seq, open(self._path(seq), "rb"))
+                f = self.reader[1]
+                f.seek(offset)
+                header = f.read(RECORD_HEADER.size)
+                length, crc = RECORD_HEADER.unpack(header) if len(header) == RECORD_HEADER.size else (0, None)
+                data = f.read(length) if crc is not None else ""
+                if crc is None or len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+                    logger.warning("Spool segment %d is corrupt at offset %d, skipping the rest of it", seq, offset)
+                    offset = self.sizes[seq]
+                    continue
+                records.append(data)
+                offset += RECORD_HEADER.size + length
+            self.read_end = (seq, offset)
+            return records
+
+    def ack(self):
+        """
+        Mark the records returned by the last read() as replayed.
+        """
+        with self.lock:
+            if self.read_end is None:
+                return
+            self.read_seq, self.read_offset = self.read_end
+            self.read_end = None
+            for seq in sorted(self.sizes):
+                if seq < self.read_seq:
+                    self._remove(seq)
+            if (self.read_seq, self.read_offset) == (self.write_seq, self.sizes[self.write_seq]) \
+                    and self.sizes[self.write_seq] > 0:
+                # Fully replayed, start over with an empty segment
+                self.writer.close()
+                self._remove(self.write_seq)
+                self.write_seq += 1
+                self._open_writer()
+                self.read_seq, self.read_offset = self.write_seq, 0
+            self._save_cursor()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.writer.close()
+            if self.reader is not None:
+                self.reader[1].close()
+                self.reader = None
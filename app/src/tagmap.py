@@ -0,0 +1,227 @@
+"""
+Declarative tag map.
+
+Each tag in the [tags] section of package_config.ini describes where a value
+lives in the holding registers and how to interpret it:
+
+    [tags]
+    # name: address, type[, count=N][, byteorder=big|little][, wordorder=big|little][, scale=X][, group=G]
+    #       [, deadband=X][, deadband_pct=X]
+    Temperature: 0x01, uint16
+    Latitude: 0x04, float32, wordorder=big, group=geo
+    Key: 0x08, string, count=6, group=fast
+
+Tags of a group are polled at the rate configured for the group in the
+[poll_groups] section, all other tags at the poll frequency of the device.
+deadband and deadband_pct override the report by exception deadbands of
+the [report] section for the tag.
+
+The tags are compiled once into a read plan and a flat table of struct based
+unpackers per read block, so decoding a poll is a single pass over each
+block's register buffer. Registers that hold no valid value for their tag,
+a NaN or infinite float or a string that is not UTF-8, are decode errors.
+"""
+import struct
+
+from readplan import MAX_READ_COUNT, plan_reads
+
+# type name -> (struct format character, register count)
+TAG_TYPES = {
+    "uint16": ("H", 1),
+    "int16": ("h", 1),
+    "uint32": ("I", 2),
+    "int32": ("i", 2),
+    "float32": ("f", 2),
+    "uint64": ("Q", 4),
+    "int64": ("q", 4),
+    "float64": ("d", 4),
+    "string": (None, None),
+}
+
+ORDERS = ("big", "little")
+
+
+class Tag(object):
+    """
+    Definition of a single tag.
+    """
+    __slots__ = ("name", "address", "type", "count", "byteorder", "wordorder", "scale", "group",
+                 "deadband", "deadband_pct")
+
+    def __init__(self, name, address, type, count=None, byteorder="big", wordorder="big", scale=None,
+                 group=None, deadband=None, deadband_pct=None):
+        if type not in TAG_TYPES:
+            raise ValueError("%s: unknown tag type %s" % (name, type))
+        if byteorder not in ORDERS or wordorder not in ORDERS:
+            raise ValueError("%s: byteorder and wordorder must be one of %s" % (name, ORDERS))
+
+        fmt, regs = TAG_TYPES[type]
+        if regs is None:
+            if not count:
+                raise ValueError("%s: string tags need a register count" % name)
+            regs = int(count)
+        elif count is not None and int(count) != regs:
+            raise ValueError("%s: %s is %d registers wide" % (name, type, regs))
+
+        self.name = name
+        self.address = address
+        self.type = type
+        self.count = regs
+        self.byteorder = byteorder
+        self.wordorder = wordorder
+        self.scale = scale
+        self.group = group
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+
+    def __repr__(self):
+        return "Tag(%s, 0x%02x, %s, count=%d)" % (self.name, self.address, self.type, self.count)
+
+
+def parse_tag(name, value):
+    """
+    Parse one "address, type[, key=value ...]" tag definition.
+    """
+    fields = [f.strip() for f in value.split(",")]
+    if len(fields) < 2:
+        raise ValueError("%s: expected 'address, type[, key=value ...]'" % name)
+
+    kwargs = dict()
+    for field in fields[2:]:
+        key, sep, val = field.partition("=")
+        key = key.strip()
+        if not sep or key not in ("count", "byteorder", "wordorder", "scale", "group",
+                                     "deadband", "deadband_pct"):
+            raise ValueError("%s: invalid tag option '%s'" % (name, field))
+        val = val.strip()
+        if key == "count":
+            val = int(val)
+        elif key in ("scale", "deadband", "deadband_pct"):
+            val = float(val)
+        elif key in ("byteorder", "wordorder"):
+            val = val.lower()
+        kwargs[key] = val
+
+    return Tag(name, int(fields[0], 0), fields[1].lower(), **kwargs)
+
+
+def load_tags(cfg, section="tags"):
+    """
+    Read the tag definitions from a config section. Falls back to the
+    legacy *_reg options of the [sensors] section when there is no tags
+    section.
+    """
+    if cfg.has_section(section):
+        return [parse_tag(name, value) for name, value in cfg.items(section)]
+
+    return [
+        Tag("Temperature", int(cfg.get("sensors", "temperature_reg"), 16), "uint16"),
+        Tag("Humidity", int(cfg.get("sensors", "humidity_reg"), 16), "uint16"),
+        Tag("Pressure", int(cfg.get("sensors", "pressure_reg"), 16), "uint16"),
+        Tag("Latitude", int(cfg.get("sensors", "geo_latitude_reg"), 16), "float32"),
+        Tag("Longitude", int(cfg.get("sensors", "geo_longitude_reg"), 16), "float32"),
+        Tag("Key", int(cfg.get("sensors", "key_operation_reg"), 16), "string", count=6),
+    ]
+
+
+def _permutation(count, byteorder, wordorder):
+    """
+    Byte positions, relative to the start of the tag in a big endian packed
+    register buffer, in the order of a big endian value.
+    """
+    words = range(count)
+    if wordorder == "little":
+        words = reversed(words)
+    perm = []
+    for w in words:
+        if byteorder == "little":
+            perm.extend((2 * w + 1, 2 * w))
+        else:
+            perm.extend((2 * w, 2 * w + 1))
+    return tuple(perm)
+
+
+def _string_unpacker(nbytes, byteorder):
+    def unpack(buf, offset):
+        raw = buf[offset:offset + nbytes]
+        if byteorder == "little":
+            raw = "".join(raw[i + 1] + raw[i] for i in xrange(0, nbytes, 2))
+        value = raw.split("\x00")[0]
+        # Raises UnicodeDecodeError, a ValueError, for garbage
+        value.decode("utf-8")
+        return (value,)
+    return unpack
+
+
+def _compile(tag):
+    """
+    Return an unpack(buf, offset) callable returning a 1-tuple for the tag.
+    """
+    if tag.type == "string":
+        return _string_unpacker(tag.count * 2, tag.byteorder)
+
+    fmt = TAG_TYPES[tag.type][0]
+    if tag.byteorder == tag.wordorder or tag.count == 1:
+        # Plain big or little endian values are unpacked straight out of
+        # the register buffer
+        endian = ">" if tag.byteorder == "big" else "<"
+        return struct.Struct(endian + fmt).unpack_from
+
+    st = struct.Struct(">" + fmt)
+    perm = _permutation(tag.count, tag.byteorder, tag.wordorder)
+
+    def unpack(buf, offset):
+        return st.unpack("".join([buf[offset + i] for i in perm]))
+    return unpack
+
+
+class TagMap(object):
+    """
+    Tags compiled into a read plan and per block decode tables.
+    """
+    def __init__(self, tags, max_gap=0, max_count=MAX_READ_COUNT):
+        self.tags = list(tags)
+        by_name = dict((t.name, t) for t in self.tags)
+        if len(by_name) != len(self.tags):
+            raise ValueError("Duplicate tag names in tag map")
+
+        self.plan = plan_reads([(t.name, t.address, t.count) for t in self.tags],
+                               max_gap=max_gap, max_count=max_count)
+
+        # (address, count) of every read
+        self.requests = [(block.address, block.count) for block in self.plan]
+        # One entry per block: [(name, unpack, byte offset, scale, is float)]
+        self.tables = []
+        for block in self.plan:
+            table = []
+            for name, offset, count in block.ranges:
+                tag = by_name[name]
+                scale = tag.scale if tag.scale not in (None, 1) else None
+                table.append((name, _compile(tag), offset * 2, scale, tag.type in ("float32", "float64")))
+            self.tables.append(table)
+
+    def decode_block(self, index, data, out, errors=None):
+        """
+        Decode all tags of plan[index] from its register bytes into out.
+        The names of tags that fail to decode are appended to errors, or
+        raise ValueError without it.
+        """
+        table = self.tables[index]
+        for name, unpack, offset, scale, real in table:
+            try:
+                value = unpack(data, offset)[0]
+            except (struct.error, ValueError):
+                if errors is None:
+                    raise
+                errors.append(name)
+                continue
+            # value - value is NaN, which is true, for NaN and infinities
+            if real and value - value:
+                if errors is None:
+                    raise ValueError("%s: register value is %r" % (name, value))
+                errors.append(name)
+                continue
+            if scale is not None:
+                value = value * scale
+            out[name] = value
+        return out
@@ -0,0 +1,227 @@
+"""
+Compact binary encoding of sample batches for the cloud sink.
+
+A batch is sent column by column instead of as one JSON object per sample:
+
+    header      ">4sBII": magic "MBPK", version, schema id, sample count
+    schema      varint length + JSON list of [column name, type]
+    timestamps  first timestamp as ">q" milliseconds, then zigzag varint deltas
+    columns     per column in schema order: presence bitmap of
+                ceil(count / 8) bytes, then the values of the present rows
+
+Nested samples ({device: {tag: value}}) are flattened to "device/tag"
+columns. Column types are:
+
+    i   integers, zigzag varint deltas from the previous present value.
+        Deltas of any size are fine, varints have no fixed width
+    f   floats that are exact in float32, ">f" each
+    d   other floats, ">d" each
+    b   booleans, one byte each
+    s   strings, varint length + utf-8 bytes
+    j   anything else, varint length + JSON text
+
+The schema id is the crc32 of the schema JSON, so a receiver can cache
+decoders per schema.
+"""
+import json
+import struct
+import zlib
+
+MAGIC = "MBPK"
+VERSION = 1
+CONTENT_TYPE = "application/x-modbus-packed"
+HEADER = struct.Struct(">4sBII")
+TIMESTAMP = struct.Struct(">q")
+FLOAT = struct.Struct(">f")
+DOUBLE = struct.Struct(">d")
+SEPARATOR = "/"
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    # Not (value << 1) ^ (value >> 63): deltas of int64 and uint64 tags need
+    # not fit in 64 bits
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def flatten(sample, prefix="", out=None):
+    """
+    Flatten nested dicts into a single dict with "a/b" keys.
+    """
+    if out is None:
+        out = dict()
+    for key, value in sample.iteritems():
+        if isinstance(value, dict):
+            flatten(value, prefix + key + SEPARATOR, out)
+        else:
+            out[prefix + key] = value
+    return out
+
+
+def unflatten(flat):
+    sample = dict()
+    for key, value in flat.iteritems():
+        parts = key.split(SEPARATOR)
+        node = sample
+        for part in parts[:-1]:
+            node = node.setdefault(part, dict())
+        node[parts[-1]] = value
+    return sample
+
+
+def _column_type(values):
+    types = set(type(v) for v in values)
+    if types == set([bool]):
+        return "b"
+    if types <= set([int, long]):
+        return "i"
+    if types <= set([int, long, float]):
+        try:
+            if all(FLOAT.unpack(FLOAT.pack(v))[0] == v for v in values):
+                return "f"
+        except (OverflowError, struct.error):
+            pass
+        return "d"
+    if types <= set([str, unicode]):
+        return "s"
+    return "j"
+
+
+def _write_bytes(out, data):
+    _write_varint(out, len(data))
+    out.extend(data)
+
+
+def encode_batch(batch):
+    """
+    Encode a list of (timestamp, sample) pairs. Timestamps are seconds since
+    the epoch.
+    """
+    rows = [flatten(sample) for _, sample in batch]
+    count = len(rows)
+    names = sorted(set().union(*rows)) if rows else []
+
+    columns = []
+    schema = []
+    for name in names:
+        present = [row[name] for row in rows if name in row]
+        kind = _column_type(present)
+        schema.append([name, kind])
+        columns.append((name, kind))
+
+    schema_json = json.dumps(schema, separators=(",", ":"))
+    out = bytearray(HEADER.pack(MAGIC, VERSION, zlib.crc32(schema_json) & 0xffffffff, count))
+    _write_bytes(out, schema_json)
+
+    prev = None
+    for ts, _ in batch:
+        ms = int(round(ts * 1000))
+        if prev is None:
+            out.extend(TIMESTAMP.pack(ms))
+        else:
+            _write_varint(out, _zigzag(ms - prev))
+        prev = ms
+
+    nbitmap = (count + 7) // 8
+    for name, kind in columns:
+        bitmap = bytearray(nbitmap)
+        values = bytearray()
+        last = 0
+        for i, row in enumerate(rows):
+            if name not in row:
+                continue
+            bitmap[i >> 3] |= 1 << (i & 7)
+            value = row[name]
+            if kind == "i":
+                _write_varint(values, _zigzag(value - last))
+                last = value
+            elif kind == "f":
+                values.extend(FLOAT.pack(value))
+            elif kind == "d":
+                values.extend(DOUBLE.pack(value))
+            elif kind == "b":
+                values.append(1 if value else 0)
+            elif kind == "s":
+                _write_bytes(values, value.encode("utf-8") if isinstance(value, unicode) else value)
+            else:
+                _write_bytes(values, json.dumps(value))
+        out.extend(bitmap)
+        out.extend(values)
+    return str(out)
+
+
+def decode_batch(data):
+    """
+    Decode a packed batch back into a list of (timestamp, sample) pairs.
+    """
+    magic, version, schema_id, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a packed sample batch")
+    buf = bytearray(data)
+    pos = HEADER.size
+
+    length, pos = _read_varint(buf, pos)
+    schema = json.loads(str(buf[pos:pos + length]))
+    pos += length
+
+    timestamps = []
+    if count:
+        ms = TIMESTAMP.unpack_from(data, pos)[0]
+        pos += TIMESTAMP.size
+        timestamps.append(ms)
+        for _ in range(count - 1):
+            delta, pos = _read_varint(buf, pos)
+            ms += _unzigzag(delta)
+            timestamps.append(ms)
+
+    rows = [dict() for _ in range(count)]
+    nbitmap = (count + 7) // 8
+    for name, kind in schema:
+        bitmap = buf[pos:pos + nbitmap]
+        pos += nbitmap
+        last = 0
+        for i in range(count):
+            if not bitmap[i >> 3] & (1 << (i & 7)):
+                continue
+            if kind == "i":
+                delta, pos = _read_varint(buf, pos)
+                last += _unzigzag(delta)
+                value = last
+            elif kind == "f":
+                value = FLOAT.unpack_from(data, pos)[0]
+                pos += FLOAT.size
+            elif kind == "d":
+                value = DOUBLE.unpack_from(data, pos)[0]
+                pos += DOUBLE.size
+            elif kind == "b":
+                value = bool(buf[pos])
+                pos += 1
+            else:
+                length, pos = _read_varint(buf, pos)
+                value = str(buf[pos:pos + length])
+                pos += length
+                value = json.loads(value) if kind == "j" else value.decode("utf-8")
+            rows[i][name] = value
+
+    return [(ms / 1000.0, unflatten(row)) for ms, row in zip(timestamps, rows)]
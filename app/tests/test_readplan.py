@@ -0,0 +1,60 @@
+"""
+Coalescing of register ranges into block reads.
+
+    cd app && python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from readplan import MAX_READ_COUNT, plan_reads
+
+
+def blocks(plan):
+    return [(block.address, block.count, block.ranges) for block in plan]
+
+
+class PlanReadsTest(unittest.TestCase):
+
+    def test_plans(self):
+        # (ranges, max_gap, max_count, expected blocks)
+        cases = [
+            ([], 0, MAX_READ_COUNT, []),
+            # Adjacent ranges merge
+            ([("a", 0, 2), ("b", 2, 2)], 0, MAX_READ_COUNT,
+             [(0, 4, [("a", 0, 2), ("b", 2, 2)])]),
+            # Order of the configuration does not matter
+            ([("b", 2, 2), ("a", 0, 2)], 0, MAX_READ_COUNT,
+             [(0, 4, [("a", 0, 2), ("b", 2, 2)])]),
+            # A gap of one register splits without max_gap...
+            ([("a", 0, 2), ("b", 3, 1)], 0, MAX_READ_COUNT,
+             [(0, 2, [("a", 0, 2)]), (3, 1, [("b", 0, 1)])]),
+            # ...and is read along with it
+            ([("a", 0, 2), ("b", 3, 1)], 1, MAX_READ_COUNT,
+             [(0, 4, [("a", 0, 2), ("b", 3, 1)])]),
+            # Overlapping and contained ranges share the block
+            ([("a", 0, 4), ("b", 2, 4), ("c", 1, 1)], 0, MAX_READ_COUNT,
+             [(0, 6, [("a", 0, 4), ("c", 1, 1), ("b", 2, 4)])]),
+            # A block never grows beyond max_count
+            ([("a", 0, 2), ("b", 2, 2), ("c", 4, 2)], 0, 4,
+             [(0, 4, [("a", 0, 2), ("b", 2, 2)]), (4, 2, [("c", 0, 2)])]),
+            ([("a", 0, 100), ("b", 100, 25), ("c", 125, 1)], 0, MAX_READ_COUNT,
+             [(0, 125, [("a", 0, 100), ("b", 100, 25)]), (125, 1, [("c", 0, 1)])]),
+        ]
+        for ranges, max_gap, max_count, expected in cases:
+            self.assertEqual(blocks(plan_reads(ranges, max_gap, max_count)), expected,
+                             (ranges, max_gap, max_count))
+
+    def test_invalid(self):
+        for ranges, max_gap, max_count in [
+                ([("a", 0, 0)], 0, MAX_READ_COUNT),
+                ([("a", 0, 5)], 0, 4),
+                ([("a", 0, 1)], -1, MAX_READ_COUNT),
+                ([("a", 0, 1)], 0, 0),
+                ([("a", 0, 1)], 0, MAX_READ_COUNT + 1)]:
+            self.assertRaises(ValueError, plan_reads, ranges, max_gap, max_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Deadbands, heartbeats and keyframes of report by exception.
+
+    cd app && python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import unittest
+from ConfigParser import SafeConfigParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from report import ReportFilter, load_report
+from tagmap import Tag
+
+
+class ReportFilterTest(unittest.TestCase):
+
+    def run_steps(self, tags, kwargs, steps):
+        report = ReportFilter(tags, **kwargs)
+        for now, values, expected in steps:
+            self.assertEqual(report.update(values, now), expected, (kwargs, now, values))
+
+    def test_steps(self):
+        t = [Tag("t", 0, "float32")]
+        long_intervals = dict(heartbeat=1000, keyframe=10000)
+        # (tags, ReportFilter arguments, [(now, values, expected changes)])
+        cases = [
+            # Without a deadband every change is reported
+            (t, long_intervals, [
+                (0, {"t": 1.0}, {"t": 1.0}),
+                (1, {"t": 1.0}, {}),
+                (2, {"t": 1.001}, {"t": 1.001}),
+            ]),
+            # Absolute deadband, measured from the last reported value
+            (t, dict(long_intervals, deadband=0.5), [
+                (0, {"t": 10.0}, {"t": 10.0}),
+                (1, {"t": 10.4}, {}),
+                (2, {"t": 10.5}, {}),
+                (3, {"t": 10.6}, {"t": 10.6}),
+                (4, {"t": 10.2}, {}),
+                (5, {"t": 10.0}, {"t": 10.0}),
+                (6, {"t": 10.49}, {}),
+                (7, {"t": 9.5}, {}),
+            ]),
+            # Relative deadband, percent of the last reported value
+            (t, dict(long_intervals, deadband_pct=10), [
+                (0, {"t": 100.0}, {"t": 100.0}),
+                (1, {"t": 109.0}, {}),
+                (2, {"t": 89.0}, {"t": 89.0}),
+                (3, {"t": 97.0}, {}),
+                (4, {"t": 98.0}, {"t": 98.0}),
+            ]),
+            # Tag options override the [report] defaults
+            ([Tag("t", 0, "float32", deadband=5), Tag("u", 2, "float32")], dict(long_intervals, deadband=0.5), [
+                (0, {"t": 0.0, "u": 0.0}, {"t": 0.0, "u": 0.0}),
+                (1, {"t": 4.0, "u": 0.6}, {"u": 0.6}),
+                (2, {"t": 6.0, "u": 0.6}, {"t": 6.0}),
+            ]),
+            # Strings and booleans ignore deadbands
+            ([Tag("s", 0, "string", count=2), Tag("t", 2, "uint16")], dict(long_intervals, deadband=100), [
+                (0, {"s": "a", "t": True}, {"s": "a", "t": True}),
+                (1, {"s": "b", "t": False}, {"s": "b", "t": False}),
+            ]),
+            # A silent tag is sent again after heartbeat seconds
+            (t, dict(deadband=1, heartbeat=10, keyframe=10000), [
+                (0, {"t": 1.0}, {"t": 1.0}),
+                (9, {"t": 1.5}, {}),
+                (10, {"t": 1.5}, {"t": 1.5}),
+                (15, {"t": 1.5}, {}),
+                (20, {"t": 1.5}, {"t": 1.5}),
+            ]),
+            # Keyframes send every tag
+            (t + [Tag("u", 2, "float32")], dict(heartbeat=1000, keyframe=30), [
+                (0, {"t": 1.0, "u": 2.0}, {"t": 1.0, "u": 2.0}),
+                (10, {"t": 1.0, "u": 3.0}, {"u": 3.0}),
+                (30, {"t": 1.0, "u": 3.0}, {"t": 1.0, "u": 3.0}),
+                (31, {"t": 1.0, "u": 3.0}, {}),
+            ]),
+            # A tag seen for the first time is always reported
+            (t + [Tag("u", 2, "float32")], dict(long_intervals, deadband=100), [
+                (0, {"t": 1.0}, {"t": 1.0}),
+                (1, {"t": 1.0, "u": 5.0}, {"u": 5.0}),
+            ]),
+        ]
+        for tags, kwargs, steps in cases:
+            self.run_steps(tags, kwargs, steps)
+
+
+class LoadReportTest(unittest.TestCase):
+
+    def load(self, text):
+        cfg = SafeConfigParser()
+        cfg.readfp(io.BytesIO(text))
+        return load_report(cfg)
+
+    def test_load(self):
+        self.assertEqual(self.load(""), None)
+        self.assertEqual(self.load("[report]\ndeadband: 1\n"), None)
+        self.assertEqual(self.load("[report]\nenabled: no\n"), None)
+        self.assertEqual(self.load("[report]\nenabled: yes\ndeadband: 1\nkeyframe: 60\n"),
+                         {"deadband": 1.0, "keyframe": 60.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
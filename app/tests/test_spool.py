@@ -0,0 +1,126 @@
+"""
+Durability of the store and forward spool.
+
+    cd app && python -m unittest discover tests
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from spool import RECORD_HEADER, SEGMENT_SUFFIX, Spool
+
+logging.getLogger("modbusapp").addHandler(logging.NullHandler())
+
+
+def records(start, count, size=20):
+    return ["%0*d" % (size, i) for i in range(start, start + count)]
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def segments(self):
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def replay(self, spool):
+        result = []
+        while True:
+            batch = spool.read(7)
+            if not batch:
+                return result
+            result.extend(batch)
+            spool.ack()
+
+    def test_reopen_after_crash(self):
+        # Small segments so that the records span several of them
+        spool = Spool(self.directory, segment_size=100)
+        spool.append(records(0, 20))
+        self.assertEqual(spool.read(5), records(0, 5))
+        spool.ack()
+        spool.sync()
+        # A crash: nothing is closed, the next process opens the directory
+        spool = Spool(self.directory, segment_size=100)
+        self.assertTrue(spool.pending)
+        spool.append(records(20, 5))
+        self.assertEqual(self.replay(spool), records(5, 20))
+        self.assertFalse(spool.pending)
+        spool.close()
+
+        spool = Spool(self.directory, segment_size=100)
+        self.assertFalse(spool.pending)
+        self.assertEqual(spool.read(10), [])
+        spool.close()
+
+    def test_unacked_records_are_read_again(self):
+        spool = Spool(self.directory)
+        spool.append(records(0, 3))
+        self.assertEqual(spool.read(10), records(0, 3))
+        self.assertEqual(spool.read(10), records(0, 3))
+        spool.close()
+        spool = Spool(self.directory)
+        self.assertEqual(self.replay(spool), records(0, 3))
+        spool.close()
+
+    def test_truncated_tail_is_skipped(self):
+        spool = Spool(self.directory)
+        spool.append(records(0, 3))
+        spool.close()
+        path = self.segments()[-1]
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 5)
+        spool = Spool(self.directory)
+        spool.append(records(3, 2))
+        self.assertEqual(self.replay(spool), records(0, 2) + records(3, 2))
+        spool.close()
+
+    def test_corrupted_record_is_skipped(self):
+        spool = Spool(self.directory)
+        spool.append(records(0, 3))
+        spool.close()
+        path = self.segments()[-1]
+        # Flip a byte of the data of the second record
+        with open(path, "r+b") as f:
+            f.seek(2 * RECORD_HEADER.size + 20 + 3)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(chr(ord(byte) ^ 0xff))
+        spool = Spool(self.directory)
+        spool.append(records(3, 1))
+        # The rest of the corrupt segment is lost, later segments are not
+        self.assertEqual(self.replay(spool), records(0, 1) + records(3, 1))
+        spool.close()
+
+    def test_eviction_at_max_size(self):
+        record_size = RECORD_HEADER.size + 20
+        spool = Spool(self.directory, segment_size=10 * record_size, max_size=30 * record_size)
+        spool.append(records(0, 100))
+        self.assertLessEqual(spool.size, 30 * record_size)
+        self.assertEqual(spool.evicted, 70 * record_size)
+        # The newest records survive, in order
+        self.assertEqual(self.replay(spool), records(70, 30))
+        spool.close()
+
+    def test_eviction_moves_the_cursor(self):
+        record_size = RECORD_HEADER.size + 20
+        spool = Spool(self.directory, segment_size=10 * record_size, max_size=20 * record_size)
+        spool.append(records(0, 10))
+        self.assertEqual(spool.read(5), records(0, 5))
+        spool.append(records(10, 20))
+        # The records read before the eviction are gone, ack is a no-op
+        spool.ack()
+        self.assertEqual(self.replay(spool), records(10, 20))
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Parsing and decoding of tag maps.
+
+    cd app && python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from tagmap import Tag, TagMap, parse_tag
+
+
+def decode(tag, registers):
+    """
+    Decode the register bytes of a single tag. Returns (values, errors).
+    """
+    tagmap = TagMap([tag])
+    values, errors = dict(), []
+    tagmap.decode_block(0, registers, values, errors)
+    return values, errors
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_values(self):
+        # (type, byteorder, wordorder, register bytes, expected value)
+        cases = [
+            ("uint16", "big", "big", "\x01\x02", 0x0102),
+            ("uint16", "little", "big", "\x01\x02", 0x0201),
+            ("int16", "big", "big", "\xff\xfe", -2),
+            ("int16", "little", "little", "\xfe\xff", -2),
+            ("uint32", "big", "big", "\x01\x02\x03\x04", 0x01020304),
+            ("uint32", "big", "little", "\x03\x04\x01\x02", 0x01020304),
+            ("uint32", "little", "big", "\x02\x01\x04\x03", 0x01020304),
+            ("uint32", "little", "little", "\x04\x03\x02\x01", 0x01020304),
+            ("int32", "big", "little", "\xff\xfe\xff\xff", -2),
+            ("float32", "big", "big", "\x3f\xc0\x00\x00", 1.5),
+            ("float32", "big", "little", "\x00\x00\x3f\xc0", 1.5),
+            ("float32", "little", "big", "\xc0\x3f\x00\x00", 1.5),
+            ("float32", "little", "little", "\x00\x00\xc0\x3f", 1.5),
+            ("uint64", "big", "big", "\xff" * 8, (1 << 64) - 1),
+            ("int64", "big", "big", "\x80" + "\x00" * 7, -(1 << 63)),
+            ("float64", "big", "little", "\x00\x00\x00\x00\x00\x00\x3f\xf8", 1.5),
+            ("float64", "little", "big", "\xf8\x3f" + "\x00" * 6, 1.5),
+        ]
+        for type, byteorder, wordorder, registers, expected in cases:
+            tag = Tag("t", 0, type, byteorder=byteorder, wordorder=wordorder)
+            self.assertEqual(decode(tag, registers), ({"t": expected}, []),
+                             (type, byteorder, wordorder))
+
+    def test_scale(self):
+        values, _ = decode(Tag("t", 0, "uint16", scale=0.1), "\x00\xfa")
+        self.assertAlmostEqual(values["t"], 25.0)
+
+    def test_strings(self):
+        # (byteorder, register bytes, expected value)
+        cases = [
+            ("big", "AB\x00\x00", "AB"),
+            ("little", "BA\x00\x00", "AB"),
+            ("big", "ABCD", "ABCD"),
+            ("big", "\xc3\xa9\x00\x00", "\xc3\xa9"),
+        ]
+        for byteorder, registers, expected in cases:
+            tag = Tag("t", 0, "string", count=2, byteorder=byteorder)
+            self.assertEqual(decode(tag, registers), ({"t": expected}, []), registers)
+
+    def test_decode_errors(self):
+        # (tag, register bytes) that hold no valid value
+        cases = [
+            (Tag("t", 0, "float32"), "\x7f\xc0\x00\x00"),
+            (Tag("t", 0, "float32"), "\x7f\x80\x00\x00"),
+            (Tag("t", 0, "float32"), "\xff\x80\x00\x00"),
+            (Tag("t", 0, "float32", wordorder="little"), "\x00\x00\x7f\xc0"),
+            (Tag("t", 0, "float64"), "\x7f\xf0" + "\x00" * 6),
+            (Tag("t", 0, "string", count=2), "\xff\xfe\x00\x00"),
+        ]
+        for tag, registers in cases:
+            self.assertEqual(decode(tag, registers), ({}, ["t"]), registers)
+            self.assertRaises(ValueError, TagMap([tag]).decode_block, 0, registers, dict())
+
+    def test_errors_leave_other_tags(self):
+        tagmap = TagMap([Tag("a", 0, "uint16"), Tag("b", 1, "float32"), Tag("c", 3, "uint16")])
+        values, errors = dict(), []
+        tagmap.decode_block(0, "\x00\x01\x7f\xc0\x00\x00\x00\x02", values, errors)
+        self.assertEqual((values, errors), ({"a": 1, "c": 2}, ["b"]))
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse(self):
+        tag = parse_tag("Latitude", "0x04, Float32, wordorder=Little, scale=2, group=geo, deadband=0.5")
+        self.assertEqual((tag.address, tag.type, tag.count, tag.byteorder, tag.wordorder, tag.scale,
+                          tag.group, tag.deadband),
+                         (4, "float32", 2, "big", "little", 2.0, "geo", 0.5))
+        self.assertEqual(parse_tag("Key", "8, string, count=6").count, 6)
+
+    def test_invalid(self):
+        for value in ["0x01",
+                      "0x01, uint24",
+                      "0x01, uint16, count=2",
+                      "0x01, string",
+                      "0x01, uint16, wordorder=middle",
+                      "0x01, uint16, colour=red",
+                      "0x01, uint16, scale"]:
+            self.assertRaises(ValueError, parse_tag, "t", value)
+
+    def test_duplicate_names(self):
+        self.assertRaises(ValueError, TagMap, [Tag("t", 0, "uint16"), Tag("t", 1, "uint16")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Round trips of the packed wire format.
+
+    cd app && python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import wireformat
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+UINT64_MAX = (1 << 64) - 1
+
+
+class WireFormatTest(unittest.TestCase):
+
+    def roundtrip(self, values):
+        batch = [(1500000000.0 + i, {"tag": value}) for i, value in enumerate(values)]
+        decoded = wireformat.decode_batch(wireformat.encode_batch(batch))
+        self.assertEqual([sample["tag"] for _, sample in decoded], values)
+
+    def test_int64_extremes(self):
+        self.roundtrip([INT64_MIN, INT64_MAX, INT64_MIN, 0, INT64_MAX])
+        self.roundtrip([-(1 << 62) - 5, (1 << 62) + 5])
+
+    def test_uint64_extremes(self):
+        self.roundtrip([0, UINT64_MAX, 0, UINT64_MAX - 1, 1])
+
+    def test_mixed_columns(self):
+        batch = [(1500000000.25, {"dev1": {"a": 1, "s": u"x\xe9"}, "f": 0.5}),
+                 (1500000001.5, {"dev1": {"a": -3, "b": True}, "f": 0.1, "j": [1, 2]})]
+        self.assertEqual(wireformat.decode_batch(wireformat.encode_batch(batch)), batch)
+
+
+if __name__ == "__main__":
+    unittest.main()
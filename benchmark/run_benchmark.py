@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+End to end benchmark of the pipeline: load simulator -> modbus app -> cloud
+endpoint, all on loopback ports.
+
+For every combination of the swept device counts, tag counts and poll rates
+it starts modbus_simulator/load_simulator.py, cloud/cloudendpoint.py and
+app/src/main.py with a generated config, lets them warm up, and measures
+over a fixed window:
+
+    polls_per_sec               samples published by the app (/data X-Sequence)
+    modbus_requests_per_poll    simulator requests per published sample
+    samples_ingested_per_sec    samples received by the cloud endpoint
+    latency_s                   p50/p90/p99/max from sample timestamp to
+                                arrival at the cloud endpoint
+    processes                   CPU % and RSS of each of the three processes
+    app_errors, app_missed      ERROR and missed deadline lines in the app log
+
+The cloud sink uses the packed encoding, which carries the sample
+timestamps the latency is computed from. Report by exception and
+aggregation are disabled so that every poll reaches the endpoint.
+
+    python run_benchmark.py --devices 1,10,100 --tags 10,100 --poll-hz 1,5 \\
+        --output results.json
+    python run_benchmark.py ... --compare results.json
+
+Results are written as JSON. With --compare, the runs are matched to those
+of an earlier result file by devices, tags and poll rate and the changes
+are printed. Needs Linux (/proc) and numpy for the simulator.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from ConfigParser import SafeConfigParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIMULATOR = os.path.join(ROOT, "modbus_simulator", "load_simulator.py")
+APP = os.path.join(ROOT, "app", "src", "main.py")
+ENDPOINT = os.path.join(ROOT, "cloud", "cloudendpoint.py")
+BASE_CONFIG = os.path.join(ROOT, "app", "project", "package_config.ini")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Nothing listening on port %d after %ds" % (port, timeout))
+
+
+def cpu_seconds(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        # The command name may contain spaces, the fields after it do not
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+
+def memory_kb(pid):
+    result = dict()
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":")
+                result[key] = int(value.split()[0])
+    return result.get("VmRSS"), result.get("VmHWM")
+
+
+def simulator_stats(port):
+    conn = socket.create_connection(("127.0.0.1", port), 5)
+    try:
+        conn.sendall("stats\n")
+        reply = conn.makefile().readline().split()
+    finally:
+        conn.close()
+    return dict((key, int(value)) for key, _, value in (w.partition("=") for w in reply[1:]))
+
+
+def app_sequence(port):
+    context = ssl._create_unverified_context() if hasattr(ssl, "_create_unverified_context") else None
+    kwargs = dict(context=context) if context else dict()
+    response = urllib2.urlopen("https://127.0.0.1:%d/data" % port, timeout=10, **kwargs)
+    response.read()
+    return int(response.info().getheader("X-Sequence"))
+
+
+def endpoint_stats(port, reset=False):
+    url = "http://127.0.0.1:%d/stats%s" % (port, "?reset=1" if reset else "")
+    return json.load(urllib2.urlopen(url, timeout=10))
+
+
+def write_app_config(path, args, devices, tags, poll_hz, ports):
+    cfg = SafeConfigParser()
+    cfg.optionxform = str
+    cfg.read(BASE_CONFIG)
+    for section in list(cfg.sections()):
+        if section == "tags" or section.startswith("device:"):
+            cfg.remove_section(section)
+
+    cfg.add_section("tags")
+    for i in range(tags):
+        cfg.set("tags", "tag%d" % i, "%d, float32" % (2 * i))
+    for d in range(devices):
+        section = "device:dev%d" % d
+        cfg.add_section(section)
+        cfg.set(section, "server", "127.0.0.1")
+        cfg.set(section, "port", str(ports["simulator"] + d // args.units_per_port))
+        cfg.set(section, "unit", str(d % args.units_per_port + 1))
+        cfg.set(section, "poll_frequency", repr(1.0 / poll_hz))
+
+    settings = {
+        "collector": dict(workers=args.workers, max_inflight=args.max_inflight, pipeline=args.pipeline),
+        "server": dict(port=ports["app"]),
+        "dweet": dict(enabled="no"),
+        "report": dict(enabled="no"),
+        "aggregate": dict(enabled="no"),
+        "cloud": dict(enabled="yes", server="127.0.0.1", port=ports["endpoint"], url="/?collector=bench",
+                      scheme="http", method="POST", encoding="packed", compression="none", spool="no",
+                      batch_size=args.batch_size, batch_interval_ms=args.batch_interval_ms),
+        "logging": dict(log_level=30, console="no"),
+    }
+    for section, options in settings.items():
+        if not cfg.has_section(section):
+            cfg.add_section(section)
+        for key, value in options.items():
+            cfg.set(section, key, str(value))
+    with open(path, "w") as f:
+        cfg.write(f)
+
+
+class Process(object):
+    def __init__(self, name, argv, env, workdir):
+        self.name = name
+        self.log = open(os.path.join(workdir, "%s.out" % name), "w")
+        full_env = dict(os.environ)
+        full_env.update(env)
+        self.popen = subprocess.Popen(argv, env=full_env, stdout=self.log, stderr=subprocess.STDOUT,
+                                      cwd=os.path.dirname(argv[1]))
+
+    @property
+    def pid(self):
+        return self.popen.pid
+
+    def check(self):
+        if self.popen.poll() is not None:
+            raise RuntimeError("%s exited with status %s, see %s" % (self.name, self.popen.returncode, self.log.name))
+
+    def stop(self):
+        if self.popen.poll() is None:
+            self.popen.terminate()
+            deadline = time.time() + 5
+            while self.popen.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.popen.poll() is None:
+                self.popen.kill()
+                self.popen.wait()
+        self.log.close()
+
+
+def run_one(args, devices, tags, poll_hz):
+    workdir = tempfile.mkdtemp(prefix="modbus-bench-")
+    nports = (devices + args.units_per_port - 1) // args.units_per_port
+    ports = dict(simulator=args.base_port, control=free_port(), app=free_port(), endpoint=free_port())
+    config = os.path.join(workdir, "package_config.ini")
+    write_app_config(config, args, devices, tags, poll_hz, ports)
+
+    python = sys.executable
+    processes = []
+    try:
+        simulator = Process("simulator", [python, SIMULATOR, "--generate", str(tags), "--host", "127.0.0.1",
+                                          "--base-port", str(ports["simulator"]), "--ports", str(nports),
+                                          "--units", str(args.units_per_port), "--rate", str(args.update_hz),
+                                          "--control-port", str(ports["control"])], {}, workdir)
+        processes.append(simulator)
+        endpoint = Process("endpoint", [python, ENDPOINT],
+                           dict(CLOUD_PORT=str(ports["endpoint"]), CLOUD_DATA_DIR=os.path.join(workdir, "cloud")),
+                           workdir)
+        processes.append(endpoint)
+        wait_for_port(ports["control"])
+        wait_for_port(ports["endpoint"])
+        app = Process("app", [python, APP], dict(CAF_APP_CONFIG_FILE=config, CAF_APP_DATA_DIR=workdir,
+                                                 CAF_APP_LOG_DIR=workdir), workdir)
+        processes.append(app)
+        wait_for_port(ports["app"])
+
+        time.sleep(args.warmup)
+        for p in processes:
+            p.check()
+        t0 = time.time()
+        seq0 = app_sequence(ports["app"])
+        sim0 = simulator_stats(ports["control"])
+        cloud0 = endpoint_stats(ports["endpoint"], reset=True)
+        cpu0 = dict((p.name, cpu_seconds(p.pid)) for p in processes)
+
+        time.sleep(args.duration)
+        for p in processes:
+            p.check()
+        elapsed = time.time() - t0
+        seq1 = app_sequence(ports["app"])
+        sim1 = simulator_stats(ports["control"])
+        cloud1 = endpoint_stats(ports["endpoint"])
+        usage = dict()
+        for p in processes:
+            rss, peak = memory_kb(p.pid)
+            usage[p.name] = dict(cpu_percent=round(100 * (cpu_seconds(p.pid) - cpu0[p.name]) / elapsed, 1),
+                                 rss_kb=rss, peak_rss_kb=peak)
+    finally:
+        for p in reversed(processes):
+            p.stop()
+
+    errors = missed = 0
+    log_file = os.path.join(workdir, "modbus_app.log")
+    if os.path.exists(log_file):
+        with open(log_file) as f:
+            for line in f:
+                if "ERROR" in line:
+                    errors += 1
+                if "missed" in line:
+                    missed += 1
+    if args.keep:
+        print "  files kept in %s" % workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    polls = seq1 - seq0
+    return dict(
+        devices=devices, tags=tags, poll_hz=poll_hz, duration_s=round(elapsed, 2),
+        expected_polls_per_sec=devices * poll_hz,
+        polls_per_sec=round(polls / elapsed, 2),
+        modbus_requests_per_poll=round((sim1["requests"] - sim0["requests"]) / float(polls), 2) if polls else None,
+        samples_ingested_per_sec=round((cloud1["samples"] - cloud0["samples"]) / elapsed, 2),
+        latency_s=cloud1["delay"],
+        processes=usage,
+        app_errors=errors,
+        app_missed=missed,
+    )
+
+
+def compare(results, baseline, baseline_file):
+    previous = dict(((r["devices"], r["tags"], r["poll_hz"]), r) for r in baseline["runs"])
+    print "\nChange against %s:" % baseline_file
+
+    def change(new, old):
+        if new is None or not old:
+            return "      n/a"
+        return "%+8.1f%%" % (100.0 * (new - old) / old)
+
+    for run in results["runs"]:
+        old = previous.get((run["devices"], run["tags"], run["poll_hz"]))
+        if old is None:
+            continue
+        print "  devices=%-5d tags=%-5d poll_hz=%-5g polls/s %s  p99 latency %s  app cpu %s  app rss %s" % (
+            run["devices"], run["tags"], run["poll_hz"],
+            change(run["polls_per_sec"], old["polls_per_sec"]),
+            change(run["latency_s"].get("p99"), old["latency_s"].get("p99")),
+            change(run["processes"]["app"]["cpu_percent"], old["processes"]["app"]["cpu_percent"]),
+            change(run["processes"]["app"]["rss_kb"], old["processes"]["app"]["rss_kb"]))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmark of the modbus pipeline")
+    parser.add_argument("--devices", type=int_list, default=[1, 10], help="device counts to sweep")
+    parser.add_argument("--tags", type=int_list, default=[10], help="float32 tags per device to sweep")
+    parser.add_argument("--poll-hz", type=float_list, default=[1.0], help="polls per second per device to sweep")
+    parser.add_argument("--units-per-port", type=int, default=10)
+    parser.add_argument("--update-hz", type=float, default=1.0, help="simulator value updates per second")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-inflight", type=int, default=1)
+    parser.add_argument("--pipeline", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-interval-ms", type=int, default=200)
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to measure")
+    parser.add_argument("--base-port", type=int, default=15020, help="first simulator port")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="FILE", help="earlier result file to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the config and log files of each run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        # Read before running, the output may overwrite it
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    settings = dict((k, v) for k, v in vars(args).items() if k not in ("output", "compare", "keep"))
+    results = dict(started=time.strftime("%Y-%m-%dT%H:%M:%S"), host=platform.node(),
+                   python=platform.python_version(), settings=settings, runs=[])
+    for devices, tags, poll_hz in itertools.product(args.devices, args.tags, args.poll_hz):
+        print "devices=%d tags=%d poll_hz=%g" % (devices, tags, poll_hz)
+        run = run_one(args, devices, tags, poll_hz)
+        results["runs"].append(run)
+        print "  %.1f polls/s (of %g), %s requests/poll, p99 latency %s s, app cpu %.1f%%, rss %s kB" % (
+            run["polls_per_sec"], run["expected_polls_per_sec"], run["modbus_requests_per_poll"],
+            run["latency_s"].get("p99"), run["processes"]["app"]["cpu_percent"], run["processes"]["app"]["rss_kb"])
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    print "Results written to %s" % args.output
+    if baseline is not None:
+        compare(results, baseline, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,51 @@
 import os
 import sys, errno
+import collections
 import json
+import socket
 import threading
 import time
 import ssl
-from wsgiref.simple_server import make_server
+import zlib
+from wsgiref.simple_server import make_server, WSGIServer
+from SocketServer import ThreadingMixIn
 from cgi import parse_qs, escape
 
+from columnstore import ColumnStore
+
+# The packed wire format is decoded with the encoder's own module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "src"))
+import wireformat
+
 
 moduledir = os.path.abspath(os.path.dirname(__file__))
 BASEDIR = os.getenv("CAF_APP_PATH", moduledir)
+# Where the column store keeps its chunk files
+DATADIR = os.getenv("CLOUD_DATA_DIR", os.path.join(moduledir, "data"))
+# "threaded" serves every connection on its own thread, "single" one
+# request at a time
+SERVER_MODE = os.getenv("CLOUD_SERVER_MODE", "threaded")
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
 
 
 class HTTPServerThread(threading.Thread):
     """
     Open a HTTP/TCP Port and spit out json response.
     """
-    def __init__(self, ipaddress, port, app):
+    def __init__(self, ipaddress, port, app, mode="threaded"):
         super(HTTPServerThread, self).__init__()
         self.ipaddress = ipaddress
         self.port = port
         self.name = "HTTPServerThread-%s" % self.ipaddress
         self.setDaemon(True)
         self.stop_event = threading.Event()
-        self.httpd = make_server(self.ipaddress, self.port, app)
+        if mode == "threaded":
+            self.httpd = make_server(self.ipaddress, self.port, app, server_class=ThreadingWSGIServer)
+        else:
+            self.httpd = make_server(self.ipaddress, self.port, app)
         cert = os.path.join(BASEDIR, "ssl.crt")
         key = os.path.join(BASEDIR, "ssl.key")
 
@@ -50,6 +72,150 @@ class HTTPServerThread(threading.Thread):
 
 
 DATA = {}
+DATA_LOCK = threading.Lock()
+# Serialized JSON of DATA and of its sub-resources by path, dropped on every
+# write, so that dashboards polling the same values share one json.dumps
+DATA_CACHE = {}
+STORE = None
+
+# Ingest counters for GET /stats. Delays are the time from the sample
+# timestamp to its arrival, only known for packed batches.
+STATS = {"samples": 0, "batches": 0}
+DELAYS = collections.deque(maxlen=100000)
+STATS_LOCK = threading.Lock()
+
+# Packed sample batches as sent by the modbus app with "encoding: packed"
+PACKED_CONTENT_TYPE = wireformat.CONTENT_TYPE
+
+
+def decode_body(environ, body):
+    """
+    Return the list of (timestamp, sample) pairs posted in a request body.
+    JSON samples without a "_time" get the time of arrival.
+    """
+    encoding = environ.get('HTTP_CONTENT_ENCODING', '').lower()
+    if encoding == 'deflate':
+        body = zlib.decompress(body)
+    elif encoding == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+    if environ.get('CONTENT_TYPE', '').startswith(PACKED_CONTENT_TYPE):
+        samples = wireformat.decode_batch(body)
+    else:
+        now = time.time()
+        payload = json.loads(body)  # turns the qs to a dict
+        # Batches of samples are posted as a JSON array
+        if not isinstance(payload, list):
+            payload = [payload]
+        samples = [(now, sample) for sample in payload]
+    # The collector sends the time of the poll along
+    return [(sample.pop("_time", ts), sample) for ts, sample in samples]
+
+
+def merge_latest(data, sample):
+    """
+    Merge a sample, which may only hold the values that changed, into the
+    latest data. "_quality" lists all tags that are not good, so it replaces
+    the previous one, and a sample without it means they all are.
+    """
+    for key, value in sample.iteritems():
+        if isinstance(value, dict) and key != "_quality":
+            if not isinstance(data.get(key), dict):
+                data[key] = dict()
+            merge_latest(data[key], value)
+        else:
+            data[key] = value
+    if "_quality" not in sample:
+        data.pop("_quality", None)
+
+
+def numeric_columns(sample, prefix="", out=None):
+    """
+    Flatten a sample to {"tag": float} or {"device/tag": float}, leaving
+    out values that are not numbers and the "_" prefixed sample metadata
+    such as "_latency_ms".
+    """
+    if out is None:
+        out = dict()
+    for key, value in sample.iteritems():
+        if key.startswith("_"):
+            continue
+        if isinstance(value, dict):
+            numeric_columns(value, prefix + key + "/", out)
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            out[prefix + key] = float(value)
+    return out
+
+
+def query_app(environ, start_response):
+    """
+    GET /devices    {collector: [tag, ...]} of the stored samples
+    GET /query?device=<collector>&tag=<tag>[&start=<t>][&end=<t>]
+                    the stored [timestamp, value] pairs of a tag
+    """
+    d = parse_qs(environ['QUERY_STRING'])
+    headers = [('Content-type', 'application/json')]
+    if environ.get('PATH_INFO') == '/devices':
+        start_response('200 OK', headers)
+        return [json.dumps(STORE.tags())]
+
+    try:
+        device = d['device'][0]
+        tag = d['tag'][0]
+        start = float(d['start'][0]) if 'start' in d else None
+        end = float(d['end'][0]) if 'end' in d else None
+    except (KeyError, ValueError):
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return ['device and tag are required, start and end must be numbers']
+    points = STORE.query(device, tag, start, end)
+    if points is None:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Unknown device %s' % device]
+    start_response('200 OK', headers)
+    return [json.dumps({"device": device, "tag": tag, "points": points})]
+
+
+def stats_app(environ, start_response):
+    """
+    GET /stats[?reset=1]    samples and batches received, and percentiles of
+                            the delay of packed samples in seconds
+    """
+    d = parse_qs(environ['QUERY_STRING'])
+    with STATS_LOCK:
+        stats = dict(STATS)
+        delays = sorted(DELAYS)
+        if d.get('reset', ['0'])[0] == '1':
+            DELAYS.clear()
+    stats["delay"] = {"count": len(delays)}
+    if delays:
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            stats["delay"][name] = delays[min(len(delays) - 1, int(q * len(delays)))]
+        stats["delay"]["max"] = delays[-1]
+    start_response('200 OK', [('Content-type', 'application/json')])
+    return [json.dumps(stats)]
+
+
+def latest_json(path):
+    """
+    Return the serialized latest values for a GET path: all of them for /,
+    a part of them for /latest/<key>[/<key>...], e.g. /latest/plc1 for one
+    device of a multi device collector. None if there is no such value.
+    """
+    if not path.startswith('/latest/'):
+        path = '/'
+    with DATA_LOCK:
+        body = DATA_CACHE.get(path)
+        if body is not None:
+            return body
+        value = DATA
+        if path != '/':
+            for key in path[len('/latest/'):].strip('/').split('/'):
+                if not isinstance(value, dict) or key not in value:
+                    return None
+                value = value[key]
+        body = DATA_CACHE[path] = json.dumps(value)
+        return body
+
 
 def simple_app(environ, start_response):
     global DATA
@@ -64,10 +230,25 @@ def simple_app(environ, start_response):
             headers = [('Content-Type', 'text/plain')]
             request_body_size = int(environ.get('CONTENT_LENGTH', 0))
             request_body = environ['wsgi.input'].read(request_body_size)
-            payload = json.loads(request_body)  # turns the qs to a dict
-            msg = 'From POST: %s' % str(payload)
-            print msg 
-            DATA.update(payload)
+            payload = decode_body(environ, request_body)
+            msg = 'Received %d samples' % len(payload)
+            # Samples are stored per collector, named by the collector
+            # query parameter of the upload URL or the client address
+            d = parse_qs(environ['QUERY_STRING'])
+            device = d.get('collector', [environ.get('REMOTE_ADDR', 'unknown')])[0]
+            rows = [(ts, numeric_columns(sample)) for ts, sample in payload]
+            STORE.append(device, [(ts, columns) for ts, columns in rows if columns])
+            now = time.time()
+            with STATS_LOCK:
+                STATS["samples"] += len(payload)
+                STATS["batches"] += 1
+                if environ.get('CONTENT_TYPE', '').startswith(PACKED_CONTENT_TYPE):
+                    DELAYS.extend(now - ts for ts, _ in payload)
+            # Samples only hold the values that changed since the last one
+            with DATA_LOCK:
+                for _, sample in payload:
+                    merge_latest(DATA, sample)
+                DATA_CACHE.clear()
         except Exception as ex:
             status = '500 OOPS'
             headers = [('Content-Type', 'text/plain')]
@@ -76,7 +257,7 @@ def simple_app(environ, start_response):
         finally:
             try:
                 start_response(status, headers)
-                return msg
+                return [msg]
             except socket.error, e:
                 print "socket error"
             except IOError, e:
@@ -85,32 +266,43 @@ def simple_app(environ, start_response):
                 else:
                     print "IO error"
 
+    elif environ.get('PATH_INFO') in ('/query', '/devices'):
+        return query_app(environ, start_response)
+
+    elif environ.get('PATH_INFO') == '/stats':
+        return stats_app(environ, start_response)
+
     else:  # GET
         status = '200 OK'
         d = parse_qs(environ['QUERY_STRING'])
-        cb = d.get('callback','')[0]
+        cb = d.get('callback', [''])[0]
         headers = [('Content-type', 'application/json')]
-        ret = json.dumps(DATA)
-        rval = "%s(%s)" % (cb, ret)
+        ret = latest_json(environ.get('PATH_INFO', '/'))
+        if ret is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['No such value']
+        rval = "%s(%s)" % (cb, ret) if cb else ret
         start_response(status, headers)
-        return rval
+        return [rval]
 
 if __name__ == '__main__':
     app = simple_app
 
     ip = "0.0.0.0"
-    port = 10001
+    port = int(os.getenv("CLOUD_PORT", 10001))
+
+    STORE = ColumnStore(DATADIR)
 
     # Setup App Server
 
-    hs = HTTPServerThread(ip, port, app)
+    hs = HTTPServerThread(ip, port, app, SERVER_MODE)
     hs.start()
 
     def terminate_self():
         print "Stopping the application"
         try:
             hs.stop()
-            p.stop()
+            STORE.close()
         except Exception as ex:
             print "Error stopping the app gracefully."
         print "Killing self.."
@@ -0,0 +1,253 @@
+"""
+Columnar sample store of the cloud endpoint.
+
+Samples are stored per device (the collector that posted them) in chunks of
+up to CHUNK_ROWS rows. A chunk holds an array('d') of timestamps and one
+array('d') per numeric tag, with NaN where a row has no value for the tag.
+Appending a sample is a few array appends, no objects are kept per sample.
+
+When a chunk is full it is written to disk and memory mapped, so only the
+open chunk of every device takes heap memory. A chunk file is
+
+    "<I" length of the JSON header, JSON header, padding to 8 bytes,
+    timestamps, then the values of every column in header order
+
+with native byte order doubles. Chunk files found at start up are mapped
+again, so stored samples survive restarts of the endpoint.
+
+Queries return the [timestamp, value] pairs of a device tag in a time
+range. Chunks whose time range does not overlap are skipped, and chunks
+with ascending timestamps are searched by bisection.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import urllib
+from array import array
+
+CHUNK_ROWS = 65536
+HEADER = struct.Struct("<I")
+DOUBLE = struct.Struct("=d")
+NAN = float("nan")
+
+
+class _MappedColumn(object):
+    """
+    Read only sequence of the doubles of a column in a mapped chunk file.
+    """
+    __slots__ = ("buf", "offset", "length")
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(self.length)
+            values = array("d")
+            if stop > start:
+                values.fromstring(self.buf[self.offset + 8 * start:self.offset + 8 * stop])
+            return values
+        if index < 0:
+            index += self.length
+        return DOUBLE.unpack_from(self.buf, self.offset + 8 * index)[0]
+
+
+class Chunk(object):
+    """
+    Rows of one device, in memory until sealed, memory mapped afterwards.
+    """
+    def __init__(self, capacity=CHUNK_ROWS):
+        self.capacity = capacity
+        self.times = array("d")
+        self.columns = dict()
+        self.tmin = float("inf")
+        self.tmax = float("-inf")
+        self.ascending = True
+        self.path = None
+        self.map = None
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def full(self):
+        return len(self.times) >= self.capacity
+
+    def append(self, timestamp, values):
+        """
+        Append a row. values is a dict of tag name -> float.
+        """
+        n = len(self.times)
+        if timestamp < self.tmax:
+            self.ascending = False
+        if timestamp < self.tmin:
+            self.tmin = timestamp
+        if timestamp > self.tmax:
+            self.tmax = timestamp
+        self.times.append(timestamp)
+        for name, value in values.iteritems():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = array("d", [NAN]) * n
+            column.append(value)
+        if len(values) != len(self.columns):
+            for column in self.columns.itervalues():
+                if len(column) == n:
+                    column.append(NAN)
+
+    def seal(self, path):
+        """
+        Write the chunk to path and replace its arrays with a memory map.
+        """
+        names = sorted(self.columns)
+        header = json.dumps({"rows": len(self.times), "columns": names, "tmin": self.tmin,
+                             "tmax": self.tmax, "ascending": self.ascending,
+                             "byteorder": sys.byteorder})
+        padding = -(HEADER.size + len(header)) % 8
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(len(header)) + header + "\0" * padding)
+            self.times.tofile(f)
+            for name in names:
+                self.columns[name].tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        self._map(path)
+
+    @classmethod
+    def load(cls, path):
+        chunk = cls()
+        chunk._map(path)
+        return chunk
+
+    def _map(self, path):
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        length = HEADER.unpack_from(buf)[0]
+        header = json.loads(buf[HEADER.size:HEADER.size + length])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("%s was written with %s endian doubles" % (path, header["byteorder"]))
+        rows = header["rows"]
+        offset = HEADER.size + length
+        offset += -offset % 8
+        self.times = _MappedColumn(buf, offset, rows)
+        self.columns = dict()
+        for i, name in enumerate(header["columns"]):
+            self.columns[name] = _MappedColumn(buf, offset + 8 * rows * (i + 1), rows)
+        self.capacity = rows
+        self.tmin = header["tmin"]
+        self.tmax = header["tmax"]
+        self.ascending = header["ascending"]
+        self.path = path
+        self.map = buf
+
+    def query(self, name, start, end):
+        """
+        Return [[timestamp, value], ...] of a column for start <= timestamp <= end.
+        """
+        column = self.columns.get(name)
+        if column is None or end < self.tmin or start > self.tmax:
+            return []
+        times = self.times
+        if self.ascending:
+            first = bisect.bisect_left(times, start)
+            last = bisect.bisect_right(times, end, first)
+            return [[t, v] for t, v in zip(times[first:last], column[first:last]) if v == v]
+        times = times[0:len(times)]
+        values = column[0:len(times)]
+        return [[t, v] for t, v in zip(times, values) if start <= t <= end and v == v]
+
+
+class ColumnStore(object):
+    """
+    The chunks of all devices. The last chunk of a device is the open one.
+    """
+    def __init__(self, directory, chunk_rows=CHUNK_ROWS):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.devices = dict()
+        self.sealed = dict()
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for entry in sorted(os.listdir(directory)):
+            path = os.path.join(directory, entry)
+            if not os.path.isdir(path):
+                continue
+            device = urllib.unquote(entry)
+            chunks = [Chunk.load(os.path.join(path, name))
+                      for name in sorted(os.listdir(path)) if name.endswith(".chunk")]
+            self.sealed[device] = len(chunks)
+            self.devices[device] = chunks + [Chunk(chunk_rows)]
+
+    def _seal(self, device, chunk):
+        path = os.path.join(self.directory, urllib.quote(device, safe=""))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        seq = self.sealed.get(device, 0)
+        chunk.seal(os.path.join(path, "%012d.chunk" % seq))
+        self.sealed[device] = seq + 1
+
+    def append(self, device, rows):
+        """
+        Append (timestamp, {tag: float}) rows of a device.
+        """
+        with self.lock:
+            chunks = self.devices.get(device)
+            if chunks is None:
+                chunks = self.devices[device] = [Chunk(self.chunk_rows)]
+            chunk = chunks[-1]
+            for timestamp, values in rows:
+                chunk.append(timestamp, values)
+                if chunk.full:
+                    self._seal(device, chunk)
+                    chunk = Chunk(self.chunk_rows)
+                    chunks.append(chunk)
+
+    def tags(self):
+        """
+        Return {device: [tag, ...]}.
+        """
+        with self.lock:
+            return dict((device, sorted(set().union(*[c.columns for c in chunks])))
+                        for device, chunks in self.devices.iteritems())
+
+    def query(self, device, tag, start=None, end=None):
+        """
+        Return [[timestamp, value], ...] of a device tag in time order, or
+        None for an unknown device.
+        """
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        # Only the open chunk changes, the sealed ones are scanned without
+        # holding up appends
+        with self.lock:
+            chunks = self.devices.get(device)
+            if chunks is None:
+                return None
+            chunks = list(chunks)
+            points = chunks[-1].query(tag, start, end)
+        for chunk in chunks[:-1]:
+            points.extend(chunk.query(tag, start, end))
+        points.sort()
+        return points
+
+    def close(self):
+        """
+        Write the open chunks to disk.
+        """
+        with self.lock:
+            for device, chunks in self.devices.iteritems():
+                if len(chunks[-1]):
+                    self._seal(device, chunks[-1])
+                    chunks.append(Chunk(self.chunk_rows))
@@ -0,0 +1,782 @@
+#!/usr/bin/env python
+'''
+Modbus load simulator
+--------------------------------------------------------------------------
+
+Simulates a site of many Modbus TCP devices in one process, to size and
+load test collectors:
+
+    python load_simulator.py --config ../app/project/package_config.ini \\
+        --ports 50 --units 10 --rate 2
+
+serves 500 devices: unit ids 1-10 on each of the ports 5020-5069. Every
+device has the register map of the [tags] section of the config file (the
+format of the modbus app), or with --generate N a synthetic map of N
+float32 tags. Unit id 0 is answered by unit 1 of the port.
+
+How a tag changes is set in an optional [simulation] section:
+
+    [simulation]
+    # name: kind[, key=value ...]
+    Temperature: sine, min=25, max=30, period=60
+    Humidity: walk, min=35, max=45, step=0.5
+    Pressure: step, min=100, max=104, interval=30
+    Key: constant, value=SELECT
+
+Numeric tags without an entry do a random walk between 0 and 100, string
+tags hold their name. Each device starts at its own random value and phase.
+
+The registers of all devices live in one numpy byte array in wire format.
+An update computes the new values of all tags of all devices with a few
+vectorized operations per generator kind and scatters their encoded bytes
+into the array, and a read is answered with a slice of it. Requests are
+served by a single threaded asyncore (poll) loop, which also runs the
+updates, so reads never see half written values.
+
+Supports read holding registers (3), read input registers (4, same data),
+write single register (6) and write multiple registers (16).
+
+Faults can be injected per port and unit, at start up with --fault and at
+runtime through the line based control port (--control-port, e.g. with
+telnet or nc):
+
+    fault [ports=5020-5029] [units=1-5] [latency=<distribution>] [drop=P]
+          [exception=P[:code]] [reset=P] [drip=P[:seconds per byte]]
+    clear [ports=...] [units=...]
+    show
+    stats       request, drop, exception and reset counters
+
+latency delays every response by a sample of fixed:S, uniform:MIN:MAX,
+normal:MEAN:SD, lognormal:MEDIAN:SIGMA or exp:MEAN seconds. With
+probability P a request is not answered (drop), answered with a Modbus
+exception (default code 4, slave device failure), answered by resetting
+the connection, or answered one byte at a time (drip, 0.1s per byte by
+default). Responses of a connection always leave in request order, so a
+slow response also delays the ones pipelined behind it. A fault command
+replaces the fault profile of the selected units; without ports= or units=
+it applies to all of them.
+
+With --framer rtu the ports speak Modbus RTU instead of Modbus TCP, like a
+TCP to serial gateway, and with --serial PATH the devices of the first port
+are also served as RTU slaves on a pseudo terminal, linked to PATH, so a
+collector can poll them as a serial bus:
+
+    python load_simulator.py --units 8 --serial /tmp/ttyMODBUS --baudrate 9600
+
+RTU slaves do not answer unit ids without a device, like on a real bus.
+--baudrate delays every RTU response by the time its request and response
+take on a line of that speed, so a port is busy as long as a real bus.
+'''
+import argparse
+import asynchat
+import asyncore
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import socket
+import struct
+import sys
+import time
+import tty
+from ConfigParser import SafeConfigParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "src"))
+from connection import CRC, SerialLine, crc16
+from tagmap import Tag, _permutation, load_tags
+
+logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("simulator")
+log.setLevel(logging.INFO)
+
+MBAP = struct.Struct(">HHHB")
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_REGISTERS = 16
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+GATEWAY_TARGET_FAILED = 11
+
+# tag type -> big endian numpy dtype
+DTYPES = {
+    "uint16": ">u2", "int16": ">i2",
+    "uint32": ">u4", "int32": ">i4", "float32": ">f4",
+    "uint64": ">u8", "int64": ">i8", "float64": ">f8",
+}
+GENERATORS = ("sine", "walk", "step", "constant")
+SLAVE_DEVICE_FAILURE = 4
+
+
+class Timers(object):
+    """
+    Callbacks run by the main loop at a given time.
+    """
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+
+    def call_at(self, when, callback, *args):
+        heapq.heappush(self.heap, (when, next(self.seq), callback, args))
+
+    def next(self):
+        return self.heap[0][0] if self.heap else None
+
+    def run(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.heap)
+            callback(*args)
+
+
+TIMERS = Timers()
+
+
+def parse_distribution(spec):
+    """
+    Return a function sampling the latency distribution spec in seconds.
+    """
+    fields = spec.split(":")
+    kind, args = fields[0], [float(f) for f in fields[1:]]
+    if kind == "fixed" and len(args) == 1:
+        return lambda: args[0]
+    if kind == "uniform" and len(args) == 2:
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "normal" and len(args) == 2:
+        return lambda: max(0.0, random.gauss(args[0], args[1]))
+    if kind == "lognormal" and len(args) == 2:
+        mu = math.log(args[0])
+        return lambda: random.lognormvariate(mu, args[1])
+    if kind == "exp" and len(args) == 1:
+        return lambda: random.expovariate(1.0 / args[0])
+    raise ValueError("Invalid latency distribution %s" % spec)
+
+
+def parse_range(spec):
+    """
+    Parse "1-5,8" into a set of ints.
+    """
+    result = set()
+    for part in spec.split(","):
+        lo, _, hi = part.partition("-")
+        result.update(range(int(lo), int(hi or lo) + 1))
+    return result
+
+
+class Fault(object):
+    """
+    Fault profile of a unit.
+    """
+    __slots__ = ("spec", "latency", "drop", "exception", "code", "reset", "drip", "drip_interval")
+
+    def __init__(self, latency=None, drop=0, exception=0, code=SLAVE_DEVICE_FAILURE, reset=0,
+                 drip=0, drip_interval=0.1, spec=""):
+        self.spec = spec
+        self.latency = latency
+        self.drop = drop
+        self.exception = exception
+        self.code = code
+        self.reset = reset
+        self.drip = drip
+        self.drip_interval = drip_interval
+
+    @classmethod
+    def parse(cls, options):
+        """
+        Create a fault from the latency=, drop=, exception=, reset= and
+        drip= options of a fault command.
+        """
+        kwargs = dict(spec=" ".join("%s=%s" % item for item in sorted(options.items())))
+        for key, value in options.iteritems():
+            if key == "latency":
+                kwargs["latency"] = parse_distribution(value)
+            elif key in ("drop", "reset"):
+                kwargs[key] = float(value)
+            elif key == "exception":
+                p, _, code = value.partition(":")
+                kwargs["exception"] = float(p)
+                if code:
+                    kwargs["code"] = int(code)
+            elif key == "drip":
+                p, _, interval = value.partition(":")
+                kwargs["drip"] = float(p)
+                if interval:
+                    kwargs["drip_interval"] = float(interval)
+            else:
+                raise ValueError("Unknown fault option %s" % key)
+        return cls(**kwargs)
+
+
+def parse_simulation(name, value):
+    fields = [f.strip() for f in value.split(",")]
+    kind = fields[0].lower()
+    if kind not in GENERATORS:
+        raise ValueError("%s: unknown generator %s, expected one of %s" % (name, kind, ", ".join(GENERATORS)))
+    params = dict()
+    for field in fields[1:]:
+        key, sep, val = field.partition("=")
+        if not sep:
+            raise ValueError("%s: invalid generator option '%s'" % (name, field))
+        params[key.strip()] = val.strip()
+    return kind, params
+
+
+class Site(object):
+    """
+    The register images of all simulated devices and their generators.
+    """
+    def __init__(self, tags, specs, devices):
+        self.tags = tags
+        self.devices = devices
+        self.nregs = max(t.address + t.count for t in tags)
+        self.rowbytes = 2 * self.nregs
+        self.image = np.zeros((devices, self.rowbytes), dtype=np.uint8)
+        self.flat = self.image.reshape(-1)
+        self.start = time.time()
+        rows = np.arange(devices) * self.rowbytes
+
+        numeric = [t for t in tags if t.type != "string"]
+        for tag in tags:
+            if tag.type == "string":
+                kind, params = specs.get(tag.name, ("constant", dict()))
+                self._write_string(tag, params.get("value", tag.name))
+
+        # One entry per (device, numeric tag), tag major
+        n = len(numeric)
+        self.kind = np.empty(n * devices, dtype="S8")
+        self.lo = np.empty(n * devices)
+        self.hi = np.empty(n * devices)
+        self.param = np.empty(n * devices)
+        for i, tag in enumerate(numeric):
+            kind, params = specs.get(tag.name, ("walk", dict()))
+            lo = float(params.get("min", 0))
+            hi = float(params.get("max", params.get("value", 100)))
+            if kind == "constant":
+                lo = hi = float(params.get("value", lo))
+            s = slice(i * devices, (i + 1) * devices)
+            self.kind[s] = kind
+            self.lo[s] = lo
+            self.hi[s] = hi
+            # sine: period in seconds, walk: standard deviation of a step,
+            # step: seconds between steps
+            if kind == "walk":
+                self.param[s] = float(params.get("step", (hi - lo) / 50.0))
+            else:
+                self.param[s] = float(params.get("period", params.get("interval", 60)))
+        self.phase = np.random.uniform(0, 1, n * devices)
+        self.values = np.random.uniform(self.lo, self.hi)
+        self.next_step = self.start + self.phase * self.param
+        self.masks = dict((kind, self.kind == kind) for kind in GENERATORS)
+
+        # Encoding groups: tags with the same type, byte and word order and
+        # scale are encoded with one astype() and one scatter
+        self.encodings = []
+        groups = dict()
+        for i, tag in enumerate(numeric):
+            key = (tag.type, tag.byteorder, tag.wordorder, tag.scale or 1)
+            groups.setdefault(key, []).append(i)
+        for (type, byteorder, wordorder, scale), members in sorted(groups.items()):
+            count = numeric[members[0]].count
+            perm = np.array(_permutation(count, byteorder, wordorder))
+            entries = np.concatenate([np.arange(i * devices, (i + 1) * devices) for i in members])
+            base = np.concatenate([rows + numeric[i].address * 2 for i in members])
+            index = base[:, None] + perm[None, :]
+            self.encodings.append((np.dtype(DTYPES[type]), float(scale), entries, index))
+        self.update()
+
+    def _write_string(self, tag, text):
+        raw = text.encode("utf-8")[:tag.count * 2].ljust(tag.count * 2, "\0")
+        data = np.frombuffer(raw, dtype=np.uint8)
+        if tag.byteorder == "little":
+            data = data.reshape(-1, 2)[:, ::-1].reshape(-1)
+        start = tag.address * 2
+        self.image[:, start:start + len(data)] = data
+
+    def update(self):
+        now = time.time()
+        values = self.values
+        m = self.masks["sine"]
+        if m.any():
+            t = (now - self.start) / self.param[m] + self.phase[m]
+            values[m] = self.lo[m] + (self.hi[m] - self.lo[m]) * (0.5 + 0.5 * np.sin(2 * np.pi * t))
+        m = self.masks["walk"]
+        if m.any():
+            values[m] = np.clip(values[m] + np.random.normal(0, 1, m.sum()) * self.param[m], self.lo[m], self.hi[m])
+        m = self.masks["step"] & (self.next_step <= now)
+        if m.any():
+            values[m] = np.random.uniform(self.lo[m], self.hi[m])
+            self.next_step[m] = now + self.param[m]
+        m = self.masks["constant"]
+        values[m] = self.lo[m]
+
+        for dtype, scale, entries, index in self.encodings:
+            raw = values[entries] / scale
+            if dtype.kind in "iu":
+                info = np.iinfo(dtype)
+                raw = np.clip(np.round(raw), info.min, info.max)
+            data = raw.astype(dtype).view(np.uint8).reshape(len(entries), -1)
+            self.flat[index] = data
+
+    def read(self, device, address, count):
+        start = address * 2
+        return self.image[device, start:start + 2 * count].tobytes()
+
+    def write(self, device, address, data):
+        start = address * 2
+        self.image[device, start:start + len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+
+class ModbusHandler(asyncore.dispatcher):
+    """
+    A client connection. Requests are answered in the order they arrive,
+    so pipelined requests are supported.
+    """
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock)
+        self.server = server
+        self.inbuf = ""
+        self.outbuf = []
+        # Time the last delayed response of the connection is sent
+        self.busy_until = 0
+        # Seconds per byte RTU responses are delayed by
+        self.char_time = server.char_time
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        buf = self.inbuf + data
+        pos = 0
+        while len(buf) - pos >= MBAP.size:
+            tid, protocol, length, unit = MBAP.unpack_from(buf, pos)
+            if length < 2:
+                self.close()
+                return
+            end = pos + 6 + length
+            if end > len(buf):
+                break
+            pdu = buf[pos + MBAP.size:end]
+            pos = end
+            if not self.answer(tid, protocol, unit, pdu):
+                return
+        self.inbuf = buf[pos:]
+        if self.outbuf:
+            self.handle_write()
+
+    def frame(self, tid, protocol, unit, response):
+        return MBAP.pack(tid, protocol, len(response) + 1, unit) + response
+
+    def answer(self, tid, protocol, unit, pdu):
+        """
+        Answer a request. Returns False if the connection was reset.
+        """
+        fault = self.server.faults.get(unit or 1)
+        if fault is not None:
+            return self.inject(fault, tid, protocol, unit, pdu)
+        response = self.server.process(unit, pdu)
+        frame = self.frame(tid, protocol, unit, response)
+        char_time = self.char_time
+        if char_time:
+            self.delay(frame, (len(pdu) + len(frame) + 3) * char_time, None)
+        elif self.busy_until:
+            self.delay(frame, 0, None)
+        else:
+            self.outbuf.append(frame)
+        return True
+
+    def inject(self, fault, tid, protocol, unit, pdu):
+        """
+        Answer a request of a unit with a fault profile. Returns False if
+        the connection was reset.
+        """
+        server = self.server
+        if fault.reset and random.random() < fault.reset:
+            server.resets += 1
+            self.reset()
+            return False
+        if fault.drop and random.random() < fault.drop:
+            server.requests += 1
+            server.dropped += 1
+            return True
+        if fault.exception and random.random() < fault.exception:
+            server.requests += 1
+            server.exceptions += 1
+            response = struct.pack(">BB", ord(pdu[0]) | 0x80, fault.code)
+        else:
+            response = server.process(unit, pdu)
+        frame = self.frame(tid, protocol, unit, response)
+        latency = fault.latency() if fault.latency else 0
+        if self.char_time:
+            latency += (len(pdu) + len(frame) + 3) * self.char_time
+        drip = fault.drip_interval if fault.drip and random.random() < fault.drip else None
+        self.delay(frame, latency, drip)
+        return True
+
+    def delay(self, frame, latency, drip):
+        # Responses leave in request order, after the ones before them
+        now = time.time()
+        at = max(now + latency, self.busy_until)
+        self.busy_until = at + (len(frame) * drip if drip else 0)
+        TIMERS.call_at(at, self.push, frame, drip)
+
+    def push(self, frame, drip):
+        if not self.connected:
+            return
+        if drip:
+            self.outbuf.append(frame[0])
+            if len(frame) > 1:
+                TIMERS.call_at(time.time() + drip, self.push, frame[1:], drip)
+        else:
+            self.outbuf.append(frame)
+        if self.busy_until <= time.time():
+            self.busy_until = 0
+        self.handle_write()
+
+    def reset(self):
+        # Close with SO_LINGER 0, so the client sees a connection reset
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.close()
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        data = "".join(self.outbuf)
+        sent = self.send(data)
+        self.outbuf = [data[sent:]] if sent < len(data) else []
+
+    def handle_close(self):
+        self.close()
+
+
+def rtu_request_size(buf, pos):
+    """
+    Size of the RTU request frame at pos of buf, None if it is not known
+    yet, 0 for an unsupported function.
+    """
+    if len(buf) - pos < 2:
+        return None
+    function = ord(buf[pos + 1])
+    if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, WRITE_SINGLE_REGISTER):
+        return 8
+    if function == WRITE_MULTIPLE_REGISTERS:
+        if len(buf) - pos < 7:
+            return None
+        return 9 + ord(buf[pos + 6])
+    return 0
+
+
+class RtuHandler(ModbusHandler):
+    """
+    A client connection speaking Modbus RTU, one request at a time.
+    """
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        buf = self.inbuf + data
+        pos = 0
+        while True:
+            size = rtu_request_size(buf, pos)
+            if size is None or pos + size > len(buf):
+                break
+            request = buf[pos:pos + size]
+            if not size or crc16(request[:-2]) != CRC.unpack(request[-2:])[0]:
+                # A real slave waits for the next silent interval, start
+                # over with the next read
+                log.debug("%s: discarding garbled request %r", self.server.port, buf[pos:])
+                pos = len(buf)
+                break
+            pos += size
+            unit = ord(request[0])
+            # Only the slave addressed answers, and nobody a broadcast
+            if not 1 <= unit <= self.server.units:
+                continue
+            if not self.answer(0, 0, unit, request[1:-2]):
+                return
+        self.inbuf = buf[pos:]
+        if self.outbuf:
+            self.handle_write()
+
+    def frame(self, tid, protocol, unit, response):
+        adu = chr(unit) + response
+        return adu + CRC.pack(crc16(adu))
+
+
+class SerialPort(RtuHandler, asyncore.file_dispatcher):
+    """
+    The master side of a pseudo terminal, answering RTU requests written to
+    its slave side, which is linked to path, for the units of server.
+    """
+    def __init__(self, server, path, char_time=0):
+        self.master, self.slave = os.openpty()
+        # No echo or line editing, the bytes pass as they are
+        tty.setraw(self.slave)
+        asyncore.file_dispatcher.__init__(self, self.master)
+        self.server = server
+        self.inbuf = ""
+        self.outbuf = []
+        self.busy_until = 0
+        self.char_time = char_time
+        self.name = os.ttyname(self.slave)
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(self.name, path)
+        # The slave side stays open, or reads of the master side fail with
+        # EIO whenever no client has it open
+        self.path = path
+
+    def reset(self):
+        # A serial line cannot be reset, the request goes unanswered
+        self.server.dropped += 1
+
+    def handle_close(self):
+        pass
+
+
+class ModbusServer(asyncore.dispatcher):
+    """
+    One listening port, serving units 1..units of the site starting at
+    device first. RTU responses are delayed by char_time per byte.
+    """
+    def __init__(self, site, host, port, first, units, framer="tcp", char_time=0):
+        asyncore.dispatcher.__init__(self)
+        self.site = site
+        self.first = first
+        self.units = units
+        self.port = port
+        self.handler = RtuHandler if framer == "rtu" else ModbusHandler
+        self.char_time = char_time if framer == "rtu" else 0
+        self.requests = 0
+        self.dropped = 0
+        self.exceptions = 0
+        self.resets = 0
+        # unit -> Fault
+        self.faults = dict()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, _ = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.handler(sock, self)
+
+    def process(self, unit, pdu):
+        self.requests += 1
+        function = ord(pdu[0])
+        if unit == 0:
+            unit = 1
+        if not 1 <= unit <= self.units:
+            return struct.pack(">BB", function | 0x80, GATEWAY_TARGET_FAILED)
+        device = self.first + unit - 1
+        nregs = self.site.nregs
+        try:
+            if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+                address, count = struct.unpack_from(">HH", pdu, 1)
+                if not 1 <= count <= 125 or address + count > nregs:
+                    return struct.pack(">BB", function | 0x80, ILLEGAL_ADDRESS)
+                return struct.pack(">BB", function, 2 * count) + self.site.read(device, address, count)
+            if function == WRITE_SINGLE_REGISTER:
+                address = struct.unpack_from(">H", pdu, 1)[0]
+                if address >= nregs:
+                    return struct.pack(">BB", function | 0x80, ILLEGAL_ADDRESS)
+                self.site.write(device, address, pdu[3:5])
+                return pdu[:5]
+            if function == WRITE_MULTIPLE_REGISTERS:
+                address, count, nbytes = struct.unpack_from(">HHB", pdu, 1)
+                if address + count > nregs or nbytes != 2 * count:
+                    return struct.pack(">BB", function | 0x80, ILLEGAL_ADDRESS)
+                self.site.write(device, address, pdu[6:6 + nbytes])
+                return pdu[:5]
+        except struct.error:
+            return struct.pack(">BB", function | 0x80, ILLEGAL_ADDRESS)
+        return struct.pack(">BB", function | 0x80, ILLEGAL_FUNCTION)
+
+    def handle_close(self):
+        self.close()
+
+
+class ControlHandler(asynchat.async_chat):
+    """
+    A connection to the control port. See the module docstring for the
+    commands.
+    """
+    def __init__(self, sock, servers):
+        asynchat.async_chat.__init__(self, sock)
+        self.servers = servers
+        self.buffer = []
+        self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.buffer).strip()
+        self.buffer = []
+        if line:
+            try:
+                reply = control(self.servers, line)
+            except (ValueError, KeyError) as ex:
+                reply = "error %s" % ex
+            self.push(reply + "\n")
+
+
+class ControlServer(asyncore.dispatcher):
+    def __init__(self, servers, host, port):
+        asyncore.dispatcher.__init__(self)
+        self.servers = servers
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(8)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            ControlHandler(pair[0], self.servers)
+
+
+def control(servers, line):
+    """
+    Run a control command. Returns the reply.
+    """
+    words = line.split()
+    command = words[0].lower()
+    options = dict()
+    for word in words[1:]:
+        key, sep, value = word.partition("=")
+        if not sep:
+            raise ValueError("expected key=value, got %s" % word)
+        options[key.lower()] = value
+
+    if command == "stats":
+        return "ok requests=%d dropped=%d exceptions=%d resets=%d" % (
+            sum(s.requests for s in servers), sum(s.dropped for s in servers),
+            sum(s.exceptions for s in servers), sum(s.resets for s in servers))
+
+    if command == "show":
+        lines = []
+        for server in servers:
+            for unit, fault in sorted(server.faults.iteritems()):
+                lines.append("port %d unit %d: %s" % (server.port, unit, fault.spec))
+        return "\n".join(lines + ["ok %d faulty units" % len(lines)])
+
+    ports = parse_range(options.pop("ports")) if "ports" in options else None
+    units = parse_range(options.pop("units")) if "units" in options else None
+    if command == "fault":
+        fault = Fault.parse(options)
+    elif command == "clear":
+        fault = None
+    else:
+        raise ValueError("unknown command %s" % command)
+
+    count = 0
+    for server in servers:
+        if ports is not None and server.port not in ports:
+            continue
+        for unit in range(1, server.units + 1):
+            if units is not None and unit not in units:
+                continue
+            if fault is None:
+                server.faults.pop(unit, None)
+            else:
+                server.faults[unit] = fault
+            count += 1
+    log.info("%s: %d units", line, count)
+    return "ok %d units" % count
+
+
+def load_site(args):
+    specs = dict()
+    if args.generate:
+        tags = [Tag("tag%d" % i, 2 * i, "float32") for i in range(args.generate)]
+    else:
+        cfg = SafeConfigParser()
+        cfg.optionxform = str
+        if not cfg.read(args.config):
+            raise SystemExit("Cannot read %s" % args.config)
+        tags = load_tags(cfg)
+        if cfg.has_section("simulation"):
+            for name, value in cfg.items("simulation"):
+                specs[name] = parse_simulation(name, value)
+    return Site(tags, specs, args.ports * args.units)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many Modbus TCP devices")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          "..", "app", "project", "package_config.ini"),
+                        help="file with the [tags] (and optional [simulation]) section")
+    parser.add_argument("--generate", type=int, default=0, metavar="N",
+                        help="use N synthetic float32 tags instead of the config file")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--base-port", type=int, default=5020)
+    parser.add_argument("--ports", type=int, default=1, help="number of listening ports")
+    parser.add_argument("--units", type=int, default=1, help="unit ids per port")
+    parser.add_argument("--rate", type=float, default=1.0, help="value updates per second")
+    parser.add_argument("--framer", choices=("tcp", "rtu"), default="tcp",
+                        help="framing of the ports, rtu is Modbus RTU over TCP")
+    parser.add_argument("--serial", metavar="PATH",
+                        help="also serve the units of the first port as RTU slaves on a pty linked to PATH")
+    parser.add_argument("--baudrate", type=int, default=0,
+                        help="delay RTU responses like a serial line of this speed")
+    parser.add_argument("--control-port", type=int, default=0,
+                        help="port of the fault injection control interface")
+    parser.add_argument("--fault", action="append", default=[], metavar="COMMAND",
+                        help='fault command to run at start up, e.g. "fault units=1-5 drop=0.1"')
+    args = parser.parse_args()
+
+    site = load_site(args)
+    char_time = SerialLine(args.baudrate).char_time if args.baudrate else 0
+    servers = [ModbusServer(site, args.host, args.base_port + i, i * args.units, args.units, args.framer, char_time)
+               for i in range(args.ports)]
+    log.info("Simulating %d devices with %d tags (%d registers) each on ports %d-%d (%s)",
+             site.devices, len(site.tags), site.nregs, args.base_port, args.base_port + args.ports - 1,
+             args.framer)
+    if args.serial:
+        port = SerialPort(servers[0], args.serial, char_time)
+        log.info("Serving units 1-%d of port %d as RTU slaves on %s (%s)",
+                 args.units, args.base_port, port.path, port.name)
+    for command in args.fault:
+        control(servers, command)
+    if args.control_port:
+        ControlServer(servers, args.host, args.control_port)
+        log.info("Fault injection control on port %d", args.control_port)
+
+    interval = 1.0 / args.rate
+    next_update = time.time() + interval
+    next_report = time.time() + 10
+    requests = 0
+    while True:
+        now = time.time()
+        if now >= next_update:
+            started = time.time()
+            site.update()
+            next_update += interval
+            if next_update < now:
+                log.warning("Updates take longer than 1/rate (%.3fs)", time.time() - started)
+                next_update = now + interval
+        if now >= next_report:
+            total = sum(s.requests for s in servers)
+            log.info("%.0f requests/s, %d dropped, %d exceptions, %d resets in total",
+                     (total - requests) / 10.0, sum(s.dropped for s in servers),
+                     sum(s.exceptions for s in servers), sum(s.resets for s in servers))
+            requests = total
+            next_report += 10
+        TIMERS.run(time.time())
+        wakeup = min(next_update, next_report, TIMERS.next() or next_update)
+        asyncore.loop(timeout=max(0, wakeup - time.time()), use_poll=True, count=1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass